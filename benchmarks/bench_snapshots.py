@@ -0,0 +1,108 @@
+"""
+Snapshot refresh time and memory, dict rows + QuoteSnapshot models vs the
+preallocated columnar quote board (full refresh and in-place changed rows)
+
+usage: python -m benchmarks.bench_snapshots (from the project root)
+"""
+
+import time
+import tracemalloc
+import datetime as dt
+import random
+from typing import Callable, List
+
+from bunny_order.models import QuoteSnapshot, QUOTE_SNAPSHOT_DTYPES
+from bunny_order.common import Snapshots, ColumnarSnapshots
+from bunny_order.database.tsdb_client import rows_to_columns
+
+
+def make_rows(n_codes: int) -> List[tuple]:
+    """rows as returned by cursor.fetchall()"""
+    now = dt.datetime.now().replace(microsecond=0)
+    rows = []
+    for k in range(n_codes):
+        close = round(random.uniform(10, 1000), 2)
+        rows.append(
+            (
+                now,
+                f"{1000 + k}",
+                close,
+                close * 1.02,
+                close * 0.98,
+                close,
+                random.randint(1, 100),
+                random.randint(100, 100000),
+                random.randint(1000, 100000),
+                random.randint(100000, 100000000),
+                close,
+                random.randint(1, 100),
+                close,
+                random.randint(1, 100),
+            )
+        )
+    return rows
+
+
+def refresh_dict(rows: List[tuple], snapshots: Snapshots):
+    cols = list(QUOTE_SNAPSHOT_DTYPES)
+    data = [{col: row[k] for k, col in enumerate(cols)} for row in rows]
+    snapshots.update({x["code"]: QuoteSnapshot(**x) for x in data})
+
+
+def refresh_columns(rows: List[tuple], snapshots: ColumnarSnapshots):
+    columns = rows_to_columns(rows, list(QUOTE_SNAPSHOT_DTYPES), QUOTE_SNAPSHOT_DTYPES)
+    snapshots.update_columns(columns)
+
+
+def apply_changes(rows: List[tuple], snapshots: ColumnarSnapshots):
+    columns = rows_to_columns(rows, list(QUOTE_SNAPSHOT_DTYPES), QUOTE_SNAPSHOT_DTYPES)
+    snapshots.apply_columns(columns)
+
+
+def measure_memory(factory: Callable, refresh: Callable, rows: List[tuple]) -> float:
+    """KiB held by a store refreshed with rows"""
+    tracemalloc.start()
+    snapshots = factory()
+    refresh(rows, snapshots)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del snapshots
+    return size / 1024
+
+
+def timeit(func: Callable, *args, repeat: int = 10) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    print(
+        f"{'codes':>6} {'dict (ms)':>10} {'columns (ms)':>13} {'speedup':>8} "
+        f"{'in-place 10% (ms)':>18} {'dict (KiB)':>11} {'columns (KiB)':>14}"
+    )
+    # ~2600 listed TWSE + TPEx codes
+    for n_codes in [100, 1000, 2600, 5000]:
+        rows = make_rows(n_codes)
+        changed_rows = random.sample(rows, n_codes // 10)
+        t_dict = timeit(refresh_dict, rows, Snapshots())
+        t_columns = timeit(refresh_columns, rows, ColumnarSnapshots())
+        board = ColumnarSnapshots()
+        refresh_columns(rows, board)
+        t_apply = timeit(apply_changes, changed_rows, board)
+        m_dict = measure_memory(Snapshots, refresh_dict, rows)
+        m_columns = measure_memory(
+            lambda: ColumnarSnapshots(capacity=n_codes), refresh_columns, rows
+        )
+        print(
+            f"{n_codes:>6} {t_dict * 1000:>10.3f} {t_columns * 1000:>13.3f} "
+            f"{t_dict / t_columns:>7.1f}x {t_apply * 1000:>18.3f} "
+            f"{m_dict:>11.1f} {m_columns:>14.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
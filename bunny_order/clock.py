@@ -0,0 +1,127 @@
+import time
+import threading
+import datetime as dt
+from enum import Enum
+from typing import Callable, NamedTuple
+
+from bunny_order.config import Config
+from bunny_order.utils import logger, get_tpe_datetime
+
+
+class SessionPhase(str, Enum):
+    Closed = "Closed"
+    PreSync = "PreSync"
+    PreMarket = "PreMarket"
+    Trading = "Trading"
+    PostTrade = "PostTrade"
+
+
+class SessionState(NamedTuple):
+    now: dt.datetime
+    phase: SessionPhase
+    is_week_date: bool
+    is_sync_time: bool
+    is_signal_time: bool
+    is_before_market_signal_time: bool
+    is_trade_time: bool
+
+
+class SessionClock:
+    """
+    Cached TPE time and session phase derived from the engine schedule
+
+    the state is recomputed at most once per `resolution` seconds (or when the
+    monotonic clock goes backwards), phase changes are logged
+    """
+
+    def __init__(
+        self,
+        time_source: Callable[[], dt.datetime] = get_tpe_datetime,
+        resolution: float = Config.CLOCK_RESOLUTION,
+        debug: bool = Config.DEBUG,
+    ):
+        self.time_source = time_source
+        self.resolution = resolution
+        self.debug = debug
+        self.lock = threading.Lock()
+        self._state: SessionState = None
+        self._refresh_ts = 0.0
+        self._expire_ts = 0.0
+
+    def set_time_source(self, time_source: Callable[[], dt.datetime]):
+        self.time_source = time_source
+        self.invalidate()
+
+    def invalidate(self):
+        self._expire_ts = 0.0
+
+    def get_phase(self, now: dt.datetime) -> SessionPhase:
+        ntime = now.time()
+        if now.weekday() >= 5:
+            return SessionPhase.Closed
+        elif ntime < Config.SYNC_START_TIME:
+            return SessionPhase.PreSync
+        elif ntime < Config.TRADE_START_TIME:
+            return SessionPhase.PreMarket
+        elif ntime <= Config.TRADE_END_TIME:
+            return SessionPhase.Trading
+        return SessionPhase.PostTrade
+
+    def _compute(self, now: dt.datetime) -> SessionState:
+        ntime = now.time()
+        return SessionState(
+            now=now,
+            phase=self.get_phase(now),
+            is_week_date=self.debug or now.weekday() < 5,
+            is_sync_time=self.debug
+            or Config.SYNC_START_TIME <= ntime <= Config.SYNC_END_TIME,
+            is_signal_time=self.debug
+            or Config.SIGNAL_START_TIME <= ntime < Config.SIGNAL_END_TIME,
+            is_before_market_signal_time=self.debug
+            or Config.SIGNAL_START_TIME <= ntime < Config.BEFORE_MARKET_END_TIME,
+            is_trade_time=self.debug
+            or Config.TRADE_START_TIME <= ntime <= Config.TRADE_END_TIME,
+        )
+
+    def get_state(self) -> SessionState:
+        ts = time.monotonic()
+        state = self._state
+        if state is not None and self._refresh_ts <= ts < self._expire_ts:
+            return state
+
+        with self.lock:
+            prev_state = self._state
+            state = self._compute(self.time_source())
+            self._state = state
+            self._refresh_ts = ts
+            self._expire_ts = ts + self.resolution
+            if prev_state is not None and prev_state.phase != state.phase:
+                logger.info(f"session phase: {prev_state.phase} -> {state.phase}")
+        return state
+
+    def now(self) -> dt.datetime:
+        return self.get_state().now
+
+    def today(self) -> dt.date:
+        return self.get_state().now.date()
+
+    def phase(self) -> SessionPhase:
+        return self.get_state().phase
+
+    def is_week_date(self) -> bool:
+        return self.get_state().is_week_date
+
+    def is_sync_time(self) -> bool:
+        return self.get_state().is_sync_time
+
+    def is_signal_time(self) -> bool:
+        return self.get_state().is_signal_time
+
+    def is_before_market_signal_time(self) -> bool:
+        return self.get_state().is_before_market_signal_time
+
+    def is_trade_time(self) -> bool:
+        return self.get_state().is_trade_time
+
+
+clock = SessionClock()
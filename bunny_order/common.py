@@ -1,35 +1,71 @@
-from typing import Dict, List, Tuple
+import bisect
+import time
+from types import MappingProxyType
+from typing import Callable, Dict, List, Mapping, NamedTuple, Optional, Tuple, TypeVar
 import datetime as dt
+import numpy as np
 
 from bunny_order.models import (
     Strategy,
     Position,
+    Trade,
     Contract,
     QuoteSnapshot,
+    QUOTE_SNAPSHOT_DTYPES,
     ComingDividend,
 )
-from bunny_order.utils import ReadWriteLock, get_tpe_datetime
+from bunny_order.utils import WriteLock, logger
+from bunny_order.clock import clock
 from bunny_order.config import Config
 
 
+def freeze(data: dict) -> Mapping:
+    """read-only view over a private copy of data"""
+    return MappingProxyType(dict(data))
+
+
+EMPTY = freeze({})
+
+T = TypeVar("T")
+
+# Position.qty and Trade.qty are in lots
+LOT_SIZE = 1000
+
+# Caches are copy-on-write: writers build a new immutable mapping aside and
+# publish it with a single reference swap (serialized by the write lock),
+# readers take a reference once and never lock nor see a partial update.
+# `version` is incremented on every publish, Strategies and Positions publish
+# only when their data changed.
+
+
 class Strategies:
     def __init__(self, tolerance: int = 60):
-        self._data: Dict[int, Strategy] = {}
-        self.lock = ReadWriteLock()
+        self._data: Mapping[int, Strategy] = EMPTY
+        self.lock = WriteLock("strategies")
+        self.version = 0
         self.update_dt: dt.datetime = None
         self.tolerance = tolerance
 
-    def update(self, data: Dict[int, Strategy]):
+    def update(self, data: Dict[int, Strategy], update_dt: dt.datetime = None):
+        data = freeze(data)
         self.lock.acquire_write()
-        self._data.clear()
-        self._data.update(data)
-        self.lock.release_write()
-        self.update_dt = get_tpe_datetime()
+        try:
+            # an identical reload keeps the version
+            if data != self._data:
+                self._data = data
+                self.version += 1
+        finally:
+            self.lock.release_write()
+        self.update_dt = update_dt or clock.now()
+
+    def touch(self):
+        """mark as up to date without reloading, e.g. no change notified"""
+        self.update_dt = clock.now()
 
     def _check_updated(self):
         if (
             self.update_dt is None
-            or (get_tpe_datetime() - self.update_dt).seconds > self.tolerance
+            or (clock.now() - self.update_dt).seconds > self.tolerance
         ):
             raise Exception(
                 f"strategy outdated, previous update time: {self.update_dt}"
@@ -38,7 +74,7 @@ class Strategies:
     def check_updated(self) -> bool:
         if (
             self.update_dt is None
-            or (get_tpe_datetime() - self.update_dt).seconds > self.tolerance
+            or (clock.now() - self.update_dt).seconds > self.tolerance
         ):
             return False
         return True
@@ -49,42 +85,43 @@ class Strategies:
 
     def get_strategy(self, strategy_id: int) -> Strategy:
         self._check_updated()
-        if strategy_id in self._data:
-            return self._data[strategy_id]
+        strategy = self._data.get(strategy_id)
+        if strategy is not None:
+            return strategy
         raise Exception(f"cannot find strategy_id: {strategy_id}")
 
     def get_id(self, name: str) -> int:
         self._check_updated()
         strategy_id = 7
-        try:
-            self.lock.acquire_read()
-            for _id, strategy in self._data.items():
-                if name == strategy.name:
-                    strategy_id = strategy.id
-        finally:
-            self.lock.release_read()
+        for _id, strategy in self._data.items():
+            if name == strategy.name:
+                strategy_id = strategy.id
 
         return strategy_id
 
 
 class Snapshots:
     def __init__(self, tolerance: int = 60):
-        self._data: Dict[str, QuoteSnapshot] = {}
-        self.lock = ReadWriteLock()
+        self._data: Mapping[str, QuoteSnapshot] = EMPTY
+        self.lock = WriteLock("snapshots")
+        self.version = 0
         self.update_dt: dt.datetime = None
         self.tolerance = tolerance
 
-    def update(self, data: Dict[int, QuoteSnapshot]):
+    def update(self, data: Dict[int, QuoteSnapshot], update_dt: dt.datetime = None):
+        data = freeze(data)
         self.lock.acquire_write()
-        self._data.clear()
-        self._data.update(data)
-        self.lock.release_write()
-        self.update_dt = get_tpe_datetime()
+        try:
+            self._data = data
+            self.version += 1
+        finally:
+            self.lock.release_write()
+        self.update_dt = update_dt or clock.now()
 
     def _check_updated(self):
         if (
             self.update_dt is None
-            or (get_tpe_datetime() - self.update_dt).seconds > self.tolerance
+            or (clock.now() - self.update_dt).seconds > self.tolerance
         ):
             raise Exception(
                 f"snapshots outdated, previous update time: {self.update_dt}"
@@ -94,45 +131,439 @@ class Snapshots:
         if Config.DEBUG:
             return True
 
-        result = True
+        data = self._data
+        for code in codes:
+            if code in data:
+                if (clock.now() - data[code].dt).seconds > self.tolerance:
+                    return False
+        return True
+
+    def get_snapshot(self, code: str) -> QuoteSnapshot:
+        self._check_updated()
+        snapshot = self._data.get(code)
+        if snapshot is not None:
+            return snapshot
+        raise Exception(f"cannot find snapshot: {code}")
+
+    def get_quote_columns(
+        self, codes: List[str]
+    ) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+        """
+        quote columns aligned with `codes` and the mask of codes found,
+        rows of missing codes are undefined
+        """
+        self._check_updated()
+        data = self._data
+        found = np.array([code in data for code in codes], dtype=bool)
+        snapshots = [data[code] for code in codes if code in data]
+        columns = {}
+        for key, dtype in QUOTE_SNAPSHOT_DTYPES.items():
+            col = np.zeros(len(codes), dtype=dtype)
+            col[found] = np.array([getattr(x, key) for x in snapshots], dtype=dtype)
+            columns[key] = col
+        return columns, found
+
+
+class SnapshotBoard(NamedTuple):
+    """preallocated column arrays and the slot of each code"""
+
+    columns: Mapping[str, np.ndarray]
+    index: Mapping[str, int]
+
+
+def allocate_columns(capacity: int) -> Dict[str, np.ndarray]:
+    return {
+        key: np.zeros(capacity, dtype=dtype)
+        for key, dtype in QUOTE_SNAPSHOT_DTYPES.items()
+    }
+
+
+class ColumnarSnapshots(Snapshots):
+    """
+    Quote board of one slot per code in preallocated column arrays
+    (see DataManager.get_quote_snapshot_columns), QuoteSnapshot is only built
+    when requested
+
+    quotes are written in place, the board (arrays and code -> slot index) is
+    only republished when a code is added or the arrays grow. Writers bump
+    `_seq` before and after writing (odd while writing), lock-free readers
+    retry a read that overlapped a write.
+    """
+
+    def __init__(self, tolerance: int = 60, capacity: int = Config.SNAPSHOT_CAPACITY):
+        super().__init__(tolerance=tolerance)
+        self._board = SnapshotBoard(freeze(allocate_columns(capacity)), EMPTY)
+        self._seq = 0
+
+    @property
+    def capacity(self) -> int:
+        return len(self._board.columns["code"])
+
+    def update(self, data: Dict[str, QuoteSnapshot], update_dt: dt.datetime = None):
+        snapshots = list(data.values())
+        columns = {
+            key: np.array([getattr(x, key) for x in snapshots], dtype=dtype)
+            for key, dtype in QUOTE_SNAPSHOT_DTYPES.items()
+        }
+        self.update_columns(columns, update_dt=update_dt)
+
+    def update_columns(
+        self, columns: Dict[str, np.ndarray], update_dt: dt.datetime = None
+    ):
+        """replace the board content, slots are reassigned"""
+        self.lock.acquire_write()
+        try:
+            self._write(columns, EMPTY)
+        finally:
+            self.lock.release_write()
+        self.update_dt = update_dt or clock.now()
+
+    def apply_columns(
+        self, columns: Dict[str, np.ndarray], update_dt: dt.datetime = None
+    ) -> List[str]:
+        """write changed rows into the slots of their codes, return changed codes"""
+        codes = columns["code"].tolist()
+        self.lock.acquire_write()
+        try:
+            self._write(columns, self._board.index)
+        finally:
+            self.lock.release_write()
+        self.update_dt = update_dt or clock.now()
+        return list(dict.fromkeys(codes))
+
+    def _write(self, columns: Dict[str, np.ndarray], index: Mapping[str, int]):
+        """write rows with the write lock held"""
+        board = self._board
+        codes = columns["code"].tolist()
+        new_codes = [code for code in dict.fromkeys(codes) if code not in index]
+        if new_codes or index is not board.index:
+            index = dict(index)
+            for code in new_codes:
+                index[code] = len(index)
+            index = freeze(index)
+        board_columns = board.columns
+        capacity = len(board_columns["code"])
+        if len(index) > capacity:
+            while capacity < len(index):
+                capacity *= 2
+            logger.info(f"snapshots grow | capacity: {capacity}")
+            # readers of the previous arrays keep them, new quotes go to the copy
+            new_columns = allocate_columns(capacity)
+            size = len(board.index)
+            for key, arr in board_columns.items():
+                new_columns[key][:size] = arr[:size]
+            board_columns = freeze(new_columns)
+        rows = np.array([index[code] for code in codes], dtype=np.int64)
+
+        self._seq += 1
         try:
-            self.lock.acquire_read()
-            for code in codes:
-                if code in self._data:
-                    if (
-                        get_tpe_datetime() - self._data[code].dt
-                    ).seconds > self.tolerance:
-                        result = False
+            for key, arr in board_columns.items():
+                # the last row of a code wins
+                arr[rows] = columns[key]
+            if index is not board.index or board_columns is not board.columns:
+                self._board = SnapshotBoard(board_columns, index)
+            self.version += 1
         finally:
-            self.lock.release_read()
+            self._seq += 1
+
+    def _read_consistent(self, read: Callable[[SnapshotBoard], T]) -> T:
+        while True:
+            seq = self._seq
+            if not seq % 2:
+                result = read(self._board)
+                if self._seq == seq:
+                    return result
+            time.sleep(0)
+
+    def get_watermarks(self) -> Dict[str, dt.datetime]:
+        def read(board: SnapshotBoard) -> Dict[str, dt.datetime]:
+            dts = board.columns["dt"][: len(board.index)].tolist()
+            return {code: dts[k] for code, k in board.index.items()}
+
+        return self._read_consistent(read)
+
+    def get_columns(self) -> Mapping[str, np.ndarray]:
+        """
+        read-only views of the used slots without copy, in slot order,
+        the views see later in-place updates
+        """
+        board = self._board
+        size = len(board.index)
+        columns = {}
+        for key, arr in board.columns.items():
+            view = arr[:size]
+            view.flags.writeable = False
+            columns[key] = view
+        return freeze(columns)
 
-        return result
+    def check_updated(self, codes: List[str] = ["0050", "2330", "2317"]) -> bool:
+        if Config.DEBUG:
+            return True
+
+        def read(board: SnapshotBoard) -> List[dt.datetime]:
+            dts = board.columns["dt"]
+            return [
+                dts[board.index[code]].item() for code in codes if code in board.index
+            ]
+
+        now = clock.now()
+        for dt_ in self._read_consistent(read):
+            if (now - dt_).seconds > self.tolerance:
+                return False
+        return True
 
     def get_snapshot(self, code: str) -> QuoteSnapshot:
         self._check_updated()
-        if code in self._data:
-            return self._data[code]
+
+        def read(board: SnapshotBoard) -> Dict:
+            if code not in board.index:
+                return None
+            k = board.index[code]
+            return {key: arr[k].item() for key, arr in board.columns.items()}
+
+        row = self._read_consistent(read)
+        if row is not None:
+            return QuoteSnapshot.construct(**row)
         raise Exception(f"cannot find snapshot: {code}")
 
+    def get_quote_columns(
+        self, codes: List[str]
+    ) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+        self._check_updated()
+
+        def read(board: SnapshotBoard) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+            slots = np.array(
+                [board.index.get(code, -1) for code in codes], dtype=np.int64
+            )
+            found = slots >= 0
+            # gathered copies, slot 0 stands in for missing codes
+            slots[~found] = 0
+            return {key: arr[slots] for key, arr in board.columns.items()}, found
+
+        return self._read_consistent(read)
+
+
+class PositionIndex(NamedTuple):
+    """positions with indexes derived at publish time"""
+
+    data: Mapping[int, Mapping[str, Position]]
+    # distinct codes held by any strategy
+    codes: Tuple[str, ...]
+    # code -> strategies holding it
+    code_strategies: Mapping[str, Tuple[int, ...]]
+    # (strategy, code) of every position
+    strategy_codes: Tuple[Tuple[int, str], ...]
+
+    @classmethod
+    def from_data(cls, data: Mapping[int, Mapping[str, Position]]) -> "PositionIndex":
+        code_strategies: Dict[str, List[int]] = {}
+        strategy_codes = []
+        for strategy_id, d0 in data.items():
+            for code in d0:
+                strategy_codes.append((strategy_id, code))
+                if code not in code_strategies:
+                    code_strategies[code] = []
+                code_strategies[code].append(strategy_id)
+        return cls(
+            data,
+            tuple(code_strategies),
+            freeze({code: tuple(x) for code, x in code_strategies.items()}),
+            tuple(strategy_codes),
+        )
+
+
+def apply_trade_to_position(
+    position: Optional[Position], trade: Trade
+) -> Optional[Position]:
+    """position after the trade, None when closed"""
+    price = float(trade.price)
+    if position is None or position.qty == 0:
+        return Position(
+            strategy=trade.strategy,
+            code=trade.code,
+            action=trade.action,
+            qty=trade.qty,
+            cost_amt=price * trade.qty * LOT_SIZE,
+            avg_prc=price,
+            first_entry_date=trade.trade_date,
+            low_since_entry=price,
+            high_since_entry=price,
+        )
+
+    if trade.action == position.action:
+        qty = position.qty + trade.qty
+        cost_amt = position.cost_amt + price * trade.qty * LOT_SIZE
+        return position.copy(
+            update={
+                "qty": qty,
+                "cost_amt": cost_amt,
+                "avg_prc": cost_amt / (qty * LOT_SIZE),
+                "low_since_entry": min(position.low_since_entry or price, price),
+                "high_since_entry": max(position.high_since_entry or price, price),
+            }
+        )
+
+    qty = position.qty - trade.qty
+    if qty == 0:
+        return None
+    if qty < 0:
+        # reversed, the remaining qty opens a new position
+        return apply_trade_to_position(None, trade.copy(update={"qty": -qty}))
+    return position.copy(
+        update={
+            "qty": qty,
+            "cost_amt": position.avg_prc * qty * LOT_SIZE,
+            "low_since_entry": min(position.low_since_entry or price, price),
+            "high_since_entry": max(position.high_since_entry or price, price),
+        }
+    )
+
 
 class Positions:
+    """
+    Position book of the DB snapshot plus the trades applied since
+
+    a trade applied from the trade callback is kept with its journal offset
+    until the DB snapshot includes it (offset below the persisted offset),
+    it is re-applied on top of every newer snapshot in the meantime
+    """
+
     def __init__(self, tolerance: int = 60):
-        self._data: Dict[int, Dict[str, Position]] = {}
-        self.lock = ReadWriteLock()
+        self._index = PositionIndex.from_data(EMPTY)
+        self.lock = WriteLock("positions")
+        self.version = 0
         self.update_dt: dt.datetime = None
         self.tolerance = tolerance
-
-    def update(self, data: Dict[int, Dict[str, Position]]):
+        # (journal offset, trade) not persisted yet
+        self._pending_trades: List[Tuple[int, Trade]] = []
+
+    def update(
+        self,
+        data: Dict[int, Dict[str, Position]],
+        update_dt: dt.datetime = None,
+        persisted_offset: int = None,
+    ):
         self.lock.acquire_write()
-        self._data.clear()
-        self._data.update(data)
-        self.lock.release_write()
-        self.update_dt = get_tpe_datetime()
+        try:
+            self._drop_persisted_trades(persisted_offset)
+            changed = {strategy_id: dict(d0) for strategy_id, d0 in data.items()}
+            for _, trade in self._pending_trades:
+                self._apply_trade(changed, changed, trade)
+            self._publish({}, changed)
+        finally:
+            self.lock.release_write()
+        self.update_dt = update_dt or clock.now()
+
+    def apply_changes(
+        self,
+        data: Dict[int, Dict[str, Position]],
+        removed: List[Tuple[int, str]] = None,
+        persisted_offset: int = None,
+    ):
+        self.lock.acquire_write()
+        try:
+            self._drop_persisted_trades(persisted_offset)
+            # no trade since the watermark: keep the index and the version
+            if data or removed:
+                self._apply_changes(data, removed or [])
+        finally:
+            self.lock.release_write()
+        self.update_dt = clock.now()
+
+    def _apply_changes(
+        self, data: Dict[int, Dict[str, Position]], removed: List[Tuple[int, str]]
+    ):
+        """apply changes with the write lock held"""
+        # only the changed strategies are copied
+        new_data = dict(self._data)
+        changed = {}
+        keys = set()
+        for strategy_id, d0 in data.items():
+            if strategy_id not in changed:
+                changed[strategy_id] = dict(new_data.get(strategy_id, {}))
+            changed[strategy_id].update(d0)
+            keys.update((strategy_id, code) for code in d0)
+        for strategy_id, code in removed:
+            if strategy_id not in changed and strategy_id in new_data:
+                changed[strategy_id] = dict(new_data[strategy_id])
+            if strategy_id in changed:
+                changed[strategy_id].pop(code, None)
+            keys.add((strategy_id, code))
+        # positions reloaded from the DB miss the trades not persisted yet
+        for _, trade in self._pending_trades:
+            if (trade.strategy, trade.code) in keys:
+                self._apply_trade(new_data, changed, trade)
+        self._publish(new_data, changed)
+
+    def apply_trade(self, trade: Trade, offset: int) -> Optional[Position]:
+        """apply a mapped trade immediately, return the position after it"""
+        self.lock.acquire_write()
+        try:
+            self._pending_trades.append((offset, trade))
+            new_data = dict(self._data)
+            changed = {}
+            position = self._apply_trade(new_data, changed, trade)
+            self._publish(new_data, changed)
+        finally:
+            self.lock.release_write()
+        return position
+
+    def get_pending_trades(self) -> List[Tuple[int, Trade]]:
+        return list(self._pending_trades)
+
+    def _drop_persisted_trades(self, persisted_offset: Optional[int]):
+        if persisted_offset is None:
+            return
+        self._pending_trades = [
+            (offset, trade)
+            for offset, trade in self._pending_trades
+            if offset >= persisted_offset
+        ]
+
+    @staticmethod
+    def _apply_trade(
+        new_data: Dict[int, Mapping[str, Position]],
+        changed: Dict[int, Dict[str, Position]],
+        trade: Trade,
+    ) -> Optional[Position]:
+        if trade.strategy not in changed:
+            changed[trade.strategy] = dict(new_data.get(trade.strategy, {}))
+        d0 = changed[trade.strategy]
+        position = apply_trade_to_position(d0.get(trade.code), trade)
+        if position is None:
+            d0.pop(trade.code, None)
+        else:
+            d0[trade.code] = position
+        return position
+
+    def _publish(
+        self,
+        new_data: Dict[int, Mapping[str, Position]],
+        changed: Dict[int, Dict[str, Position]],
+    ):
+        """publish with the write lock held, nothing if no position changed"""
+        for strategy_id, d0 in changed.items():
+            if d0:
+                new_data[strategy_id] = freeze(d0)
+            else:
+                new_data.pop(strategy_id, None)
+        if new_data == self._data:
+            return
+        self._index = PositionIndex.from_data(freeze(new_data))
+        self.version += 1
+
+    @property
+    def _data(self) -> Mapping[int, Mapping[str, Position]]:
+        return self._index.data
+
+    def touch(self):
+        """mark as up to date without reloading, e.g. no change notified"""
+        self.update_dt = clock.now()
 
     def _check_updated(self):
         if (
             self.update_dt is None
-            or (get_tpe_datetime() - self.update_dt).seconds > self.tolerance
+            or (clock.now() - self.update_dt).seconds > self.tolerance
         ):
             raise Exception(
                 f"positions outdated, previous update time: {self.update_dt}"
@@ -141,97 +572,101 @@ class Positions:
     def check_updated(self) -> bool:
         if (
             self.update_dt is None
-            or (get_tpe_datetime() - self.update_dt).seconds > self.tolerance
+            or (clock.now() - self.update_dt).seconds > self.tolerance
         ):
             return False
         return True
 
-    def get_position_codes(self) -> List[str]:
-        codes = []
-        try:
-            self.lock.acquire_read()
-            for strategy_id in self._data:
-                codes.extend(list(self._data[strategy_id]))
-        finally:
-            self.lock.release_read()
-        return codes
+    def get_position_codes(self) -> Tuple[str, ...]:
+        """distinct codes held by any strategy"""
+        return self._index.codes
 
-    def get_position_strategy_codes(self) -> List[Tuple[int, str]]:
-        data = [
-            (strategy_id, code) for strategy_id, d0 in self._data.items() for code in d0
-        ]
-        return data
+    def get_code_strategies(self, code: str) -> Tuple[int, ...]:
+        return self._index.code_strategies.get(code, ())
+
+    def get_position_strategy_codes(self) -> Tuple[Tuple[int, str], ...]:
+        return self._index.strategy_codes
 
     def exists(self, strategy_id: int, code: str) -> bool:
         self._check_updated()
-        if strategy_id in self._data:
-            if code in self._data[strategy_id]:
-                return True
-        return False
+        return code in self._data.get(strategy_id, EMPTY)
 
     def get_position(self, strategy_id: int, code: str) -> Position:
         self._check_updated()
-        if strategy_id in self._data:
-            if code in self._data[strategy_id]:
-                return self._data[strategy_id][code]
+        position = self._data.get(strategy_id, EMPTY).get(code)
+        if position is not None:
+            return position
 
         raise Exception(f"cannot find position: {strategy_id}, {code}")
 
 
 class Contracts:
     def __init__(self):
-        self._data: Dict[str, Contract] = {}
-        self.lock = ReadWriteLock()
+        self._data: Mapping[str, Contract] = EMPTY
+        self.lock = WriteLock("contracts")
+        self.version = 0
         self.update_dt: dt.datetime = None
 
-    def update(self, data: Dict[int, Contract]):
+    def update(self, data: Dict[int, Contract], update_dt: dt.datetime = None):
+        data = freeze(data)
+        self.lock.acquire_write()
+        try:
+            self._data = data
+            self.version += 1
+        finally:
+            self.lock.release_write()
+        self.update_dt = update_dt or clock.now()
+
+    def apply_changes(self, data: Dict[str, Contract]):
         self.lock.acquire_write()
-        self._data.clear()
-        self._data.update(data)
-        self.lock.release_write()
-        self.update_dt = get_tpe_datetime()
+        try:
+            self._data = freeze({**self._data, **data})
+            self.version += 1
+        finally:
+            self.lock.release_write()
+        self.update_dt = clock.now()
 
     def _check_updated(self, code: str):
         if not self.check_updated([code]):
             raise Exception(f"contract outdated: {code}")
 
     def check_updated(self, codes: List[str] = ["0050", "2330", "2317"]) -> bool:
-        result = True
-        try:
-            self.lock.acquire_read()
-            for code in codes:
-                if code in self._data:
-                    if self._data[code].update_date != get_tpe_datetime().date():
-                        if Config.DEBUG:
-                            result = True
-                        else:
-                            result = False
-        finally:
-            self.lock.release_read()
-        return result
+        if Config.DEBUG:
+            return True
+        data = self._data
+        today = clock.now().date()
+        for code in codes:
+            if code in data and data[code].update_date != today:
+                return False
+        return True
 
     def exists(self, code: str) -> bool:
         return code in self._data
 
     def get_contract(self, code: str) -> Contract:
         self._check_updated(code)
-        if code in self._data:
-            return self._data[code]
+        contract = self._data.get(code)
+        if contract is not None:
+            return contract
         raise Exception(f"cannot find contract: {code}")
 
 
 class ComingDividends:
     def __init__(self):
-        self._data: Dict[str, ComingDividend] = {}
-        self.lock = ReadWriteLock()
+        self._data: Mapping[str, ComingDividend] = EMPTY
+        self.lock = WriteLock("coming_dividends")
+        self.version = 0
         self.update_dt: dt.datetime = None
 
-    def update(self, data: Dict[int, ComingDividend]):
+    def update(self, data: Dict[int, ComingDividend], update_dt: dt.datetime = None):
+        data = freeze(data)
         self.lock.acquire_write()
-        self._data.clear()
-        self._data.update(data)
-        self.lock.release_write()
-        self.update_dt = get_tpe_datetime()
+        try:
+            self._data = data
+            self.version += 1
+        finally:
+            self.lock.release_write()
+        self.update_dt = update_dt or clock.now()
 
     def _check_updated(self):
         if not self.check_updated():
@@ -240,9 +675,7 @@ class ComingDividends:
             )
 
     def check_updated(self) -> bool:
-        if self.update_dt is None or (
-            get_tpe_datetime().date() != self.update_dt.date()
-        ):
+        if self.update_dt is None or (clock.now().date() != self.update_dt.date()):
             return False
         return True
 
@@ -251,30 +684,52 @@ class ComingDividends:
 
     def get_coming_dividend(self, code: str) -> ComingDividend:
         self._check_updated()
-        if code in self._data:
-            return self._data[code]
+        coming_dividend = self._data.get(code)
+        if coming_dividend is not None:
+            return coming_dividend
         raise Exception(f"cannot find coming_dividend: {code}")
 
 
+class TradingCalendar(NamedTuple):
+    """trading dates in order, date -> ordinal and the read-only datetime64 array"""
+
+    dates: Tuple[dt.date, ...]
+    ordinals: Mapping[dt.date, int]
+    days: np.ndarray
+
+    @classmethod
+    def from_dates(cls, dates: List[dt.date]) -> "TradingCalendar":
+        dates = tuple(dates)
+        days = np.array(dates, dtype="datetime64[D]")
+        days.setflags(write=False)
+        return cls(dates, freeze({x: k for k, x in enumerate(dates)}), days)
+
+
 class TradingDates:
     def __init__(self):
-        self._data: List[dt.date] = []
-        self.lock = ReadWriteLock()
+        self._calendar = TradingCalendar.from_dates([])
+        self.lock = WriteLock("trading_dates")
+        self.version = 0
         self.update_dt: dt.datetime = None
         self.today = None
         self._is_trading_date = False
 
-    def update(self, data: List[dt.date]):
+    @property
+    def _data(self) -> Tuple[dt.date, ...]:
+        return self._calendar.dates
+
+    def update(self, data: List[dt.date], update_dt: dt.datetime = None):
+        calendar = TradingCalendar.from_dates(data)
+        update_dt = update_dt or clock.now()
         self.lock.acquire_write()
-        self._data.clear()
-        self._data.extend(data)
-        self.lock.release_write()
-        self.update_dt = get_tpe_datetime()
-        self.today = self.update_dt.date()
-        if self.today in self._data:
-            self._is_trading_date = True
-        else:
-            self._is_trading_date = False
+        try:
+            self._calendar = calendar
+            self.version += 1
+        finally:
+            self.lock.release_write()
+        self.update_dt = update_dt
+        self.today = update_dt.date()
+        self._is_trading_date = self.today in calendar.ordinals
 
     def is_trading_date(self) -> bool:
         if Config.DEBUG:
@@ -289,9 +744,7 @@ class TradingDates:
             )
 
     def check_updated(self) -> bool:
-        if self.update_dt is None or (
-            get_tpe_datetime().date() != self.update_dt.date()
-        ):
+        if self.update_dt is None or (clock.now().date() != self.update_dt.date()):
             return False
         return True
 
@@ -304,20 +757,40 @@ class TradingDates:
         else:
             tdate = self.today
 
-        self.lock.acquire_read()
-        target_date: dt.date = None
-        if tdate in self._data:
-            idx = self._data.index(tdate)
-            if idx + days < len(self._data):
-                target_date = self._data[idx + days]
-        self.lock.release_read()
+        calendar = self._calendar
+        idx = calendar.ordinals.get(tdate)
+        if idx is None and Config.DEBUG:
+            # roll back to the previous trading date
+            idx = bisect.bisect_right(calendar.dates, tdate) - 1
+        if idx is None or idx < 0 or not 0 <= idx + days < len(calendar.dates):
+            raise Exception(f"{tdate} not in trading dates or days out of range")
 
-        if target_date is None:
-            if Config.DEBUG:
-                return self.get_next_n_trading_date(
-                    tdate - dt.timedelta(days=1), days=days
-                )
+        return calendar.dates[idx + days]
 
-            raise Exception(f"{tdate} not in trading dates or days out of range")
+    def get_next_n_trading_dates(self, bench_dates, days) -> np.ndarray:
+        """
+        vectorised get_next_n_trading_date over arrays of dates and/or days,
+        NaT where the date is not a trading date or the offset is out of range
 
-        return target_date
+        bench_dates: array-like of dates (datetime64[D] compatible)
+        days: int or array-like of int, broadcast against bench_dates
+        """
+        self._check_updated()
+        calendar = self._calendar
+        bench = np.asarray(bench_dates, dtype="datetime64[D]")
+        idx = np.searchsorted(calendar.days, bench, side="right") - 1
+        idx, days = np.broadcast_arrays(idx, np.asarray(days, dtype=np.int64))
+        out = np.full(idx.shape, np.datetime64("NaT"), dtype="datetime64[D]")
+        if not len(calendar.days):
+            return out
+
+        valid = idx >= 0
+        if not Config.DEBUG:
+            # in DEBUG non trading dates roll back as get_next_n_trading_date
+            valid &= calendar.days[np.clip(idx, 0, None)] == np.broadcast_to(
+                bench, idx.shape
+            )
+        target = idx + days
+        valid &= (target >= 0) & (target < len(calendar.days))
+        out[valid] = calendar.days[target[valid]]
+        return out
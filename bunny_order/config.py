@@ -23,6 +23,21 @@ class BaseConfig:
     DB_USER = os.environ.get("DB_USER")
     DB_PASSWORD = os.environ.get("DB_PASSWORD")
     DB_DATABASE = config_yaml["database"]["database"]
+    DB_STREAM_BATCH_SIZE = int(config_yaml["database"]["stream_batch_size"])
+    DB_SLOW_QUERY_MS = float(config_yaml["database"]["slow_query_ms"])
+    DB_BREAKER_FAILURE_THRESHOLD = int(
+        config_yaml["database"]["breaker_failure_threshold"]
+    )
+    DB_RECONNECT_BACKOFF_INITIAL = float(
+        config_yaml["database"]["reconnect_backoff_initial"]
+    )
+    DB_RECONNECT_BACKOFF_MAX = float(config_yaml["database"]["reconnect_backoff_max"])
+    DB_MAX_PENDING_WRITES = int(config_yaml["database"]["max_pending_writes"])
+    DB_RETRY_INTERVAL = float(config_yaml["database"]["retry_interval"])
+    DB_CANCEL_GRACE_MS = float(config_yaml["database"]["cancel_grace_ms"])
+    DB_TIMEOUTS = {
+        key: float(val) for key, val in config_yaml["database"]["timeouts"].items()
+    }
     # observer
     OBSERVER_BASE_PATH = config_yaml["observer"]["base_path"]
     OBSERVER_SF31_ORDERS_DIR = config_yaml["observer"]["sf31_orders_dir"]
@@ -87,11 +102,44 @@ class BaseConfig:
         minute=int(config_yaml["engine"]["signal_end_time"][2:4]),
         second=0,
     )
+    FULL_SYNC_INTERVAL = int(config_yaml["engine"]["full_sync_interval"])
+    POSITION_SYNC_LOOKBACK = int(config_yaml["engine"]["position_sync_lookback"])
+    TRADING_CALENDAR_LOOKBACK_MONTHS = int(
+        config_yaml["engine"]["trading_calendar_lookback_months"]
+    )
+    TRADING_CALENDAR_LOOKAHEAD_MONTHS = int(
+        config_yaml["engine"]["trading_calendar_lookahead_months"]
+    )
+    CLOCK_RESOLUTION = float(config_yaml["engine"]["clock_resolution"])
+    SNAPSHOT_CAPACITY = int(config_yaml["engine"]["snapshot_capacity"])
+    # listener
+    LISTENER_STRATEGY_CHANNEL = config_yaml["listener"]["strategy_channel"]
+    LISTENER_POSITIONS_CHANNEL = config_yaml["listener"]["positions_channel"]
+    LISTENER_CONTRACTS_CHANNEL = config_yaml["listener"]["contracts_channel"]
+    LISTENER_FALLBACK_SYNC_INTERVAL = int(
+        config_yaml["listener"]["fallback_sync_interval"]
+    )
     # exit handler
     QUOTE_DELAY_TOLERANCE = int(config_yaml["exit_handler"]["quote_delay_tolerance"])
+    EXIT_REJECT_COOLDOWN = float(config_yaml["exit_handler"]["reject_cooldown"])
+    EXIT_WORKERS = int(config_yaml["exit_handler"]["workers"])
+    EXIT_WORKER_TIMEOUT = float(config_yaml["exit_handler"]["worker_timeout"])
+    EXIT_WORKER_RESTART_INTERVAL = float(
+        config_yaml["exit_handler"]["worker_restart_interval"]
+    )
     CHECKPOINTS_DIR = config_yaml["common"]["checkpoints_dir"]
+    CACHE_DIR = config_yaml["common"]["cache_dir"]
+    LOCK_TIMEOUT = float(config_yaml["common"]["lock_timeout"])
     # order manager
     OM_DAILY_AMOUNT_LIMIT = config_yaml["order_manager"]["daily_amount_limit"]
+    # journal
+    JOURNAL_DIR = config_yaml["journal"]["journal_dir"]
+    JOURNAL_SEGMENT_SIZE = int(config_yaml["journal"]["segment_size"])
+    JOURNAL_FSYNC_INTERVAL = float(config_yaml["journal"]["fsync_interval"])
+    JOURNAL_FSYNC_BATCH = int(config_yaml["journal"]["fsync_batch"])
+    JOURNAL_CONSUMER_BATCH_SIZE = int(config_yaml["journal"]["consumer_batch_size"])
+    JOURNAL_CONSUMER_MAX_RETRIES = int(config_yaml["journal"]["consumer_max_retries"])
+    JOURNAL_RETENTION_DAYS = int(config_yaml["journal"]["retention_days"])
     # loguru
     LOGURU_SINK_DIR = config_yaml["loguru"]["sink_dir"]
     LOGURU_SINK_FILE = config_yaml["loguru"]["sink_file"]
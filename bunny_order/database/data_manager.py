@@ -1,5 +1,10 @@
+import time
 import datetime as dt
-from typing import Dict, List
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+import numpy as np
 import pandas as pd
 from loguru import logger
 from decimal import Decimal
@@ -13,13 +18,103 @@ from bunny_order.models import (
     SF31Position,
     Position,
     QuoteSnapshot,
+    QUOTE_SNAPSHOT_DTYPES,
     Contract,
     ComingDividend,
 )
 from bunny_order.database.tsdb_client import TSDBClient
+from bunny_order.errors import DatabaseUnavailable, QueryTimeout
 from bunny_order.config import Config
+from bunny_order.clock import clock
 from bunny_order.utils import get_tpe_datetime
 
+# columns an sf31 order is matched on in dealer.sf31_orders
+SF31_ORDER_KEYS = [
+    "signal_id",
+    "strategy_id",
+    "sfdate",
+    "sftime",
+    "code",
+    "price",
+    "quantity",
+    "action",
+]
+
+
+def profiled(func):
+    """
+    attribute the DB time of func to its name in the query profiler and apply
+    the timeout budget of func
+    """
+
+    @wraps(func)
+    def inner(self: "DataManager", *args, **kwargs):
+        with self.call_site(func.__name__):
+            return func(self, *args, **kwargs)
+
+    return inner
+
+
+def fallback_read(default: Callable[[], Any] = None):
+    """
+    serve the last result of func while the database is unavailable or the
+    query timed out, incremental reads return `default()` (no changes) instead
+
+    the time the served result was read is kept for get_read_dt, a cached
+    result keeps its original read time and `default()` has none
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def inner(self: "DataManager", *args, **kwargs):
+            try:
+                result = func(self, *args, **kwargs)
+            except (DatabaseUnavailable, QueryTimeout):
+                if default is not None:
+                    self._read_dts[func.__name__] = None
+                    return default()
+                if func.__name__ in self._last_reads:
+                    return self._last_reads[func.__name__]
+                raise
+            self._read_dts[func.__name__] = clock.now()
+            if default is None:
+                self._last_reads[func.__name__] = result
+            return result
+
+        return inner
+
+    return decorator
+
+
+def buffered_write(func):
+    """
+    buffer func for replay while the database is unavailable or the write timed
+    out, writes are queued behind pending ones to keep their order
+    """
+
+    @wraps(func)
+    def inner(self: "DataManager", *args, **kwargs):
+        if not self.pending_writes:
+            try:
+                return func(self, *args, **kwargs)
+            except (DatabaseUnavailable, QueryTimeout):
+                pass
+        if len(self.pending_writes) == self.pending_writes.maxlen:
+            dropped, _, _ = self.pending_writes[0]
+            logger.error(f"pending writes full | drop: {dropped.__name__}")
+        self.pending_writes.append((func, args, kwargs))
+        logger.warning(
+            f"buffer write: {func.__name__} | pending: {len(self.pending_writes)}"
+        )
+
+    return inner
+
+
+def empty_quote_snapshot_columns() -> Dict[str, np.ndarray]:
+    return {
+        col: np.empty(0, dtype=dtype) for col, dtype in QUOTE_SNAPSHOT_DTYPES.items()
+    }
+
 
 class DataManager:
     def __init__(self, verbose: bool = False):
@@ -29,9 +124,69 @@ class DataManager:
             user=Config.DB_USER,
             password=Config.DB_PASSWORD,
             db=Config.DB_DATABASE,
+            stream_batch_size=Config.DB_STREAM_BATCH_SIZE,
+            slow_query_ms=Config.DB_SLOW_QUERY_MS,
+            breaker_failure_threshold=Config.DB_BREAKER_FAILURE_THRESHOLD,
+            reconnect_backoff_initial=Config.DB_RECONNECT_BACKOFF_INITIAL,
+            reconnect_backoff_max=Config.DB_RECONNECT_BACKOFF_MAX,
+            cancel_grace_ms=Config.DB_CANCEL_GRACE_MS,
         )
         self.verbose = verbose
         self.simulation = Config.DEBUG
+        # method name -> last result, served while the database is unavailable
+        self._last_reads: Dict[str, Any] = {}
+        # method name -> read time of the result served last
+        self._read_dts: Dict[str, Optional[dt.datetime]] = {}
+        self.pending_writes: Deque[Tuple[Callable, tuple, dict]] = deque(
+            maxlen=Config.DB_MAX_PENDING_WRITES
+        )
+        self.retry_interval = Config.DB_RETRY_INTERVAL
+        self._next_replay_ts = 0.0
+
+    def is_degraded(self) -> bool:
+        return self.cli.breaker_open
+
+    def get_read_dt(self, name: str) -> Optional[dt.datetime]:
+        """
+        read time of the result served by the last call of method `name`, None
+        if no changes were served instead
+        """
+        return self._read_dts.get(name)
+
+    @contextmanager
+    def call_site(self, name: str):
+        timeout_ms = Config.DB_TIMEOUTS.get(name, Config.DB_TIMEOUTS["default"])
+        with self.cli.profiler.caller(name), self.cli.timeout(timeout_ms):
+            yield
+
+    def replay_writes(self) -> int:
+        """
+        replay buffered writes in order, stop at the first unavailable or timeout
+        error and retry after `retry_interval` seconds
+        """
+        if time.time() < self._next_replay_ts:
+            return 0
+        n_replayed = 0
+        while self.pending_writes and not self.is_degraded():
+            func, args, kwargs = self.pending_writes[0]
+            try:
+                with self.call_site(func.__name__):
+                    func(self, *args, **kwargs)
+            except (DatabaseUnavailable, QueryTimeout):
+                self._next_replay_ts = time.time() + self.retry_interval
+                break
+            except Exception as e:
+                logger.exception(e)
+            self.pending_writes.popleft()
+            n_replayed += 1
+        if n_replayed:
+            logger.info(
+                f"replay writes: {n_replayed} | pending: {len(self.pending_writes)}"
+            )
+        return n_replayed
+
+    def dump_profile(self):
+        self.cli.profiler.dump(Config.CHECKPOINTS_DIR)
 
     def convert_condition_to_sql_string(
         self, conditions: dict, sep: str = "and"
@@ -52,7 +207,7 @@ class DataManager:
                 sql = f"{key}='{val.strftime('%Y-%m-%d')}'"
             elif isinstance(val, dt.time):
                 sql = f"{key}='{val.strftime('%H:%M:%S.%f')}'"
-            elif isinstance(val, list):
+            elif isinstance(val, (list, tuple)):
                 if val:
                     if isinstance(val[0], str):
                         sql = f"""{key} in ( {",".join([f"'{x}'" for x in val])} ) """
@@ -203,10 +358,14 @@ class DataManager:
         elif isinstance(result, str) and "Error" in result:
             raise Exception(f"save {table} | failed", result)
 
+    @profiled
+    @fallback_read()
     def get_strategies(self) -> Dict[int, Strategy]:
         data = self.cli.execute_query("select * from dealer.strategy", "dict")
         return {x["id"]: Strategy(**x, update_dt=get_tpe_datetime()) for x in data}
 
+    @profiled
+    @buffered_write
     def save_signal(self, signal: Signal):
         self.save_one(
             table="dealer.signals",
@@ -218,22 +377,65 @@ class DataManager:
             },
         )
 
+    @profiled
     def update_sf31_order(self, order: SF31Order):
-        self.update(
-            table="dealer.sf31_orders",
-            uppdate_data={"order_id": order.order_id},
-            conditions={
-                "signal_id": order.signal_id,
-                "strategy_id": order.strategy_id,
-                "sfdate": order.sfdate,
-                "sftime": order.sftime,
-                "code": order.code,
-                "price": order.price,
-                "quantity": order.quantity,
-                "action": order.action,
-            },
+        self.update_sf31_order_ids([order])
+
+    @profiled
+    @buffered_write
+    def update_sf31_order_ids(self, orders: List[SF31Order]):
+        """
+        map order_id of sf31 orders in one statement, keyed on the columns
+        save_sf31_order deduplicates on and the action, raise when an sf31
+        order is not found so the mapping is retried
+        """
+        if self.simulation:
+            return
+        if not orders:
+            return
+        values = ",".join(
+            [
+                f"""('{order.signal_id}', {order.strategy_id}, """
+                f"""'{order.sfdate.strftime('%Y-%m-%d')}'::date, """
+                f"""'{order.sftime.strftime('%H:%M:%S.%f')}'::time, """
+                f"""'{order.code}', {order.price}::numeric, {order.quantity}, """
+                f"""'{order.action.value}', '{order.order_id}')"""
+                for order in orders
+            ]
         )
+        columns = ", ".join(SF31_ORDER_KEYS + ["order_id"])
+        matched = " and ".join([f"o.{col} = v.{col}" for col in SF31_ORDER_KEYS])
+        result = self.cli.execute_query(
+            f"""update dealer.sf31_orders as o
+            set order_id = v.order_id
+            from ( values {values} ) as v({columns})
+            where {matched}
+            """
+        )
+        if isinstance(result, int) and result == 1:
+            raise Exception("save dealer.sf31_orders | failed")
+        keys = {
+            tuple(getattr(order, col) for col in SF31_ORDER_KEYS) for order in orders
+        }
+        if self.cli.last_rowcount < len(keys):
+            # not inserted yet, its save is pending or dead-lettered
+            rows = self.cli.execute_query(
+                f"""select v.signal_id, v.strategy_id, v.sfdate, v.code
+                from ( values {values} ) as v({columns})
+                where not exists (
+                    select 1 from dealer.sf31_orders as o where {matched}
+                )
+                """
+            )
+            if isinstance(rows, int) and rows == 1:
+                raise Exception("query dealer.sf31_orders | failed")
+            if rows:
+                raise Exception(
+                    f"map order_id | sf31_orders not found: {[tuple(x) for x in rows]}"
+                )
 
+    @profiled
+    @buffered_write
     def save_sf31_order(self, order: SF31Order):
         self.save_one(
             table="dealer.sf31_orders",
@@ -250,6 +452,8 @@ class DataManager:
             },
         )
 
+    @profiled
+    @buffered_write
     def save_order(self, order: Order):
         if order.order_id == "00000":
             self.save_one(table="dealer.orders", data=order.dict(), method="direct")
@@ -264,6 +468,8 @@ class DataManager:
                 },
             )
 
+    @profiled
+    @buffered_write
     def save_trade(self, trade: Trade):
         self.save_one(
             table="dealer.trades",
@@ -276,6 +482,8 @@ class DataManager:
             },
         )
 
+    @profiled
+    @buffered_write
     def save_positions(self, positions: List[SF31Position]):
         df = pd.DataFrame([pos.dict() for pos in positions])
         self.save(
@@ -285,20 +493,80 @@ class DataManager:
             conflict_cols=["code"],
         )
 
+    @profiled
+    @fallback_read()
     def get_positions(self) -> Dict[int, Dict[str, Position]]:
-        data = self.cli.execute_query(
-            """select * from dealer.ft_get_positions_order_manager();""",
+        """positions without high / low since entry, see get_position_extremes"""
+        d = {}
+        for row in self.cli.stream_query(
+            """select * from dealer.ft_get_positions_order_manager_lite();"""
+        ):
+            if row["strategy"] not in d:
+                d[row["strategy"]] = {}
+            d[row["strategy"]][row["code"]] = Position(
+                **row, update_dt=get_tpe_datetime()
+            )
+        return d
+
+    @profiled
+    @fallback_read(default=lambda: ({}, []))
+    def get_position_changes(
+        self, since: dt.datetime
+    ) -> Tuple[Dict[int, Dict[str, Position]], List[Tuple[int, str]]]:
+        """
+        positions of (strategy, code) traded after `since`
+        return (changed positions, removed (strategy, code))
+
+        keyed on trades only: fields computed by the database without a trade
+        are refreshed by the full sync, up to `full_sync_interval` later, high /
+        low since entry are left out as in get_positions
+        """
+        keys = self.cli.execute_query(
+            f"""select distinct strategy, code
+            from dealer.trades
+            where trade_date + trade_time > '{since.strftime('%Y-%m-%d %H:%M:%S')}';
+            """,
             "dict",
         )
+        if not keys:
+            return {}, []
+
+        values = ",".join([f"({x['strategy']}, '{x['code']}')" for x in keys])
         d = {}
-        for row in data:
+        for row in self.cli.stream_query(
+            f"""select *
+            from dealer.ft_get_positions_order_manager_lite()
+            where (strategy, code) in ( values {values} );
+            """
+        ):
             if row["strategy"] not in d:
                 d[row["strategy"]] = {}
             d[row["strategy"]][row["code"]] = Position(
                 **row, update_dt=get_tpe_datetime()
             )
-        return d
+        removed = [
+            (x["strategy"], x["code"])
+            for x in keys
+            if x["code"] not in d.get(x["strategy"], {})
+        ]
+        return d, removed
+
+    @profiled
+    @fallback_read(default=list)
+    def get_position_extremes(self) -> List[Position]:
+        """
+        positions with high / low since entry, aggregated by the database from
+        the quotes since entry, read once a day to seed EntryExtremes
+        """
+        return [
+            Position(**row)
+            for row in self.cli.stream_query(
+                """select * from dealer.ft_get_positions_order_manager();"""
+            )
+        ]
 
+    @profiled
+    @fallback_read()
     def get_quote_snapshots(self, codes: List[str]) -> Dict[str, QuoteSnapshot]:
         cond = self.convert_condition_to_sql_string({"code": codes})
         data = self.cli.execute_query(
@@ -316,19 +584,75 @@ class DataManager:
             d[row["code"]] = QuoteSnapshot(**row)
         return d
 
+    @profiled
+    def get_quote_snapshot_columns(self, codes: List[str]) -> Dict[str, np.ndarray]:
+        return self.get_quote_snapshot_changes(codes, watermarks={})
+
+    @profiled
+    @fallback_read(default=empty_quote_snapshot_columns)
+    def get_quote_snapshot_changes(
+        self, codes: List[str], watermarks: Dict[str, dt.datetime]
+    ) -> Dict[str, np.ndarray]:
+        """
+        quote snapshots of `codes` newer than the watermark (last seen dt) of each code,
+        codes without watermark are always fetched
+        """
+        if not codes:
+            return empty_quote_snapshot_columns()
+        cond = self.convert_condition_to_sql_string({"q.code": codes})
+        values = ",".join(
+            [
+                f"('{code}', '{watermarks[code].strftime('%Y-%m-%d %H:%M:%S.%f')}'::timestamp)"
+                for code in codes
+                if code in watermarks
+            ]
+        )
+        if values:
+            watermark_sql = f"""left join ( values {values} ) as w(code, dt)
+                on q.code = w.code"""
+            cond = f"{cond} and (w.dt is null or q.dt > w.dt)"
+        else:
+            watermark_sql = ""
+        return self.cli.execute_query(
+            f"""select {", ".join([f"q.{x}" for x in QUOTE_SNAPSHOT_DTYPES])}
+            from public.quote_snapshots q
+            {watermark_sql}
+            where {cond}
+            order by q.dt
+            """,
+            "columns",
+            dtypes=QUOTE_SNAPSHOT_DTYPES,
+        )
+
+    @profiled
+    @fallback_read()
     def get_contracts(self) -> None:
-        data = self.cli.execute_query(
+        d = {}
+        for row in self.cli.stream_query(
             f"""select code, name, reference, limit_up, limit_down, update_date
             from sino.contracts 
             where length(code) = 4 and security_type='STK';
-            """,
-            "dict",
-        )
+            """
+        ):
+            d[row["code"]] = Contract(**row)
+        return d
+
+    @profiled
+    @fallback_read(default=dict)
+    def get_contract_changes(self, since: dt.date) -> Dict[str, Contract]:
         d = {}
-        for row in data:
+        for row in self.cli.stream_query(
+            f"""select code, name, reference, limit_up, limit_down, update_date
+            from sino.contracts 
+            where length(code) = 4 and security_type='STK'
+                and update_date >= '{since.strftime('%Y-%m-%d')}';
+            """
+        ):
             d[row["code"]] = Contract(**row)
         return d
 
+    @profiled
+    @fallback_read()
     def get_coming_dividends(self) -> Dict[str, ComingDividend]:
         data = self.cli.execute_query(
             """select code, ex_date from cmoney.v_coming_dividends;""",
@@ -339,14 +663,16 @@ class DataManager:
             d[row["code"]] = ComingDividend(**row)
         return d
 
+    @profiled
+    @fallback_read()
     def get_near_trading_dates(self) -> List[dt.date]:
         df = self.cli.execute_query(
-            """
+            f"""
             select tdate 
             from cmoney.calendar
             where exchange='TWSE'
-                and tdate >= CURRENT_DATE - INTERVAL '6 month'
-                and tdate < CURRENT_DATE + INTERVAL '6 month'
+                and tdate >= CURRENT_DATE - INTERVAL '{Config.TRADING_CALENDAR_LOOKBACK_MONTHS} month'
+                and tdate < CURRENT_DATE + INTERVAL '{Config.TRADING_CALENDAR_LOOKAHEAD_MONTHS} month'
                 and is_trading_date
             order by tdate;
             """,
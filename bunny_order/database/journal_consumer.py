@@ -0,0 +1,162 @@
+import json
+import time
+import threading
+from typing import List
+
+from bunny_order.database.data_manager import DataManager
+from bunny_order.journal import Journal, JournalCheckpoint, Record, encode_payload
+from bunny_order.models import Event
+from bunny_order.config import Config
+from bunny_order.utils import logger
+
+
+class JournalConsumer:
+    """
+    Persist journal records to Postgres from a checkpointed offset
+
+    writes are idempotent (if_not_exists / upsert / order_id mapping), so records
+    between the last checkpoint and a crash can be applied twice safely
+    """
+
+    def __init__(
+        self,
+        journal: Journal,
+        active_event: threading.Event = None,
+        checkpoint_path: str = f"{Config.JOURNAL_DIR}/db_consumer.offset",
+        dead_letter_path: str = f"{Config.JOURNAL_DIR}/db_consumer.dead_letter",
+        batch_size: int = Config.JOURNAL_CONSUMER_BATCH_SIZE,
+        max_retries: int = Config.JOURNAL_CONSUMER_MAX_RETRIES,
+    ):
+        self.journal = journal
+        self.active_event = active_event or threading.Event()
+        self.checkpoint = JournalCheckpoint(checkpoint_path)
+        self.dead_letter_path = dead_letter_path
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.dm = DataManager()
+        self.offset = self.checkpoint.load()
+        # records below are in the DB
+        self.persisted_offset = self.offset
+        # failed attempts of the record at `offset`
+        self._failures = 0
+        self._next_retry_ts = 0.0
+
+    def seek(self, offset: int):
+        """catch up from any offset"""
+        self.offset = offset
+        self.persisted_offset = offset
+        self._failures = 0
+        self.checkpoint.save(offset)
+
+    def consume(self) -> int:
+        """persist a batch of records, return the number of records consumed"""
+        if self.dm.is_degraded() or time.time() < self._next_retry_ts:
+            return 0
+        self.dm.replay_writes()
+        if self.dm.pending_writes:
+            return 0
+
+        records = self.journal.read(self.offset, max_records=self.batch_size)
+        n_consumed = 0
+        while n_consumed < len(records):
+            # consecutive mappings in one bulk update
+            batch = records[n_consumed : n_consumed + 1]
+            if batch[0].event == Event.OrderMapping:
+                for record in records[n_consumed + 1 :]:
+                    if record.event != Event.OrderMapping:
+                        break
+                    batch.append(record)
+            n_persisted = self.persist(batch)
+            n_consumed += n_persisted
+            if n_persisted < len(batch):
+                # retry the failing record first
+                break
+        if not n_consumed:
+            return 0
+
+        self.offset = records[n_consumed - 1].next_offset
+        # buffered writes are lost on a crash, resume from the last checkpoint
+        if not self.dm.pending_writes:
+            self.checkpoint.save(self.offset)
+            self.persisted_offset = self.offset
+        return n_consumed
+
+    def persist(self, records: List[Record]) -> int:
+        """
+        persist records in order, return the number of records persisted or
+        moved to the dead-letter file, a record failing `max_retries` times is
+        moved there
+        """
+        try:
+            self._persist(records)
+            self._failures = 0
+            return len(records)
+        except Exception as e:
+            if len(records) > 1:
+                logger.warning(
+                    f"cannot persist order mappings in bulk | size: {len(records)}"
+                )
+                # isolate the failing mapping
+                for k, record in enumerate(records):
+                    if not self.persist([record]):
+                        return k
+                return len(records)
+            self._failures += 1
+            logger.error(
+                f"cannot persist journal record | offset: {records[0].offset}, "
+                f"attempts: {self._failures}"
+            )
+            logger.exception(e)
+            if self._failures < self.max_retries:
+                self._next_retry_ts = time.time() + self.dm.retry_interval
+                return 0
+            self.dead_letter(records[0], e)
+            self._failures = 0
+            return 1
+
+    def dead_letter(self, record: Record, error: Exception):
+        """keep a record that cannot be persisted for manual replay"""
+        line = json.dumps(
+            {
+                "offset": record.offset,
+                "ts": record.ts,
+                "event": record.event.name,
+                "data": json.loads(encode_payload(record.data)),
+                "error": repr(error),
+            },
+            ensure_ascii=False,
+        )
+        with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+            f.write(f"{line}\n")
+        logger.error(
+            f"move journal record to dead letter | offset: {record.offset}, "
+            f"path: {self.dead_letter_path}"
+        )
+
+    def _persist(self, records: List[Record]):
+        record = records[0]
+        if record.event == Event.OrderMapping:
+            self.dm.update_sf31_order_ids([x.data for x in records])
+        elif record.event == Event.Signal:
+            self.dm.save_signal(record.data)
+        elif record.event == Event.SF31Order:
+            self.dm.save_sf31_order(record.data)
+        elif record.event == Event.OrderCallback:
+            self.dm.save_order(record.data)
+        elif record.event == Event.TradeCallback:
+            self.dm.save_trade(record.data)
+        elif record.event == Event.PositionsCallback:
+            self.dm.save_positions(record.data)
+        else:
+            logger.warning(f"Invalid event: {record.event}")
+
+    def run(self):
+        logger.info(f"Start Journal Consumer | offset: {self.offset}")
+        while not self.active_event.is_set():
+            try:
+                if self.consume():
+                    continue
+            except Exception as e:
+                logger.exception(e)
+            time.sleep(0.1)
+        logger.info("Shutdown Journal Consumer")
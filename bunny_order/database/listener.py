@@ -0,0 +1,137 @@
+import json
+import select
+import threading
+import time
+from collections import defaultdict, deque
+from typing import DefaultDict, Deque, List, Set, Tuple
+import psycopg2
+import psycopg2.extensions
+
+from bunny_order.utils import logger
+
+
+class TSDBListener:
+    """
+    LISTEN to postgres NOTIFY channels in a dedicated connection
+
+    notifications are queued as (channel, payload, received_ts), a channel is
+    only pushed if its trigger (sql/notify_triggers.sql) is installed, checked
+    on every connect
+    """
+
+    RECONNECTED = "__reconnected__"
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        user: str,
+        password: str,
+        db: str,
+        channels: List[str],
+        q_out: Deque[Tuple[str, str, float]] = None,
+        active_event: threading.Event = None,
+    ):
+        self.__host = host
+        self.__port = port
+        self.__user = user
+        self.__password = password
+        self.__db = db
+        self.channels = channels
+        self.q_out = q_out if q_out is not None else deque()
+        self.active_event = active_event or threading.Event()
+        self.poll_timeout = 1
+        self.reconnect_wait_seconds = 5
+        self.conn: psycopg2.extensions.connection = None
+        self._listening = False
+        # channels with an enabled notify trigger
+        self.triggered_channels: Set[str] = set()
+        # channel -> invalidation to apply latency (seconds)
+        self.latencies: DefaultDict[str, Deque[float]] = defaultdict(
+            lambda: deque(maxlen=1000)
+        )
+
+    def connect(self):
+        self.conn = psycopg2.connect(
+            host=self.__host,
+            port=self.__port,
+            user=self.__user,
+            password=self.__password,
+            database=self.__db,
+        )
+        self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = self.conn.cursor()
+        for channel in self.channels:
+            cursor.execute(f"LISTEN {channel};")
+        cursor.close()
+        self.triggered_channels = self.get_triggered_channels()
+        missing = sorted(set(self.channels) - self.triggered_channels)
+        if missing:
+            logger.warning(f"no notify trigger, poll instead | channels: {missing}")
+        self._listening = True
+        # notifications may be missed while disconnected
+        self.q_out.append((self.RECONNECTED, "", time.time()))
+        logger.info(f"listen to channels: {self.channels}")
+
+    def get_triggered_channels(self) -> Set[str]:
+        """channels notified by the enabled fn_notify_change triggers"""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "select t.tgargs from pg_trigger t "
+            "join pg_proc p on p.oid = t.tgfoid "
+            "where p.proname = 'fn_notify_change' "
+            "and not t.tgisinternal and t.tgenabled <> 'D'"
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+        # trigger arguments, each terminated by a null byte
+        return {bytes(row[0]).split(b"\x00")[0].decode() for row in rows}
+
+    def close(self):
+        self._listening = False
+        self.triggered_channels = set()
+        if self.conn is not None and self.conn.closed == 0:
+            self.conn.close()
+        self.conn = None
+
+    def is_healthy(self) -> bool:
+        return self._listening and self.conn is not None and self.conn.closed == 0
+
+    def is_pushed(self, channel: str) -> bool:
+        """whether changes of the channel are notified, no poll is needed"""
+        return self.is_healthy() and channel in self.triggered_channels
+
+    def get_notify_ts(self, payload: str, received_ts: float) -> float:
+        try:
+            return float(json.loads(payload)["ts"])
+        except (ValueError, KeyError, TypeError):
+            return received_ts
+
+    def record_latency(self, channel: str, payload: str, received_ts: float):
+        latency = time.time() - self.get_notify_ts(payload, received_ts)
+        self.latencies[channel].append(latency)
+        logger.debug(
+            f"invalidation applied | channel: {channel}, latency: {latency:.3f}s"
+        )
+
+    def poll(self):
+        if select.select([self.conn], [], [], self.poll_timeout) == ([], [], []):
+            return
+        self.conn.poll()
+        while self.conn.notifies:
+            notify = self.conn.notifies.pop(0)
+            self.q_out.append((notify.channel, notify.payload, time.time()))
+
+    def run(self):
+        logger.info("Start Listener")
+        while not self.active_event.is_set():
+            try:
+                if not self.is_healthy():
+                    self.connect()
+                self.poll()
+            except Exception as e:
+                logger.exception(e)
+                self.close()
+                time.sleep(self.reconnect_wait_seconds)
+        self.close()
+        logger.info("Shutdown Listener")
@@ -0,0 +1,201 @@
+import os
+import json
+import datetime as dt
+from decimal import Decimal
+from enum import Enum
+from typing import Dict, List, Optional, Tuple, Type
+import numpy as np
+from pydantic import BaseModel
+
+from bunny_order.models import (
+    Strategy,
+    Position,
+    Contract,
+    ComingDividend,
+)
+from bunny_order.config import Config
+from bunny_order.utils import logger
+
+CACHE_VERSION = 1
+
+
+def encode_column(values: list, type_: type) -> np.ndarray:
+    if issubclass(type_, bool):
+        return np.array([bool(x) for x in values], dtype=bool)
+    elif issubclass(type_, int):
+        return np.array([0 if x is None else x for x in values], dtype=np.int64)
+    elif issubclass(type_, float):
+        return np.array([np.nan if x is None else x for x in values], dtype=np.float64)
+    elif issubclass(type_, dt.datetime):
+        return np.array(values, dtype="datetime64[us]")
+    elif issubclass(type_, dt.date):
+        return np.array(values, dtype="datetime64[D]")
+    elif issubclass(type_, Enum):
+        return np.array(["" if x is None else x.value for x in values], dtype=str)
+    elif issubclass(type_, (str, Decimal)):
+        return np.array(["" if x is None else str(x) for x in values], dtype=str)
+    raise Exception(f"not handle type: {type_}")
+
+
+def decode_column(arr: np.ndarray, type_: type) -> list:
+    values = arr.tolist()
+    if issubclass(type_, (Enum, Decimal)):
+        return [type_(x) for x in values]
+    return values
+
+
+class LocalCache:
+    """
+    Reference datasets persisted as uncompressed columnar numpy archives
+
+    each archive is tagged with the cache version and the update time of the data
+    """
+
+    def __init__(self, cache_dir: str = Config.CACHE_DIR):
+        self.cache_dir = cache_dir
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _get_path(self, name: str) -> str:
+        return f"{self.cache_dir}/{name}.npz"
+
+    def _save(
+        self,
+        name: str,
+        columns: Dict[str, np.ndarray],
+        size: int,
+        update_dt: dt.datetime,
+    ):
+        meta = {
+            "version": CACHE_VERSION,
+            "date": update_dt.strftime("%Y-%m-%d"),
+            "update_dt": update_dt.isoformat(),
+            "size": size,
+        }
+        path = self._get_path(name)
+        with open(f"{path}.tmp", "wb") as f:
+            np.savez(f, __meta__=np.array(json.dumps(meta)), **columns)
+        os.replace(f"{path}.tmp", path)
+
+    def _read(self, name: str) -> Optional[Tuple[Dict[str, np.ndarray], dt.datetime]]:
+        path = self._get_path(name)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                meta = json.loads(data["__meta__"].item())
+                if meta["version"] != CACHE_VERSION:
+                    logger.warning(f"local cache version mismatch: {name}")
+                    return None
+                columns = {key: data[key] for key in data.files if key != "__meta__"}
+        except Exception as e:
+            logger.warning(f"cannot load local cache: {name} | {e}")
+            return None
+        return columns, dt.datetime.fromisoformat(meta["update_dt"])
+
+    def _dump(
+        self,
+        name: str,
+        model: Type[BaseModel],
+        rows: List[BaseModel],
+        update_dt: dt.datetime,
+    ):
+        columns = {}
+        for key, field in model.__fields__.items():
+            values = [getattr(row, key) for row in rows]
+            columns[key] = encode_column(values, field.type_)
+            if field.allow_none:
+                columns[f"{key}.null"] = np.array(
+                    [x is None for x in values], dtype=bool
+                )
+        self._save(name, columns, len(rows), update_dt)
+
+    def _load(
+        self, name: str, model: Type[BaseModel]
+    ) -> Optional[Tuple[List[BaseModel], dt.datetime]]:
+        result = self._read(name)
+        if result is None:
+            return None
+        data, update_dt = result
+        columns = {}
+        for key, field in model.__fields__.items():
+            values = decode_column(data[key], field.type_)
+            if field.allow_none:
+                values = [
+                    None if is_null else x
+                    for x, is_null in zip(values, data[f"{key}.null"].tolist())
+                ]
+            columns[key] = values
+
+        keys = list(columns)
+        # data was validated before being cached
+        rows = [
+            model.construct(**dict(zip(keys, values)))
+            for values in zip(*columns.values())
+        ]
+        return rows, update_dt
+
+    def dump_strategies(self, data: Dict[int, Strategy], update_dt: dt.datetime):
+        self._dump("strategies", Strategy, list(data.values()), update_dt)
+
+    def load_strategies(self) -> Optional[Tuple[Dict[int, Strategy], dt.datetime]]:
+        result = self._load("strategies", Strategy)
+        if result is None:
+            return None
+        rows, update_dt = result
+        return {x.id: x for x in rows}, update_dt
+
+    def dump_positions(
+        self, data: Dict[int, Dict[str, Position]], update_dt: dt.datetime
+    ):
+        rows = [position for d0 in data.values() for position in d0.values()]
+        self._dump("positions", Position, rows, update_dt)
+
+    def load_positions(
+        self,
+    ) -> Optional[Tuple[Dict[int, Dict[str, Position]], dt.datetime]]:
+        result = self._load("positions", Position)
+        if result is None:
+            return None
+        rows, update_dt = result
+        d = {}
+        for row in rows:
+            if row.strategy not in d:
+                d[row.strategy] = {}
+            d[row.strategy][row.code] = row
+        return d, update_dt
+
+    def dump_contracts(self, data: Dict[str, Contract], update_dt: dt.datetime):
+        self._dump("contracts", Contract, list(data.values()), update_dt)
+
+    def load_contracts(self) -> Optional[Tuple[Dict[str, Contract], dt.datetime]]:
+        result = self._load("contracts", Contract)
+        if result is None:
+            return None
+        rows, update_dt = result
+        return {x.code: x for x in rows}, update_dt
+
+    def dump_coming_dividends(
+        self, data: Dict[str, ComingDividend], update_dt: dt.datetime
+    ):
+        self._dump("coming_dividends", ComingDividend, list(data.values()), update_dt)
+
+    def load_coming_dividends(
+        self,
+    ) -> Optional[Tuple[Dict[str, ComingDividend], dt.datetime]]:
+        result = self._load("coming_dividends", ComingDividend)
+        if result is None:
+            return None
+        rows, update_dt = result
+        return {x.code: x for x in rows}, update_dt
+
+    def dump_trading_dates(self, data: List[dt.date], update_dt: dt.datetime):
+        columns = {"tdate": np.array(data, dtype="datetime64[D]")}
+        self._save("trading_dates", columns, len(data), update_dt)
+
+    def load_trading_dates(self) -> Optional[Tuple[List[dt.date], dt.datetime]]:
+        result = self._read("trading_dates")
+        if result is None:
+            return None
+        columns, update_dt = result
+        return columns["tdate"].tolist(), update_dt
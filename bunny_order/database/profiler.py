@@ -0,0 +1,295 @@
+import re
+import sys
+import json
+import time
+import bisect
+import threading
+import datetime as dt
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, List, Tuple
+import psycopg2
+from loguru import logger
+
+from bunny_order.utils import get_tpe_datetime
+
+
+# upper bounds (ms) of latency histogram buckets, last bucket is unbounded
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+_RE_STRING = re.compile(r"'(?:[^']|'')*'")
+_RE_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_RE_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*")
+_RE_SPACE = re.compile(r"\s+")
+
+
+def get_fingerprint(query: str) -> str:
+    """
+    normalize literals, in lists and values lists so that statements differing
+    only in parameters share a fingerprint
+    """
+    fingerprint = _RE_STRING.sub("?", query)
+    fingerprint = _RE_NUMBER.sub("?", fingerprint)
+    fingerprint = _RE_LIST.sub("(...)", fingerprint)
+    fingerprint = _RE_SPACE.sub(" ", fingerprint)
+    return fingerprint.strip().lower()
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, elapsed_ms: float, error: bool = False, timeout: bool = False):
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, elapsed_ms)] += 1
+        if error:
+            self.errors += 1
+        if timeout:
+            self.timeouts += 1
+
+    def merge(self, other: "QueryStats"):
+        self.count += other.count
+        self.errors += other.errors
+        self.timeouts += other.timeouts
+        self.total_ms += other.total_ms
+        self.max_ms = max(self.max_ms, other.max_ms)
+        self.histogram = [x + y for x, y in zip(self.histogram, other.histogram)]
+
+    def percentile(self, q: float) -> float:
+        """upper bound (ms) of the bucket holding the q-th percentile"""
+        target = q * self.count
+        cumulative = 0
+        for k, n in enumerate(self.histogram):
+            cumulative += n
+            if cumulative >= target and n:
+                return LATENCY_BUCKETS[k] if k < len(LATENCY_BUCKETS) else self.max_ms
+        return 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "total_ms": self.total_ms,
+            "max_ms": self.max_ms,
+            "histogram": self.histogram,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "QueryStats":
+        stats = cls()
+        stats.count = data["count"]
+        stats.errors = data["errors"]
+        stats.timeouts = data.get("timeouts", 0)
+        stats.total_ms = data["total_ms"]
+        stats.max_ms = data["max_ms"]
+        stats.histogram = data["histogram"]
+        return stats
+
+
+class QueryProfiler:
+    """
+    Per statement fingerprint and per caller (DataManager method) latency stats
+
+    slow queries are explained by a background thread, never by the thread
+    which ran them
+    """
+
+    def __init__(
+        self,
+        slow_query_ms: float = 500,
+        explain_cooldown: float = 600,
+    ):
+        self.slow_query_ms = slow_query_ms
+        self.explain_cooldown = explain_cooldown
+        # query -> plan, set by TSDBClient
+        self.explain: Callable[[str], str] = None
+        self.lock = threading.Lock()
+        self._local = threading.local()
+        # (query, caller, elapsed_ms) waiting for their plan
+        self._explain_queue: Deque[Tuple[str, str, float]] = deque(maxlen=100)
+        self._explain_event = threading.Event()
+        self._explain_thread: threading.Thread = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.date: dt.date = get_tpe_datetime().date()
+            self.statements: Dict[str, QueryStats] = {}
+            self.callers: Dict[str, QueryStats] = {}
+            self._explained: Dict[str, float] = {}
+
+    def get_caller(self) -> str:
+        return getattr(self._local, "caller", None) or "unknown"
+
+    @contextmanager
+    def caller(self, name: str):
+        """attribute queries to `name`, the outermost caller wins"""
+        if getattr(self._local, "caller", None):
+            yield
+            return
+        self._local.caller = name
+        try:
+            yield
+        finally:
+            self._local.caller = None
+
+    @contextmanager
+    def profile(self, query: str, explainable: bool = True):
+        start_ts = time.perf_counter()
+        error = False
+        timeout = False
+        try:
+            yield
+        except Exception as e:
+            error = True
+            timeout = isinstance(e, psycopg2.extensions.QueryCanceledError)
+            raise
+        finally:
+            self.record(
+                query,
+                (time.perf_counter() - start_ts) * 1000,
+                error=error,
+                explainable=explainable,
+                timeout=timeout,
+            )
+
+    def record(
+        self,
+        query: str,
+        elapsed_ms: float,
+        error: bool = False,
+        explainable: bool = True,
+        timeout: bool = False,
+    ):
+        fingerprint = get_fingerprint(query)
+        caller = self.get_caller()
+        with self.lock:
+            if fingerprint not in self.statements:
+                self.statements[fingerprint] = QueryStats()
+            self.statements[fingerprint].record(elapsed_ms, error, timeout)
+            if caller not in self.callers:
+                self.callers[caller] = QueryStats()
+            self.callers[caller].record(elapsed_ms, error, timeout)
+
+        if elapsed_ms >= self.slow_query_ms:
+            self.on_slow_query(query, fingerprint, caller, elapsed_ms, explainable)
+
+    def on_slow_query(
+        self,
+        query: str,
+        fingerprint: str,
+        caller: str,
+        elapsed_ms: float,
+        explainable: bool,
+    ):
+        logger.warning(
+            f"slow query | caller: {caller}, elapsed: {elapsed_ms:.1f}ms\n"
+            f"{query.strip()}"
+        )
+        if not explainable or self.explain is None:
+            return
+        with self.lock:
+            if (
+                time.time() - self._explained.get(fingerprint, 0)
+                <= self.explain_cooldown
+            ):
+                return
+            self._explained[fingerprint] = time.time()
+            self._explain_queue.append((query, caller, elapsed_ms))
+            if self._explain_thread is None:
+                self._explain_thread = threading.Thread(
+                    target=self._explain_slow_queries,
+                    name="query_explain",
+                    daemon=True,
+                )
+                self._explain_thread.start()
+        self._explain_event.set()
+
+    def _explain_slow_queries(self):
+        while True:
+            self._explain_event.wait()
+            self._explain_event.clear()
+            while self._explain_queue:
+                query, caller, elapsed_ms = self._explain_queue.popleft()
+                try:
+                    plan = self.explain(query)
+                except Exception as e:
+                    plan = f"cannot explain: {e}"
+                logger.warning(
+                    f"slow query plan | caller: {caller}, elapsed: {elapsed_ms:.1f}ms\n"
+                    f"{query.strip()}\n{plan}"
+                )
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "date": self.date.isoformat(),
+                "statements": {k: v.to_dict() for k, v in self.statements.items()},
+                "callers": {k: v.to_dict() for k, v in self.callers.items()},
+            }
+
+    def dump(self, checkpoints_dir: str):
+        """
+        write `db_profile_{date}.json`, stats are reset when the date changes
+        """
+        data = self.to_dict()
+        path = f"{checkpoints_dir}/db_profile_{self.date.strftime('%Y%m%d')}.json"
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(data, indent=4, ensure_ascii=False))
+        if get_tpe_datetime().date() != self.date:
+            self.reset()
+
+
+def report(paths: List[str], top: int = 20) -> str:
+    """rank callers and statements by total DB time"""
+    callers: Dict[str, QueryStats] = {}
+    statements: Dict[str, QueryStats] = {}
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        for target, key in [(callers, "callers"), (statements, "statements")]:
+            for name, val in data[key].items():
+                if name not in target:
+                    target[name] = QueryStats()
+                target[name].merge(QueryStats.from_dict(val))
+
+    lines = []
+    for title, target in [("caller", callers), ("statement", statements)]:
+        total_ms = sum([x.total_ms for x in target.values()]) or 1.0
+        lines.append(
+            f"{'total(s)':>9} {'share':>6} {'count':>8} {'errors':>6} "
+            f"{'timeouts':>8} {'p50(ms)':>8} {'p95(ms)':>8} {'max(ms)':>9}  {title}"
+        )
+        ranked = sorted(target.items(), key=lambda x: x[1].total_ms, reverse=True)
+        for name, stats in ranked[:top]:
+            lines.append(
+                f"{stats.total_ms / 1000:>9.2f} {stats.total_ms / total_ms:>6.1%} "
+                f"{stats.count:>8} {stats.errors:>6} {stats.timeouts:>8} "
+                f"{stats.percentile(0.5):>8.0f} "
+                f"{stats.percentile(0.95):>8.0f} {stats.max_ms:>9.1f}  {name[:120]}"
+            )
+        lines.append("")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    """
+    python -m bunny_order.database.profiler report checkpoints/db_profile_20230526.json
+    python -m bunny_order.database.profiler explain "select * from dealer.strategy"
+    """
+    if len(sys.argv) > 2 and sys.argv[1] == "report":
+        print(report(sys.argv[2:]))
+    elif len(sys.argv) > 2 and sys.argv[1] == "explain":
+        from bunny_order.database.data_manager import DataManager
+
+        print(DataManager().cli.explain(sys.argv[2], analyze=True))
+    else:
+        print("usage: python -m bunny_order.database.profiler {report,explain} ...")
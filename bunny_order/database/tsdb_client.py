@@ -1,49 +1,264 @@
 import time
-from typing import List
+import uuid
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, Iterator, List, Set, Union
+import numpy as np
 import psycopg2
 import psycopg2.extras as extras
 import pandas as pd
+from loguru import logger
+
+from bunny_order.database.profiler import QueryProfiler
+from bunny_order.errors import DatabaseUnavailable, QueryTimeout
+
+
+def rows_to_columns(
+    rows: List[tuple], cols: List[str], dtypes: Dict[str, str] = {}
+) -> Dict[str, np.ndarray]:
+    """
+    Convert fetched rows into typed column arrays, untyped columns are kept as object
+    """
+    n_rows = len(rows)
+    columns = {}
+    for k, col in enumerate(cols):
+        dtype = np.dtype(dtypes.get(col, object))
+        if dtype.kind in "biuf":
+            columns[col] = np.fromiter(
+                (row[k] for row in rows), dtype=dtype, count=n_rows
+            )
+        else:
+            columns[col] = np.array([row[k] for row in rows], dtype=dtype)
+    return columns
 
 
 class TSDBClient:
-    def __init__(self, host: str, port: int, user: str, password: str, db: str):
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        user: str,
+        password: str,
+        db: str,
+        stream_batch_size: int = 2000,
+        slow_query_ms: float = 500,
+        breaker_failure_threshold: int = 3,
+        reconnect_backoff_initial: float = 1,
+        reconnect_backoff_max: float = 60,
+        cancel_grace_ms: float = 200,
+    ):
         self.__host = host
         self.__port = port
         self.__user = user
         self.__password = password
         self.__db = db
-        self.reconnect_wait_seconds = 5
-        self.reconnect_max_retires = 20000
-        self._reconnect_retry = 0
+        # circuit breaker, opened on connection loss or after consecutive
+        # operational errors, closed by the background reconnect thread
+        self.breaker_failure_threshold = breaker_failure_threshold
+        self.reconnect_backoff_initial = reconnect_backoff_initial
+        self.reconnect_backoff_max = reconnect_backoff_max
+        self.breaker_open = False
+        self.breaker_open_ts = 0.0
+        self._failures = 0
+        self._breaker_lock = threading.Lock()
+        self._reconnect_thread: threading.Thread = None
+        self.on_reconnected: List[Callable[[], None]] = []
+        # client side cancel fires `cancel_grace_ms` after the statement timeout
+        self.cancel_grace_ms = cancel_grace_ms
+        # statements on self.conn are serialized, so a client side cancel only
+        # reaches the statement of the thread that armed it
+        self._statement_lock = threading.RLock()
+        self._cancel_lock = threading.Lock()
+        self._cancel_tokens: Set[object] = set()
+        self._local = threading.local()
+        self.stream_batch_size = stream_batch_size
+        # rows affected by the last execute_query
+        self.last_rowcount = 0
+        self.profiler = QueryProfiler(slow_query_ms=slow_query_ms)
+        self.profiler.explain = self.explain
         self.conn: psycopg2.connection = None
-        self.connect()
+        try:
+            self.connect()
+        except psycopg2.OperationalError as error:
+            logger.error(f"Error: {error}")
+            self.open_breaker()
 
     def connect(self):
-        self.conn = psycopg2.connect(
+        self.conn = self.new_connection()
+
+    def new_connection(self) -> psycopg2.extensions.connection:
+        return psycopg2.connect(
             host=self.__host,
             port=self.__port,
             user=self.__user,
             password=self.__password,
             database=self.__db,
         )
-        if self.conn.closed == 0:
-            self._reconnect_retry = 0
-
-    def reconnect(self):
-        while (
-            not self.is_connected()
-            and self._reconnect_retry < self.reconnect_max_retires
-        ):
-            self._reconnect_retry += 1
-            print(f"reconnecting... | retry: {self._reconnect_retry}")
-            self.connect()
-            if not self.is_connected():
-                time.sleep(self.reconnect_wait_seconds)
 
+    def get_stream_conn(self) -> psycopg2.extensions.connection:
+        """
+        connection of the streaming reads of the calling thread, a commit or
+        rollback on self.conn would close their named cursors
+        """
+        conn = getattr(self._local, "stream_conn", None)
+        if conn is None or conn.closed != 0:
+            conn = self.new_connection()
+            self._local.stream_conn = conn
+        return conn
+
+    def close_stream_conn(self):
+        conn = getattr(self._local, "stream_conn", None)
+        self._local.stream_conn = None
+        if conn is not None and conn.closed == 0:
+            conn.close()
+
+    def open_breaker(self):
+        """
+        stop sending queries and reconnect in the background with exponential backoff
+        """
+        with self._breaker_lock:
+            if self.breaker_open:
+                return
+            self.breaker_open = True
+            self.breaker_open_ts = time.time()
+            logger.warning("circuit breaker open | database unavailable")
+            self._reconnect_thread = threading.Thread(
+                target=self._reconnect, name="tsdb_reconnect", daemon=True
+            )
+            self._reconnect_thread.start()
+
+    def _reconnect(self):
+        retry = 0
+        wait_seconds = self.reconnect_backoff_initial
+        while True:
+            retry += 1
+            try:
+                if self.conn is not None and self.conn.closed == 0:
+                    self.conn.close()
+                self.connect()
+                cursor = self.conn.cursor()
+                cursor.execute("select 1")
+                cursor.close()
+                self.conn.rollback()
+                break
+            except (Exception, psycopg2.DatabaseError) as error:
+                logger.warning(
+                    f"reconnecting... | retry: {retry}, wait: {wait_seconds}s | {error}"
+                )
+                time.sleep(wait_seconds)
+                wait_seconds = min(wait_seconds * 2, self.reconnect_backoff_max)
+
+        with self._breaker_lock:
+            self._failures = 0
+            self.breaker_open = False
+        logger.info(
+            f"circuit breaker closed | connected after "
+            f"{time.time() - self.breaker_open_ts:.1f}s"
+        )
+        for callback in self.on_reconnected:
+            try:
+                callback()
+            except Exception as e:
+                logger.exception(e)
+
+    def check_available(self):
+        """raise DatabaseUnavailable instead of blocking while the breaker is open"""
+        if not self.breaker_open and not self.is_connected():
+            self.open_breaker()
+        if self.breaker_open:
+            raise DatabaseUnavailable("circuit breaker open")
+
+    @contextmanager
+    def timeout(self, timeout_ms: float):
+        """
+        statement timeout budget of the queries in the block, the outermost budget wins
+        """
+        if not timeout_ms or getattr(self._local, "timeout_ms", None):
+            yield
+            return
+        self._local.timeout_ms = timeout_ms
+        try:
+            yield
+        finally:
+            self._local.timeout_ms = None
+
+    def get_timeout(self) -> float:
+        return getattr(self._local, "timeout_ms", None)
+
+    def _set_statement_timeout(
+        self, timeout_ms: float, conn: psycopg2.extensions.connection = None
+    ):
+        """set statement_timeout for the current transaction"""
+        if not timeout_ms:
+            return
+        with (conn or self.conn).cursor() as cursor:
+            cursor.execute(f"set local statement_timeout = {int(timeout_ms)}")
+
+    @contextmanager
+    def _cancel_after(
+        self, timeout_ms: float, conn: psycopg2.extensions.connection = None
+    ):
+        """
+        hold the connection for the statements of the block and cancel them
+        from the client when the server cannot enforce statement_timeout, e.g.
+        a stalled network, `conn` is a connection of the calling thread only,
+        self.conn by default
+        """
+        with self._statement_lock if conn is None else nullcontext():
+            if not timeout_ms:
+                yield
+                return
+            token = object()
+            timer = threading.Timer(
+                (timeout_ms + self.cancel_grace_ms) / 1000,
+                self._cancel,
+                args=(conn or self.conn, token),
+            )
+            timer.daemon = True
+            with self._cancel_lock:
+                self._cancel_tokens.add(token)
+            timer.start()
+            try:
+                yield
+            finally:
+                # a timer firing late must not cancel the next statement
+                with self._cancel_lock:
+                    self._cancel_tokens.discard(token)
+                timer.cancel()
+
+    def _cancel(self, conn: psycopg2.extensions.connection, token: object):
+        with self._cancel_lock:
+            if token not in self._cancel_tokens:
+                return
+            logger.warning("cancel query | client side timeout")
+            try:
+                conn.cancel()
+            except (Exception, psycopg2.DatabaseError) as error:
+                logger.error(f"Error: {error}")
+
+    def on_error(self, error: Exception):
+        """
+        rollback and count connection level failures, raise QueryTimeout on
+        cancellation and DatabaseUnavailable once the breaker is open
+        """
+        logger.error(f"Error: {error}")
         if self.is_connected():
-            print("connected")
-        else:
-            raise Exception("max reconnect_max_retires exceeded")
+            try:
+                with self._statement_lock:
+                    self.conn.rollback()
+            except psycopg2.InterfaceError:
+                pass
+        if isinstance(error, psycopg2.extensions.QueryCanceledError):
+            raise QueryTimeout(str(error)) from error
+        if not isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+            return
+        self._failures += 1
+        if not self.is_connected() or self._failures >= self.breaker_failure_threshold:
+            self.open_breaker()
+            raise DatabaseUnavailable(str(error)) from error
+
+    def on_success(self):
+        self._failures = 0
 
     def is_connected(self) -> bool:
         if not self.conn:
@@ -52,21 +267,31 @@ class TSDBClient:
             return False
         return True
 
-    def execute_query(self, query: str, out_type: str = None):
-        """Execute a single query"""
-        if not self.is_connected():
-            self.reconnect()
+    def execute_query(
+        self, query: str, out_type: str = None, dtypes: Dict[str, str] = {}
+    ):
+        """
+        Execute a single query
+
+        out_type (str): {None, df, dict, columns}
+        dtypes (dict): numpy dtype of each column for out_type `columns`
+        """
+        self.check_available()
 
         ret = 0  # Return value
+        timeout_ms = self.get_timeout()
         cursor = self.conn.cursor()
         try:
-            cursor.execute(query)
-            self.conn.commit()
+            with self.profiler.profile(query), self._cancel_after(timeout_ms):
+                self._set_statement_timeout(timeout_ms)
+                cursor.execute(query)
+                self.conn.commit()
         except (Exception, psycopg2.DatabaseError) as error:
-            print("Error: %s" % error)
-            self.conn.rollback()
             cursor.close()
+            self.on_error(error)
             return 1
+        self.on_success()
+        self.last_rowcount = cursor.rowcount
 
         # If this was a select query, return the result
         if "select" in query.lower() and "into" not in query.lower():
@@ -77,32 +302,116 @@ class TSDBClient:
             elif out_type == "dict":
                 cols = [x.name for x in cursor.description]
                 ret = [{col: row[k] for k, col in enumerate(cols)} for row in ret]
+            elif out_type == "columns":
+                cols = [x.name for x in cursor.description]
+                ret = rows_to_columns(ret, cols, dtypes)
 
         cursor.close()
         return ret
 
+    def stream_query(
+        self, query: str, out_type: str = "dict", batch_size: int = None
+    ) -> Iterator[Union[tuple, dict]]:
+        """
+        Execute a select query with a named server-side cursor and yield rows
+        one by one, fetching `batch_size` rows per round trip
+
+        runs on the stream connection of the calling thread, the cursor and
+        its transaction are released when the generator is closed early
+        """
+        self.check_available()
+
+        timeout_ms = self.get_timeout()
+        try:
+            conn = self.get_stream_conn()
+        except psycopg2.OperationalError as error:
+            self.on_error(error)
+            raise
+        cursor = conn.cursor(name=f"stream_{uuid.uuid4().hex[:12]}")
+        cursor.itersize = batch_size or self.stream_batch_size
+        start_ts = time.perf_counter()
+        elapsed = 0.0
+        completed = False
+        try:
+            # the budget applies to each round trip
+            with self._cancel_after(timeout_ms, conn):
+                self._set_statement_timeout(timeout_ms, conn)
+                cursor.execute(query)
+            cols = None
+            while True:
+                with self._cancel_after(timeout_ms, conn):
+                    rows = cursor.fetchmany(cursor.itersize)
+                # time spent in the database, excluding the consumer of the rows
+                elapsed += time.perf_counter() - start_ts
+                if not rows:
+                    break
+                if out_type == "dict":
+                    if cols is None:
+                        cols = [x.name for x in cursor.description]
+                    for row in rows:
+                        yield dict(zip(cols, row))
+                else:
+                    yield from rows
+                start_ts = time.perf_counter()
+            cursor.close()
+            conn.commit()
+            completed = True
+            self.profiler.record(query, elapsed * 1000)
+            self.on_success()
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.profiler.record(
+                query,
+                elapsed * 1000,
+                error=True,
+                timeout=isinstance(error, psycopg2.extensions.QueryCanceledError),
+            )
+            self._end_stream(conn, cursor)
+            completed = True
+            if isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                self.close_stream_conn()
+            self.on_error(error)
+            raise
+        finally:
+            if not completed:
+                # the consumer stopped early (GeneratorExit)
+                self._end_stream(conn, cursor)
+
+    def _end_stream(self, conn: psycopg2.extensions.connection, cursor):
+        """close the named cursor and end its transaction"""
+        try:
+            if not cursor.closed and not conn.closed:
+                cursor.close()
+            if not conn.closed:
+                conn.rollback()
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error(f"Error: {error}")
+
     def execute_values_df(self, df: pd.DataFrame, table: str, page_size: int = 10000):
         """
         Using psycopg2.extras.execute_values() to insert the dataframe
         """
-        if not self.is_connected():
-            self.reconnect()
+        self.check_available()
         # Create a list of tupples from the dataframe values
         tuples = [tuple(x) for x in df.to_numpy()]
         # Comma-separated dataframe columns
         cols = ",".join(list(df.columns))
         # SQL quert to execute
         query = "INSERT INTO %s(%s) VALUES %%s" % (table, cols)
+        timeout_ms = self.get_timeout()
         cursor = self.conn.cursor()
         try:
-            extras.execute_values(cursor, query, tuples, page_size=page_size)
-            self.conn.commit()
+            with self.profiler.profile(
+                query, explainable=False
+            ), self._cancel_after(timeout_ms):
+                self._set_statement_timeout(timeout_ms)
+                extras.execute_values(cursor, query, tuples, page_size=page_size)
+                self.conn.commit()
         except (Exception, psycopg2.DatabaseError) as error:
-            print("Error: %s" % error)
-            self.conn.rollback()
             cursor.close()
+            self.on_error(error)
             return 1
         cursor.close()
+        self.on_success()
 
     def execute_values(
         self, columns: List[str], data: List[tuple], table: str, page_size: int = 10000
@@ -110,22 +419,26 @@ class TSDBClient:
         """
         Using psycopg2.extras.execute_values() to insert the List of tuple
         """
-        if not self.is_connected():
-            self.reconnect()
+        self.check_available()
         # Comma-separated columns
         cols = ",".join(columns)
         # SQL quert to execute
         query = "INSERT INTO %s(%s) VALUES %%s" % (table, cols)
+        timeout_ms = self.get_timeout()
         cursor = self.conn.cursor()
         try:
-            extras.execute_values(cursor, query, data, page_size=page_size)
-            self.conn.commit()
+            with self.profiler.profile(
+                query, explainable=False
+            ), self._cancel_after(timeout_ms):
+                self._set_statement_timeout(timeout_ms)
+                extras.execute_values(cursor, query, data, page_size=page_size)
+                self.conn.commit()
         except (Exception, psycopg2.DatabaseError) as error:
-            print("Error: %s" % error)
-            self.conn.rollback()
             cursor.close()
+            self.on_error(error)
             return 1
         cursor.close()
+        self.on_success()
 
     def execute_batch_upsert_df(
         self,
@@ -137,8 +450,7 @@ class TSDBClient:
         """
         Using psycopg2.extras.execute_batch() to upsert the dataframe
         """
-        if not self.is_connected():
-            self.reconnect()
+        self.check_available()
         # Create a list of tupples from the dataframe values
         tuples = [tuple(x) for x in df.to_numpy()]
         # Comma-separated dataframe columns
@@ -160,13 +472,35 @@ class TSDBClient:
             conflict_sql,
             upd_sql,
         )
+        timeout_ms = self.get_timeout()
         cursor = self.conn.cursor()
         try:
-            extras.execute_batch(cursor, query, tuples, page_size=page_size)
-            self.conn.commit()
+            with self.profiler.profile(
+                query, explainable=False
+            ), self._cancel_after(timeout_ms):
+                self._set_statement_timeout(timeout_ms)
+                extras.execute_batch(cursor, query, tuples, page_size=page_size)
+                self.conn.commit()
         except (Exception, psycopg2.DatabaseError) as error:
-            print("Error: %s" % error)
-            self.conn.rollback()
             cursor.close()
+            self.on_error(error)
             return 1
         cursor.close()
+        self.on_success()
+
+    def explain(self, query: str, analyze: bool = False) -> str:
+        """
+        Plan of a query on a connection of its own, `analyze` executes the query
+        in a transaction rolled back
+        """
+        self.check_available()
+        options = "analyze, buffers" if analyze else "costs"
+        conn = self.new_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(f"explain ({options}) {query}")
+                plan = "\n".join([row[0] for row in cursor.fetchall()])
+            conn.rollback()
+        finally:
+            conn.close()
+        return plan
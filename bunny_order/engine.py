@@ -9,13 +9,14 @@ import threading
 from bunny_order.utils import (
     logger,
     get_tpe_datetime,
-    is_trade_time,
-    is_week_date,
     get_next_schedule_time,
-    is_signal_time,
-    is_sync_time,
 )
+from bunny_order.clock import clock
 from bunny_order.database.data_manager import DataManager
+from bunny_order.database.listener import TSDBListener
+from bunny_order.database.local_cache import LocalCache
+from bunny_order.database.journal_consumer import JournalConsumer
+from bunny_order.journal import Journal
 from bunny_order.order_observer import OrderObserver
 from bunny_order.models import (
     Strategy,
@@ -28,6 +29,7 @@ from bunny_order.models import (
     Position,
     Contract,
     Event,
+    SignalSource,
 )
 from bunny_order.config import Config
 from bunny_order.order_manager import OrderManager
@@ -35,7 +37,7 @@ from bunny_order.exit_handler import ExitHandler
 from bunny_order.risk_manager import RiskManager
 from bunny_order.common import (
     Strategies,
-    Snapshots,
+    ColumnarSnapshots,
     Positions,
     Contracts,
     ComingDividends,
@@ -51,13 +53,19 @@ class Engine:
         snapshot_interval: int,
     ):
         self.dm = DataManager()
+        self.local_cache = LocalCache()
+        # state-changing events are journaled, Postgres is fed by the consumer
+        self.journal = Journal()
+        self.revalidating_event = threading.Event()
         self.strategies = Strategies()
-        self.snapshots = Snapshots()
+        self.snapshots = ColumnarSnapshots()
         self.positions = Positions()
         self.contracts = Contracts()
         self.coming_dividends = ComingDividends()
         self.trading_dates = TradingDates()
         self.unhandled_orders: Deque[SF31Order] = deque()
+        # mapped sf31 orders waiting for the bulk order_id update
+        self.order_mappings: List[SF31Order] = []
         # order_id -> Order
         self.order_callbacks: Dict[str, Order] = {}
         self.unhandled_order_callbacks: Deque[Tuple[int, Order]] = deque()
@@ -74,6 +82,7 @@ class Engine:
             strategies=self.strategies,
             contracts=self.contracts,
             trading_dates=self.trading_dates,
+            journal=self.journal,
             unhandled_orders=self.unhandled_orders,
             q_in=self.q_order_manager_in,
             active_event=self.om_active_event,
@@ -92,7 +101,12 @@ class Engine:
         )
 
         # exit handler
-        self.q_exit_handler_in: Deque[Tuple[Event, Dict[str, QuoteSnapshot]]] = deque()
+        self.q_exit_handler_in: Deque[
+            Tuple[
+                Event,
+                Union[Tuple[ColumnarSnapshots, List[str]], Signal, Order, Trade],
+            ]
+        ] = deque()
         self.q_exit_handler_out: Deque[Tuple[Event, Signal]] = deque()
         self.exit_handler_active_event = threading.Event()
         self.exit_handler = ExitHandler(
@@ -109,6 +123,37 @@ class Engine:
         )
         self.__thread_exit_handler.setDaemon(True)
 
+        # listener
+        self.q_listener_out: Deque[Tuple[str, str, float]] = deque()
+        self.listener_active_event = threading.Event()
+        self.listener = TSDBListener(
+            host=Config.DB_HOST,
+            port=Config.DB_PORT,
+            user=Config.DB_USER,
+            password=Config.DB_PASSWORD,
+            db=Config.DB_DATABASE,
+            channels=[
+                Config.LISTENER_STRATEGY_CHANNEL,
+                Config.LISTENER_POSITIONS_CHANNEL,
+                Config.LISTENER_CONTRACTS_CHANNEL,
+            ],
+            q_out=self.q_listener_out,
+            active_event=self.listener_active_event,
+        )
+        self.__thread_listener = Thread(target=self.listener.run, name="listener")
+        self.__thread_listener.setDaemon(True)
+
+        # journal consumer
+        self.journal_consumer_active_event = threading.Event()
+        self.journal_consumer = JournalConsumer(
+            journal=self.journal,
+            active_event=self.journal_consumer_active_event,
+        )
+        self.__thread_journal_consumer = Thread(
+            target=self.journal_consumer.run, name="journal_consumer"
+        )
+        self.__thread_journal_consumer.setDaemon(True)
+
         # risk manager
         self.rm = RiskManager(
             strategies=self.strategies,
@@ -120,7 +165,15 @@ class Engine:
 
         self.active = False
         self.sync_interval = sync_interval
+        self.fallback_sync_interval = Config.LISTENER_FALLBACK_SYNC_INTERVAL
+        self.full_sync_interval = Config.FULL_SYNC_INTERVAL
+        self.position_sync_lookback = Config.POSITION_SYNC_LOOKBACK
+        self._prev_full_sync_ts = 0.0
+        self._positions_watermark: dt.datetime = None
+        self._contracts_watermark: dt.date = None
         self.snapshot_interval = snapshot_interval
+        # database circuit breaker open, caches are served from the last reads
+        self.degraded = False
         self.debug = debug
         self.init_checkpoints()
 
@@ -133,7 +186,9 @@ class Engine:
         self.rm.validate_signal(signal)
         if signal.rm_validated:
             self.q_order_manager_in.append((Event.Signal, signal))
-        self.dm.save_signal(signal)
+        if signal.source == SignalSource.ExitHandler:
+            self.q_exit_handler_in.append((Event.Signal, signal))
+        self.journal.append(Event.Signal, signal)
 
     def map_signal_id_and_order_id(self, order: Order) -> bool:
         for _ in range(len(self.unhandled_orders)):
@@ -148,7 +203,7 @@ class Engine:
             ):
                 sf31_order.order_id = order.order_id
                 order.strategy = sf31_order.strategy_id
-                self.dm.update_sf31_order(sf31_order)
+                self.order_mappings.append(sf31_order)
                 return True
             else:
                 self.unhandled_orders.append(sf31_order)
@@ -161,7 +216,8 @@ class Engine:
         if self.map_signal_id_and_order_id(order):
             logger.info(order)
             self.order_callbacks[order.order_id] = order
-            self.dm.save_order(order)
+            self.journal.append(Event.OrderCallback, order)
+            self.q_exit_handler_in.append((Event.OrderCallback, order))
 
         elif retry_counter >= 0 and retry_counter < max_retries:
             self.unhandled_order_callbacks.append((retry_counter + 1, order))
@@ -169,7 +225,14 @@ class Engine:
         else:
             self.order_callbacks[order.order_id] = order
             logger.warning(f"cannot map to sf31_order | order: {order}")
-            self.dm.save_order(order)
+            self.journal.append(Event.OrderCallback, order)
+
+    def flush_order_mappings(self):
+        if not self.order_mappings:
+            return
+        for order in self.order_mappings:
+            self.journal.append(Event.OrderMapping, order)
+        self.order_mappings = []
 
     def on_trade_callback(
         self, trade: Trade, retry_counter: int = 0, max_retries: int = 20
@@ -177,23 +240,96 @@ class Engine:
         if trade.order_id in self.order_callbacks:
             trade.strategy = self.order_callbacks[trade.order_id].strategy
             logger.info(trade)
-            self.dm.save_trade(trade)
+            offset = self.journal.append(Event.TradeCallback, trade)
+            # visible to exit handler and risk manager before the next sync
+            self.positions.apply_trade(trade, offset)
+            self.q_exit_handler_in.append((Event.TradeCallback, trade))
 
         elif retry_counter >= 0 and retry_counter < max_retries:
             self.unhandled_trade_callbacks.append((retry_counter + 1, trade))
 
         else:
             logger.warning(f"cannot map trade to order | trade: {trade}")
-            self.dm.save_trade(trade)
+            self.journal.append(Event.TradeCallback, trade)
 
     def on_positions_callback(self, positions: List[SF31Position]):
-        self.dm.save_positions(positions)
+        self.journal.append(Event.PositionsCallback, positions)
+
+    def recover_from_journal(self):
+        """
+        rebuild sf31 orders and order callbacks of the day from the journal after
+        a restart, sf31 orders are mapped to their order callbacks again, those
+        without a callback are unhandled, mappings not journaled are flushed
+        """
+        now = get_tpe_datetime()
+        elapsed = now - now.replace(hour=0, minute=0, second=0, microsecond=0)
+        offset = self.journal.find_offset(time.time() - elapsed.total_seconds())
+        n_records = 0
+        n_trades = 0
+        while True:
+            records = self.journal.read(offset)
+            if not records:
+                break
+            for record in records:
+                if record.event == Event.SF31Order:
+                    self.unhandled_orders.append(record.data)
+                elif record.event == Event.OrderCallback:
+                    self.map_signal_id_and_order_id(record.data)
+                    self.order_callbacks[record.data.order_id] = record.data
+                elif record.event == Event.OrderMapping:
+                    # journaled already, not flushed again
+                    if record.data in self.order_mappings:
+                        self.order_mappings.remove(record.data)
+                elif (
+                    record.event == Event.TradeCallback
+                    and record.offset >= self.journal_consumer.persisted_offset
+                    and record.data.order_id in self.order_callbacks
+                ):
+                    # mapped trades not in the DB yet
+                    self.positions.apply_trade(record.data, record.offset)
+                    n_trades += 1
+            n_records += len(records)
+            offset = records[-1].next_offset
+        logger.info(
+            f"recover from journal | records: {n_records}, "
+            f"unhandled sf31 orders: {len(self.unhandled_orders)}, "
+            f"order callbacks: {len(self.order_callbacks)}, "
+            f"order mappings: {len(self.order_mappings)}, "
+            f"unpersisted trades: {n_trades}"
+        )
+        self.flush_order_mappings()
+
+    def log_lock_stats(self):
+        for cache in [
+            self.strategies,
+            self.snapshots,
+            self.positions,
+            self.contracts,
+            self.coming_dividends,
+            self.trading_dates,
+        ]:
+            stats = cache.lock.get_stats()
+            if stats["writes"]:
+                logger.info(f"lock stats | {stats}")
 
     def sync(self):
         self.update_strategies()
-        self.update_positions()
-        if not self.contracts.update_dt or (not self.contracts.check_updated()):
-            self.update_contracts()
+        if (
+            self._positions_watermark is None
+            or time.time() - self._prev_full_sync_ts > self.full_sync_interval
+        ):
+            # full reconcile
+            self.update_positions()
+            if not self.contracts.update_dt or (not self.contracts.check_updated()):
+                self.update_contracts()
+            self._prev_full_sync_ts = time.time()
+            self.dm.dump_profile()
+            self.log_lock_stats()
+            logger.info(f"exit handler stats | {self.exit_handler.get_stats()}")
+        else:
+            self.update_position_changes()
+            if not self.contracts.check_updated():
+                self.update_contract_changes()
         if not self.coming_dividends.update_dt or (
             not self.coming_dividends.check_updated()
         ):
@@ -201,33 +337,185 @@ class Engine:
         if not self.trading_dates.update_dt or (not self.trading_dates.check_updated()):
             self.update_trading_dates()
 
+    def on_notifications(self):
+        channels = {}
+        while self.q_listener_out:
+            channel, payload, received_ts = self.q_listener_out.popleft()
+            # keep the earliest notification of each channel
+            if channel not in channels:
+                channels[channel] = (payload, received_ts)
+
+        if TSDBListener.RECONNECTED in channels:
+            self.sync()
+            self._prev_poll_ts = time.time()
+            return
+
+        for channel, (payload, received_ts) in channels.items():
+            if channel == Config.LISTENER_STRATEGY_CHANNEL:
+                self.update_strategies()
+            elif channel == Config.LISTENER_POSITIONS_CHANNEL:
+                if self._positions_watermark is None:
+                    self.update_positions()
+                else:
+                    self.update_position_changes()
+            elif channel == Config.LISTENER_CONTRACTS_CHANNEL:
+                self.update_contract_changes()
+            else:
+                logger.warning(f"Invalid channel: {channel}")
+                continue
+            self.listener.record_latency(channel, payload, received_ts)
+
+    def get_persisted_offset(self) -> Union[int, None]:
+        """
+        journal offset below which trades are in the positions just read,
+        taken after the read so a trade is never applied twice
+        """
+        if self.dm.is_degraded():
+            # the read fell back to the last result
+            return None
+        return self.journal_consumer.persisted_offset
+
     def update_positions(self):
+        watermark = get_tpe_datetime()
         positions = self.dm.get_positions()
-        self.positions.update(positions)
+        self.positions.update(
+            positions,
+            update_dt=self.dm.get_read_dt("get_positions"),
+            persisted_offset=self.get_persisted_offset(),
+        )
+        self._positions_watermark = watermark
+        self.local_cache.dump_positions(positions, self.positions.update_dt)
+        # high / low since entry are seeded once a day, tracked from quotes after
+        extremes = self.exit_handler.extremes
+        if extremes.seed_date != clock.today() and not self.dm.is_degraded():
+            seed_positions = self.dm.get_position_extremes()
+            if self.dm.get_read_dt("get_position_extremes") is not None:
+                extremes.seed(seed_positions, clock.today())
+
+    def update_position_changes(self):
+        watermark = get_tpe_datetime()
+        since = self._positions_watermark - dt.timedelta(
+            seconds=self.position_sync_lookback
+        )
+        positions, removed = self.dm.get_position_changes(since)
+        if self.dm.get_read_dt("get_position_changes") is None:
+            # no changes served while degraded, positions stay outdated
+            return
+        self.positions.apply_changes(
+            positions, removed, persisted_offset=self.get_persisted_offset()
+        )
+        self._positions_watermark = watermark
 
     def update_strategies(self):
         strategies = self.dm.get_strategies()
-        self.strategies.update(strategies)
+        self.strategies.update(
+            strategies, update_dt=self.dm.get_read_dt("get_strategies")
+        )
+        self.local_cache.dump_strategies(strategies, self.strategies.update_dt)
 
     def update_contracts(self):
         contracts = self.dm.get_contracts()
-        self.contracts.update(contracts)
+        self.contracts.update(contracts, update_dt=self.dm.get_read_dt("get_contracts"))
+        self._contracts_watermark = self._get_contracts_watermark(contracts)
+        self.local_cache.dump_contracts(contracts, self.contracts.update_dt)
+
+    def update_contract_changes(self):
+        if self._contracts_watermark is None:
+            self.update_contracts()
+            return
+        contracts = self.dm.get_contract_changes(self._contracts_watermark)
+        if self.dm.get_read_dt("get_contract_changes") is None:
+            return
+        self.contracts.apply_changes(contracts)
+        watermark = self._get_contracts_watermark(contracts)
+        if watermark and watermark > self._contracts_watermark:
+            self._contracts_watermark = watermark
+
+    def _get_contracts_watermark(self, contracts: Dict[str, Contract]) -> dt.date:
+        return max(
+            [x.update_date for x in contracts.values() if x.update_date],
+            default=None,
+        )
 
     def update_coming_dividends(self):
         coming_dividends = self.dm.get_coming_dividends()
-        self.coming_dividends.update(coming_dividends)
+        self.coming_dividends.update(
+            coming_dividends, update_dt=self.dm.get_read_dt("get_coming_dividends")
+        )
+        self.local_cache.dump_coming_dividends(
+            coming_dividends, self.coming_dividends.update_dt
+        )
 
     def update_trading_dates(self):
         trading_dates = self.dm.get_near_trading_dates()
-        self.trading_dates.update(trading_dates)
+        self.trading_dates.update(
+            trading_dates, update_dt=self.dm.get_read_dt("get_near_trading_dates")
+        )
+        self.local_cache.dump_trading_dates(
+            trading_dates, self.trading_dates.update_dt
+        )
+
+    def load_local_cache(self):
+        """
+        warm start from the local cache, freshness is still decided by
+        check_updated of each cache with the cached update time
+        """
+        start_ts = time.time()
+        result = self.local_cache.load_strategies()
+        if result:
+            self.strategies.update(*result)
+        result = self.local_cache.load_positions()
+        if result:
+            self.positions.update(*result)
+        result = self.local_cache.load_contracts()
+        if result:
+            self.contracts.update(*result)
+            self._contracts_watermark = self._get_contracts_watermark(result[0])
+        result = self.local_cache.load_coming_dividends()
+        if result:
+            self.coming_dividends.update(*result)
+        result = self.local_cache.load_trading_dates()
+        if result:
+            self.trading_dates.update(*result)
+        logger.info(f"load local cache | elapsed: {time.time() - start_ts:.3f}s")
+
+    def revalidate(self):
+        try:
+            self.sync()
+            self._prev_sync_ts = time.time()
+            self._prev_poll_ts = time.time()
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            self.revalidating_event.clear()
 
-    def update_snapshots(self):
+    def update_snapshots(self) -> List[str]:
         codes = self.positions.get_position_codes()
-        snapshots = self.dm.get_quote_snapshots(codes)
-        self.snapshots.update(snapshots)
+        columns = self.dm.get_quote_snapshot_changes(
+            codes, self.snapshots.get_watermarks()
+        )
+        update_dt = self.dm.get_read_dt("get_quote_snapshot_changes")
+        if update_dt is None:
+            # no changes served while degraded, snapshots stay outdated
+            return []
+        changed_codes = self.snapshots.apply_columns(columns, update_dt=update_dt)
+        logger.info(
+            f"update snapshots | codes: {len(codes)}, changed: {len(changed_codes)}, "
+            f"rows: {len(columns['code'])}, "
+            f"bytes: {sum(arr.nbytes for arr in columns.values())}"
+        )
+        return changed_codes
 
     def reset(self):
         logger.info("reset")
+        self.flush_order_mappings()
+        # one segment per session, persisted ones are kept for the retention
+        self.journal.roll()
+        self.journal.delete_segments(
+            self.journal_consumer.persisted_offset,
+            time.time() - Config.JOURNAL_RETENTION_DAYS * 86400,
+        )
+        self._prev_full_sync_ts = 0.0
         self.unhandled_orders.clear()
         self.order_callbacks.clear()
         self.unhandled_order_callbacks.clear()
@@ -269,12 +557,16 @@ class Engine:
 
     def init_timer(self):
         self._prev_sync_ts = 0.0
+        self._prev_poll_ts = 0.0
         self._prev_snapshot_ts = 0.0
         self._next_reset_dt1 = get_next_schedule_time(Config.RESET_TIME1)
         self._next_reset_dt2 = get_next_schedule_time(Config.RESET_TIME2)
 
     def run_schedule_job(self):
-        cur_dt = get_tpe_datetime()
+        if self.revalidating_event.is_set():
+            return
+
+        cur_dt = clock.now()
         if cur_dt >= self._next_reset_dt1:
             self.reset()
             self.sync()
@@ -285,26 +577,59 @@ class Engine:
             self.sync()
             self._next_reset_dt2 += dt.timedelta(days=1)
 
-        if not is_week_date():
+        if not clock.is_week_date():
             return
-        
-        if not is_sync_time():
+
+        if not clock.is_sync_time():
             return
 
+        self.on_notifications()
+
         if time.time() - self._prev_sync_ts > self.sync_interval:
-            self.sync()
+            # changes are pushed while the listener is healthy and the triggers are
+            # installed, poll slowly as fallback
+            if (
+                self.listener.is_pushed(Config.LISTENER_STRATEGY_CHANNEL)
+                and self.listener.is_pushed(Config.LISTENER_POSITIONS_CHANNEL)
+                and time.time() - self._prev_poll_ts < self.fallback_sync_interval
+            ):
+                self.strategies.touch()
+                self.positions.touch()
+            else:
+                self.sync()
+                self._prev_poll_ts = time.time()
             self._prev_sync_ts = time.time()
 
         if time.time() - self._prev_snapshot_ts > self.snapshot_interval:
-            self.update_snapshots()
-            self.exit_handler.q_in.append((Event.Quote, self.snapshots))
+            changed_codes = self.update_snapshots()
+            if changed_codes:
+                self.exit_handler.q_in.append(
+                    (Event.Quote, (self.snapshots, changed_codes))
+                )
             self._prev_snapshot_ts = time.time()
 
+    def check_database(self):
+        degraded = self.dm.is_degraded()
+        if degraded and not self.degraded:
+            logger.warning("database unavailable | degraded mode, serve cached data")
+        elif not degraded and self.degraded:
+            logger.info(
+                f"database recovered | pending writes: {len(self.dm.pending_writes)}"
+            )
+            # changes are not observed while degraded, force a full reconcile
+            self._prev_full_sync_ts = 0.0
+            self._prev_sync_ts = 0.0
+        self.degraded = degraded
+        if not degraded and self.dm.pending_writes:
+            self.dm.replay_writes()
+
     def system_check(self) -> bool:
-        if not is_signal_time():
+        # degraded mode does not block signals, risk checks use the cached data
+        self.check_database()
+        if not clock.is_signal_time():
             return False
         if not self.trading_dates.check_updated():
-            if is_trade_time():
+            if clock.is_trade_time():
                 logger.warning(
                     f"trading_dates not updated, previous update time: {self.contracts.update_dt}"
                 )
@@ -312,25 +637,25 @@ class Engine:
         if not self.trading_dates.is_trading_date():
             return False
         if not self.contracts.check_updated():
-            if is_trade_time():
+            if clock.is_trade_time():
                 logger.warning(
                     f"contracts not updated, previous update time: {self.contracts.update_dt}"
                 )
             return False
         if not self.coming_dividends.check_updated():
-            if is_trade_time():
+            if clock.is_trade_time():
                 logger.warning(
                     f"coming_dividends not updated, previous update time: {self.coming_dividends.update_dt}"
                 )
             return False
         if not self.positions.check_updated():
-            if is_trade_time():
+            if clock.is_trade_time():
                 logger.warning(
                     f"positions not updated, previous update time: {self.positions.update_dt}"
                 )
             return False
         if not self.strategies.check_updated():
-            if is_trade_time():
+            if clock.is_trade_time():
                 logger.warning(
                     f"strategies not updated, previous update time: {self.strategies.update_dt}"
                 )
@@ -340,10 +665,15 @@ class Engine:
     def run(self):
         logger.info("Start Engine")
         self.init_timer()
-        self.sync()
+        self.load_local_cache()
+        self.recover_from_journal()
+        self.revalidating_event.set()
+        Thread(target=self.revalidate, name="revalidate", daemon=True).start()
         self.observer.start()
         self.__thread_om.start()
         self.__thread_exit_handler.start()
+        self.__thread_listener.start()
+        self.__thread_journal_consumer.start()
 
         self.active = True
         while self.active:
@@ -381,6 +711,9 @@ class Engine:
                     else:
                         logger.warning(f"Invalid event: {event}")
 
+                self.flush_order_mappings()
+                self.journal.sync()
+
             except KeyboardInterrupt:
                 self.active = False
                 self.stop()
@@ -392,10 +725,17 @@ class Engine:
     def stop(self):
         self.om_active_event.set()
         self.exit_handler_active_event.set()
+        self.listener_active_event.set()
+        self.journal_consumer_active_event.set()
         if self.__thread_om.is_alive():
             self.__thread_om.join(10)
         if self.__thread_exit_handler.is_alive():
             self.__thread_exit_handler.join(10)
+        if self.__thread_listener.is_alive():
+            self.__thread_listener.join(10)
+        if self.__thread_journal_consumer.is_alive():
+            self.__thread_journal_consumer.join(10)
+        self.journal.close()
 
     def __del__(self):
         self.stop()
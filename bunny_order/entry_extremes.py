@@ -0,0 +1,99 @@
+import datetime as dt
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+from bunny_order.models import Position
+from bunny_order.utils import logger
+
+
+def fmax(a: Optional[float], b: Optional[float]) -> Optional[float]:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+
+def fmin(a: Optional[float], b: Optional[float]) -> Optional[float]:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+class EntryExtremes:
+    """
+    Running high / low since entry of each (strategy_id, code), the only source
+    of them for the exit rules
+
+    Seeded once a day from the full positions function of the database, then
+    updated from every quote of the code, the positions of every other sync
+    come without them. An entry belongs to the first_entry_date it was
+    recorded with, a re-entered position starts over from its quotes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (strategy_id, code) -> (first_entry_date, high, low)
+        self._data: Dict[
+            Tuple[int, str], Tuple[dt.date, Optional[float], Optional[float]]
+        ] = {}
+        self.seed_date: dt.date = None
+        # incremented on every seed
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def seed(self, positions: Iterable[Position], seed_date: dt.date):
+        """replace the extremes with those of the database positions"""
+        data = {
+            (p.strategy, p.code): (
+                p.first_entry_date,
+                p.high_since_entry,
+                p.low_since_entry,
+            )
+            for p in positions
+            if p.high_since_entry is not None or p.low_since_entry is not None
+        }
+        with self.lock:
+            # keep quotes applied since the previous seed
+            for key, (first_entry_date, high, low) in self._data.items():
+                if key in data and data[key][0] == first_entry_date:
+                    data[key] = (
+                        first_entry_date,
+                        fmax(data[key][1], high),
+                        fmin(data[key][2], low),
+                    )
+            self._data = data
+            self.seed_date = seed_date
+            self.version += 1
+        logger.info(f"seed entry extremes | size: {len(data)}, date: {seed_date}")
+
+    def get(self, position: Position) -> Tuple[Optional[float], Optional[float]]:
+        """(high, low) since entry of the position, None before its first quote"""
+        value = self._data.get((position.strategy, position.code))
+        if value is None or value[0] != position.first_entry_date:
+            return None, None
+        return value[1], value[2]
+
+    def update(self, positions: Iterable[Position], high: float, low: float):
+        """apply the quote high / low of the code of positions"""
+        if not (high > 0 and low > 0):
+            # no trade yet or missing quote
+            return
+        with self.lock:
+            data = self._data
+            for position in positions:
+                key = (position.strategy, position.code)
+                value = data.get(key)
+                if value is None or value[0] != position.first_entry_date:
+                    value = (position.first_entry_date, None, None)
+                data[key] = (value[0], fmax(value[1], high), fmin(value[2], low))
+
+    def retain(self, keys: Iterable[Tuple[int, str]]):
+        """drop closed positions"""
+        keys = set(keys)
+        with self.lock:
+            self._data = {k: v for k, v in self._data.items() if k in keys}
@@ -2,4 +2,20 @@ from bunny_order.models import SF31Order
 
 class DailyTransactionAmountExceeded(Exception):
     def __init__(self, order: SF31Order):
-        super().__init__(order)
\ No newline at end of file
+        super().__init__(order)
+
+
+class DatabaseUnavailable(Exception):
+    pass
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class ExitWorkerError(Exception):
+    pass
@@ -1,13 +1,12 @@
-from typing import Dict, Deque, DefaultDict, Tuple, List
+from typing import Dict, Deque, Mapping, Tuple, List, Union
 import datetime as dt
 import pandas as pd
-from collections import defaultdict, deque
+import numpy as np
+from collections import deque
 import time
 import threading
 
 from bunny_order.models import (
-    QuoteSnapshot,
-    Strategy,
     Position,
     Signal,
     OrderType,
@@ -18,20 +17,71 @@ from bunny_order.models import (
     PriceType,
     SignalSource,
     Event,
+    Order,
+    Trade,
 )
 from bunny_order.utils import (
     get_tpe_datetime,
     get_signal_id,
     logger,
-    dump_checkpoints,
-    load_checkpoints,
-    is_trade_time,
-    is_before_market_signal_time,
-    is_signal_time,
 )
+from bunny_order.clock import clock
+from bunny_order.exit_tracker import ExitOrderTracker
+from bunny_order.entry_extremes import EntryExtremes
+from bunny_order.exit_rules import (
+    ExitBook,
+    CodeTriggers,
+    QUOTE_EXIT_TYPES,
+    quote_mask,
+    get_code_triggers,
+    evaluate_code_quotes,
+)
+from bunny_order.exit_workers import ExitWorkerPool
+from bunny_order.errors import ExitWorkerError
 from bunny_order.common import Strategies, Snapshots, Positions, Contracts, TradingDates
 from bunny_order.config import Config
 
+# versions of positions, strategies, trading dates, entry extremes and the date
+ExitBookKey = Tuple[int, int, int, int, dt.date]
+
+
+class ExitStats:
+    """metrics of the quote evaluation passes, times in ms"""
+
+    def __init__(self):
+        self.passes = 0
+        # codes received or marked for evaluation
+        self.codes = 0
+        # codes whose quote or positions changed since their last evaluation
+        self.evaluated_codes = 0
+        # positions of the evaluated codes
+        self.evaluations = 0
+        # positions whose trigger prices were crossed
+        self.candidates = 0
+        self.signals = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_evaluations = 0
+        self.last_ms = 0.0
+
+    def on_pass(self, codes: int, evaluated_codes: int, evaluations: int, ms: float):
+        self.passes += 1
+        self.codes += codes
+        self.evaluated_codes += evaluated_codes
+        self.evaluations += evaluations
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.last_evaluations = evaluations
+        self.last_ms = ms
+
+    def to_dict(self) -> dict:
+        passes = max(self.passes, 1)
+        return {
+            **self.__dict__,
+            "evaluations_per_pass": self.evaluations / passes,
+            "ms_per_pass": self.total_ms / passes,
+        }
+
 
 class ExitHandler:
     def __init__(
@@ -40,9 +90,12 @@ class ExitHandler:
         positions: Positions,
         contracts: Contracts,
         trading_dates: TradingDates,
-        q_in: Deque[Tuple[Event, Dict[str, QuoteSnapshot]]] = deque(),
+        q_in: Deque[
+            Tuple[Event, Union[Tuple[Snapshots, List[str]], Signal, Order, Trade]]
+        ] = deque(),
         q_out: Deque[Tuple[Event, Signal]] = deque(),
         active_event: threading.Event = threading.Event(),
+        workers: int = Config.EXIT_WORKERS,
     ):
         self.q_in = q_in
         self.q_out = q_out
@@ -51,19 +104,41 @@ class ExitHandler:
         self.positions = positions
         self.contracts = contracts
         self.trading_dates = trading_dates
-        self.running_signals: DefaultDict[int, List[str]] = defaultdict(list)
-        self.checkpoints_path = f"{Config.CHECKPOINTS_DIR}/exit_handler.json"
-        self.load_checkpoints()
+        self.exit_orders = ExitOrderTracker()
+        self.extremes = EntryExtremes()
         self.quote_delay_tolerance = Config.QUOTE_DELAY_TOLERANCE
+        self._exit_book: ExitBook = None
+        self._exit_book_key: ExitBookKey = None
+        self._exit_triggers: Mapping[str, CodeTriggers] = None
+        self._exit_triggers_key: Tuple[ExitBookKey, dt.date] = None
+        # exit book and date of the last out-date batch
+        self._out_date_key: Tuple[ExitBookKey, dt.date] = None
+        self._out_date_pending: List[int] = []
+        # snapshots of the last quote event, evaluated again when positions change
+        self._snapshots: Snapshots = None
+        # code -> exit rule inputs of its positions
+        self._code_keys: Dict[str, bytes] = {}
+        # code -> (dt, close) of the quote it was last evaluated with
+        self._evaluated: Dict[str, Tuple[int, float]] = {}
+        # codes whose positions or strategies changed since the last pass
+        self._changed_codes: Dict[str, None] = {}
+        self.stats = ExitStats()
+        # evaluate quotes in worker processes, started with run()
+        self.workers = (
+            ExitWorkerPool(workers, timeout=Config.EXIT_WORKER_TIMEOUT)
+            if workers > 0
+            else None
+        )
+        self._workers_restart_ts: float = None
 
     def reset(self):
-        self.running_signals.clear()
-        dump_checkpoints(self.checkpoints_path, self.running_signals)
+        self.exit_orders.reset()
+        self._out_date_key = None
+        self._out_date_pending = []
+        self._evaluated.clear()
 
-    def load_checkpoints(self):
-        data = load_checkpoints(self.checkpoints_path)
-        for key, val in data.items():
-            self.running_signals[int(key)] = val
+    def get_stats(self) -> dict:
+        return self.stats.to_dict()
 
     def send_exit_signal(self, position: Position, exit_type: ExitType):
         signal = Signal(
@@ -88,154 +163,218 @@ class ExitHandler:
             signal.price = contract.limit_up
 
         self.q_out.append((Event.Signal, signal))
-        self.running_signals[signal.strategy_id].append(signal.code)
-        dump_checkpoints(self.checkpoints_path, self.running_signals)
+        self.exit_orders.on_sent(signal)
 
-    def exit_by_out_date(self, strategy: Strategy, position: Position):
-        if self.is_running_signal(strategy.id, position.code):
-            return
-        if strategy.holding_period is None:
-            return
-        if position.first_entry_date is None:
-            return
-        # TODO: should consider holiday in business day
-        if get_tpe_datetime().date() >= self.trading_dates.get_next_n_trading_date(
-            position.first_entry_date, strategy.holding_period
-        ):
-            self.send_exit_signal(position, ExitType.ExitByOutDate)
+    def is_running_signal(self, strategy_id: int, code: str) -> bool:
+        return self.exit_orders.is_running(strategy_id, code)
 
-    def exit_by_days_profit_limit(
-        self, strategy: Strategy, position: Position, snapshot: QuoteSnapshot
-    ):
-        if self.is_running_signal(strategy.id, position.code):
-            return
-        if strategy.exit_dp_days is None or strategy.exit_dp_profit_limit is None:
-            return
-        # TODO: should consider holiday in business day
-        if get_tpe_datetime().date() >= self.trading_dates.get_next_n_trading_date(
-            position.first_entry_date, strategy.exit_dp_days
-        ):
-            if position.action == Action.Buy:
-                if (
-                    snapshot.close / position.avg_prc - 1
-                    <= strategy.exit_dp_profit_limit
-                ):
-                    self.send_exit_signal(position, ExitType.ExitByDaysProfitLimit)
-            else:
-                if (
-                    1 - snapshot.close / position.avg_prc
-                    <= strategy.exit_dp_profit_limit
-                ):
-                    self.send_exit_signal(position, ExitType.ExitByDaysProfitLimit)
+    def get_exit_book(self) -> ExitBook:
+        """
+        exit book of the current positions and strategies, the high / low since
+        entry are taken when it is built, quotes of the day are combined with
+        them on evaluation
+        """
+        key = (
+            self.positions.version,
+            self.strategies.version,
+            self.trading_dates.version,
+            self.extremes.version,
+            clock.today(),
+        )
+        if self._exit_book is None or self._exit_book_key != key:
+            self._exit_book = ExitBook.from_positions(
+                self.positions, self.strategies, self.trading_dates, self.extremes
+            )
+            self.extremes.retain(self.positions.get_position_strategy_codes())
+            self._exit_book_key = key
+        return self._exit_book
 
-    def exit_by_take_profit(
-        self, strategy: Strategy, position: Position, snapshot: QuoteSnapshot
-    ):
-        if self.is_running_signal(strategy.id, position.code):
-            return
-        if strategy.exit_take_profit is None:
-            return
+    def get_exit_triggers(self, book: ExitBook) -> Mapping[str, CodeTriggers]:
+        """trigger prices, recomputed when the exit book or the date changes"""
+        key = (self._exit_book_key, clock.today())
+        if self._exit_triggers is None or self._exit_triggers_key != key:
+            self._exit_triggers = get_code_triggers(book, clock.today())
+            self.update_code_keys(book, key)
+            self._exit_triggers_key = key
+        return self._exit_triggers
 
-        if position.action == Action.Buy:
-            if snapshot.close / position.avg_prc - 1 >= strategy.exit_take_profit:
-                self.send_exit_signal(position, ExitType.ExitByTakeProfit)
+    def update_code_keys(self, book: ExitBook, key: Tuple[ExitBookKey, dt.date]):
+        """
+        mark codes whose exit rule inputs changed, all of them on a new date or
+        when the high / low since entry are seeded
+        """
+        code_keys = book.get_code_keys()
+        prev_key = self._exit_triggers_key
+        # (exit book key, date), the 4th of the exit book key is the extremes version
+        if prev_key is None or prev_key[1] != key[1] or prev_key[0][3] != key[0][3]:
+            changed = list(code_keys)
+            self._evaluated.clear()
         else:
-            if 1 - snapshot.close / position.avg_prc >= strategy.exit_take_profit:
-                self.send_exit_signal(position, ExitType.ExitByTakeProfit)
+            changed = [
+                code
+                for code, code_key in code_keys.items()
+                if self._code_keys.get(code) != code_key
+            ]
+            for code in changed:
+                self._evaluated.pop(code, None)
+            for code in self._code_keys.keys() - code_keys.keys():
+                self._evaluated.pop(code, None)
+        self._code_keys = code_keys
+        self._changed_codes.update(dict.fromkeys(changed))
 
-    def exit_by_stop_loss(
-        self, strategy: Strategy, position: Position, snapshot: QuoteSnapshot
-    ):
-        if self.is_running_signal(strategy.id, position.code):
-            return
-        if strategy.exit_stop_loss is None:
-            return
+    def has_changed_codes(self) -> bool:
+        """whether positions or strategies changed since the last pass"""
+        self.get_exit_triggers(self.get_exit_book())
+        return bool(self._changed_codes)
 
-        if position.action == Action.Buy:
-            if snapshot.close / position.avg_prc - 1 <= strategy.exit_stop_loss:
-                self.send_exit_signal(position, ExitType.ExitByStopLoss)
+    def on_quote(self, snapshots: Snapshots, codes: List[str] = None):
+        """
+        evaluate the codes whose quote ticked or whose positions changed since
+        their last evaluation: find positions whose trigger prices are crossed
+        by the quote of their code, confirm them with the exit rules in one
+        vectorised pass, in the worker processes if started
+        codes (list): changed codes, evaluate all positions if None
+        """
+        start_ts = time.perf_counter()
+        self._snapshots = snapshots
+        book = self.get_exit_book()
+        triggers = self.get_exit_triggers(book)
+        if codes is None:
+            codes = list(book.code_rows)
         else:
-            if 1 - snapshot.close / position.avg_prc <= strategy.exit_stop_loss:
-                self.send_exit_signal(position, ExitType.ExitByStopLoss)
-
-    def exit_by_profit_pullback(
-        self, strategy: Strategy, position: Position, snapshot: QuoteSnapshot
-    ):
-        if self.is_running_signal(strategy.id, position.code):
+            codes = [
+                code
+                for code in dict.fromkeys([*codes, *self._changed_codes])
+                if code in triggers
+            ]
+        self._changed_codes.clear()
+        if not codes:
             return
-        if (
-            strategy.exit_profit_pullback_ratio is None
-            or strategy.exit_profit_pullback_threshold is None
-        ):
-            return
-
-        if position.action == Action.Buy:
-            if position.high_since_entry is None:
-                high = snapshot.high
-            else:
-                high = max(snapshot.high, position.high_since_entry)
-            max_profit_range = high / position.avg_prc - 1
-            if max_profit_range >= strategy.exit_profit_pullback_threshold:
-                profit_range = snapshot.close / position.avg_prc - 1
-                if profit_range < 0 or (
-                    1 - profit_range / max_profit_range
-                    >= strategy.exit_profit_pullback_ratio
-                ):
-                    self.send_exit_signal(position, ExitType.ExitByProfitPullback)
-        else:
-            if position.low_since_entry is None:
-                low = snapshot.low
-            else:
-                low = min(snapshot.low, position.low_since_entry)
-            max_profit_range = 1 - low / position.avg_prc
-            if max_profit_range >= strategy.exit_profit_pullback_threshold:
-                profit_range = 1 - snapshot.close / position.avg_prc
-                if profit_range < 0 or (
-                    1 - profit_range / max_profit_range
-                    >= strategy.exit_profit_pullback_ratio
-                ):
-                    self.send_exit_signal(position, ExitType.ExitByProfitPullback)
 
-    def is_running_signal(self, strategy_id: int, code: str) -> bool:
-        return (
-            strategy_id in self.running_signals
-            and code in self.running_signals[strategy_id]
+        quotes, found = snapshots.get_quote_columns(codes)
+        if not found.all():
+            logger.warning(
+                f"cannot find snapshots: {[c for c, f in zip(codes, found) if not f]}"
+            )
+        # skip quotes evaluated already
+        quote_keys = list(
+            zip(quotes["dt"].astype(np.int64).tolist(), quotes["close"].tolist())
+        )
+        evaluated = self._evaluated
+        ticked = found & np.array(
+            [evaluated.get(code) != x for code, x in zip(codes, quote_keys)],
+            dtype=bool,
+        )
+        # skip stale quotes and matching order
+        valid = np.flatnonzero(
+            ticked
+            & quote_mask(
+                clock.now(),
+                quotes["dt"],
+                quotes["volume"],
+                quotes["total_volume"],
+                self.quote_delay_tolerance,
+            )
         )
+        valid_codes = [codes[k] for k in valid.tolist()]
+        try:
+            result = None
+            if self.check_workers():
+                try:
+                    self.workers.set_book(book, self._exit_triggers_key, clock.today())
+                    result = self.workers.evaluate(
+                        valid_codes,
+                        {key: quotes[key][valid] for key in ("close", "high", "low")},
+                    )
+                except ExitWorkerError as e:
+                    self.stop_workers(e)
+            if result is not None:
+                rows, exit_types, candidates = result
+            else:
+                rows, exit_types, candidates = evaluate_code_quotes(
+                    book,
+                    triggers,
+                    valid_codes,
+                    quotes["close"][valid],
+                    quotes["high"][valid],
+                    quotes["low"][valid],
+                    clock.today(),
+                )
+            highs = quotes["high"].tolist()
+            lows = quotes["low"].tolist()
+            for k in valid.tolist():
+                evaluated[codes[k]] = quote_keys[k]
+                self.extremes.update(
+                    [book.positions[row] for row in book.code_rows[codes[k]]],
+                    highs[k],
+                    lows[k],
+                )
+            self.stats.candidates += candidates
+            self.send_quote_exits(book, rows, exit_types)
+        finally:
+            self.stats.on_pass(
+                len(codes),
+                len(valid_codes),
+                sum(len(book.code_rows[code]) for code in valid_codes),
+                (time.perf_counter() - start_ts) * 1000,
+            )
 
-    def on_quote(self, snapshots: Snapshots):
-        strategy_codes = self.positions.get_position_strategy_codes()
-        for strategy_id, code in strategy_codes:
-            if self.is_running_signal(strategy_id, code):
-                continue
-            snapshot = snapshots.get_snapshot(code)
-            if (get_tpe_datetime() - snapshot.dt).seconds > self.quote_delay_tolerance:
-                continue
-            # skip matching order
-            if snapshot.total_volume == 0:
+    def send_quote_exits(
+        self, book: ExitBook, rows: np.ndarray, exit_types: np.ndarray
+    ):
+        """send exits of rows once per (strategy, code) without a running exit"""
+        sent = set()
+        for row, exit_type in zip(rows.tolist(), exit_types.tolist()):
+            position = book.positions[row]
+            key = (position.strategy, position.code)
+            if key in sent:
                 continue
-            if snapshot.volume == 0:
+            if self.is_running_signal(*key):
+                # evaluated again on the next tick, e.g. after a reject cooldown
+                self._evaluated.pop(position.code, None)
                 continue
-            strategy = self.strategies.get_strategy(strategy_id)
-            position = self.positions.get_position(strategy_id, code)
-            self.exit_by_profit_pullback(strategy, position, snapshot)
-            self.exit_by_days_profit_limit(strategy, position, snapshot)
-            self.exit_by_take_profit(strategy, position, snapshot)
-            self.exit_by_stop_loss(strategy, position, snapshot)
+            self.send_exit_signal(position, QUOTE_EXIT_TYPES[exit_type])
+            sent.add(key)
+            self.stats.signals += 1
 
     def before_market_signals(self):
-        strategy_codes = self.positions.get_position_strategy_codes()
-        for strategy_id, code in strategy_codes:
-            if self.is_running_signal(strategy_id, code):
+        """
+        out-date exits of positions due today in one batch, produced again only
+        when positions, strategies or trading dates change, due positions with
+        a running exit are retried (e.g. after a reject cooldown)
+        """
+        book = self.get_exit_book()
+        key = (self._exit_book_key, clock.today())
+        if self._out_date_key == key:
+            if self._out_date_pending:
+                self._out_date_pending = self.send_out_date_signals(
+                    book, self._out_date_pending
+                )
+            return
+        rows = book.get_out_due_rows(clock.today()).tolist()
+        self._out_date_pending = self.send_out_date_signals(book, rows)
+        self._out_date_key = key
+        logger.info(
+            f"out date exits | due: {len(rows)}, "
+            f"signals: {len(rows) - len(self._out_date_pending)}"
+        )
+
+    def send_out_date_signals(self, book: ExitBook, rows: List[int]) -> List[int]:
+        """send out-date exits of rows, return rows with a running exit"""
+        pending = []
+        for k in rows:
+            position = book.positions[k]
+            if self.is_running_signal(position.strategy, position.code):
+                pending.append(k)
                 continue
-            strategy = self.strategies.get_strategy(strategy_id)
-            position = self.positions.get_position(strategy_id, code)
-            self.exit_by_out_date(strategy, position)
+            self.send_exit_signal(position, ExitType.ExitByOutDate)
+        return pending
 
     def system_check(self) -> bool:
-        if not is_signal_time():
+        if not clock.is_signal_time():
             return False
         if not self.trading_dates.check_updated():
-            if is_trade_time():
+            if clock.is_trade_time():
                 logger.warning(
                     f"trading_dates not updated, previous update time: {self.contracts.update_dt}"
                 )
@@ -243,45 +382,86 @@ class ExitHandler:
         if not self.trading_dates.is_trading_date():
             return False
         if not self.contracts.check_updated():
-            if is_trade_time():
+            if clock.is_trade_time():
                 logger.warning(
                     f"contracts not updated, previous update time: {self.contracts.update_dt}"
                 )
             return False
         if not self.positions.check_updated():
-            if is_trade_time():
+            if clock.is_trade_time():
                 logger.warning(
                     f"positions not updated, previous update time: {self.positions.update_dt}"
                 )
             return False
         if not self.strategies.check_updated():
-            if is_trade_time():
+            if clock.is_trade_time():
                 logger.warning(
                     f"strategies not updated, previous update time: {self.strategies.update_dt}"
                 )
             return False
         return True
 
+    def check_workers(self) -> bool:
+        """whether the workers evaluate quotes, restart them after a failure"""
+        if self.workers is None:
+            return False
+        if (
+            not self.workers.started
+            and self._workers_restart_ts is not None
+            and time.time() >= self._workers_restart_ts
+        ):
+            self._workers_restart_ts = None
+            self.workers.start()
+        return self.workers.started
+
+    def stop_workers(self, error: Exception):
+        """evaluate on this thread until the workers are restarted"""
+        logger.error(
+            f"exit workers failed, evaluate on the exit handler thread | {error}"
+        )
+        self.workers.close()
+        self._workers_restart_ts = time.time() + Config.EXIT_WORKER_RESTART_INTERVAL
+
     def run(self):
         logger.info("Start Exit Handler")
+        if self.workers is not None:
+            self.workers.start()
         while not self.active_event.isSet():
             try:
                 if not self.system_check():
                     time.sleep(10)
                     continue
 
-                if self.q_in:
+                while self.q_in:
                     event, data = self.q_in.popleft()
                     if event == Event.Quote:
-                        self.on_quote(data)
+                        snapshots, codes = data
+                        self.on_quote(snapshots, codes)
+                    elif event == Event.Signal:
+                        self.exit_orders.on_signal(data)
+                    elif event == Event.OrderCallback:
+                        self.exit_orders.on_order(data)
+                    elif event == Event.TradeCallback:
+                        self.exit_orders.on_trade(data)
                     else:
                         logger.warning(f"Invalid event: {event}")
 
-                if is_before_market_signal_time():
+                # positions or strategies changed on codes which did not tick
+                if (
+                    self._snapshots is not None
+                    and clock.is_trade_time()
+                    and self.has_changed_codes()
+                ):
+                    self.on_quote(self._snapshots, [])
+
+                if clock.is_before_market_signal_time():
                     self.before_market_signals()
 
             except Exception as e:
                 logger.exception(e)
 
             time.sleep(0.1)
+        self.exit_orders.close()
+        if self.workers is not None:
+            self.workers.close()
         logger.info("Shutdown Exit Handler")
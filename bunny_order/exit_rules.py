@@ -0,0 +1,512 @@
+"""
+Vectorised exit rules
+
+every kernel takes aligned arrays (one element per (strategy, code) row, or
+scalars) and returns a boolean mask, None parameters are NaN and never match.
+ExitHandler evaluates positions through the exit book only.
+"""
+
+import datetime as dt
+from typing import Dict, List, Mapping, NamedTuple, Tuple
+import numpy as np
+
+from bunny_order.models import Action, ExitType, Position
+from bunny_order.common import Positions, Strategies, TradingDates, freeze
+from bunny_order.utils import logger
+from bunny_order.entry_extremes import EntryExtremes
+
+# evaluation order on quote, the first matching rule exits the position
+QUOTE_EXIT_TYPES = (
+    ExitType.ExitByProfitPullback,
+    ExitType.ExitByDaysProfitLimit,
+    ExitType.ExitByTakeProfit,
+    ExitType.ExitByStopLoss,
+)
+NO_EXIT = -1
+
+
+def to_float(x) -> float:
+    return np.nan if x is None else float(x)
+
+
+def get_returns(is_long, avg_prc, close) -> np.ndarray:
+    """profit ratio of the position at close"""
+    return np.where(is_long, close / avg_prc - 1, 1 - close / avg_prc)
+
+
+def take_profit_mask(returns, take_profit) -> np.ndarray:
+    return returns >= take_profit
+
+
+def stop_loss_mask(returns, stop_loss) -> np.ndarray:
+    return returns <= stop_loss
+
+
+def days_profit_limit_mask(returns, dp_due, dp_profit_limit) -> np.ndarray:
+    return dp_due & (returns <= dp_profit_limit)
+
+
+def profit_pullback_mask(
+    is_long,
+    avg_prc,
+    close,
+    high,
+    low,
+    high_since_entry,
+    low_since_entry,
+    pullback_threshold,
+    pullback_ratio,
+) -> np.ndarray:
+    """max profit since entry reached the threshold and pulled back by the ratio"""
+    high = np.where(np.isnan(high_since_entry), high, np.fmax(high, high_since_entry))
+    low = np.where(np.isnan(low_since_entry), low, np.fmin(low, low_since_entry))
+    max_returns = np.where(is_long, high / avg_prc - 1, 1 - low / avg_prc)
+    returns = get_returns(is_long, avg_prc, close)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pullback = 1 - returns / max_returns
+    return (
+        (max_returns >= pullback_threshold)
+        & ~np.isnan(pullback_ratio)
+        & ((returns < 0) | (pullback >= pullback_ratio))
+    )
+
+
+def quote_mask(now: dt.datetime, dts, volume, total_volume, tolerance) -> np.ndarray:
+    """
+    fresh quotes with volume, staleness in timedelta.seconds as the previous
+    per-position check (days are ignored)
+    """
+    delay_us = (np.datetime64(now, "us") - dts).astype(np.int64)
+    delay_seconds = (delay_us // 1_000_000) % 86400
+    return (delay_seconds <= tolerance) & (total_volume != 0) & (volume != 0)
+
+
+def get_due_dates(
+    trading_dates: TradingDates, first_entry_dates: np.ndarray, days: np.ndarray
+) -> np.ndarray:
+    """`days` trading dates after entry, NaT when days is NaN or out of range"""
+    due_dates = np.full(len(days), np.datetime64("NaT"), dtype="datetime64[D]")
+    valid = ~np.isnan(days) & ~np.isnat(first_entry_dates)
+    if valid.any():
+        due_dates[valid] = trading_dates.get_next_n_trading_dates(
+            first_entry_dates[valid], days[valid].astype(np.int64)
+        )
+    return due_dates
+
+
+# array fields of ExitBook aligned with positions
+ROW_FIELDS = (
+    "strategy_ids",
+    "codes",
+    "is_long",
+    "avg_prc",
+    "high_since_entry",
+    "low_since_entry",
+    "dp_due_dates",
+    "exit_take_profit",
+    "exit_stop_loss",
+    "exit_dp_profit_limit",
+    "exit_profit_pullback_threshold",
+    "exit_profit_pullback_ratio",
+)
+
+
+class ExitBook(NamedTuple):
+    """positions and exit parameters of their strategies as aligned arrays"""
+
+    positions: Tuple[Position, ...]
+    strategy_ids: np.ndarray
+    codes: np.ndarray
+    is_long: np.ndarray
+    avg_prc: np.ndarray
+    high_since_entry: np.ndarray
+    low_since_entry: np.ndarray
+    # NaT when not applicable
+    dp_due_dates: np.ndarray
+    # sorted holding period due dates and their rows
+    out_due_dates: np.ndarray
+    out_due_rows: np.ndarray
+    exit_take_profit: np.ndarray
+    exit_stop_loss: np.ndarray
+    exit_dp_profit_limit: np.ndarray
+    exit_profit_pullback_threshold: np.ndarray
+    exit_profit_pullback_ratio: np.ndarray
+    # code -> rows
+    code_rows: Mapping[str, Tuple[int, ...]]
+
+    @classmethod
+    def from_positions(
+        cls,
+        positions: Positions,
+        strategies: Strategies,
+        trading_dates: TradingDates,
+        extremes: EntryExtremes = None,
+    ) -> "ExitBook":
+        """extremes (EntryExtremes): high / low since entry, of the positions if None"""
+        rows: List[Tuple[Position, object]] = []
+        for strategy_id, code in positions.get_position_strategy_codes():
+            if not strategies.exists(strategy_id):
+                logger.warning(
+                    f"cannot find strategy of position: {strategy_id}, {code}"
+                )
+                continue
+            rows.append(
+                (
+                    positions.get_position(strategy_id, code),
+                    strategies.get_strategy(strategy_id),
+                )
+            )
+        code_rows: Dict[str, List[int]] = {}
+        for k, (position, _) in enumerate(rows):
+            code_rows.setdefault(position.code, []).append(k)
+
+        first_entry_dates = np.array(
+            [p.first_entry_date for p, _ in rows], dtype="datetime64[D]"
+        )
+        dp_days = np.array([to_float(s.exit_dp_days) for _, s in rows])
+        dp_due_dates = get_due_dates(trading_dates, first_entry_dates, dp_days)
+        holding_periods = np.array([to_float(s.holding_period) for _, s in rows])
+        out_due_dates = get_due_dates(trading_dates, first_entry_dates, holding_periods)
+        for name, days, due_dates in (
+            ("exit_dp_days", dp_days, dp_due_dates),
+            ("holding_period", holding_periods, out_due_dates),
+        ):
+            # entry date or due date outside of the trading calendar
+            missing = np.flatnonzero(~np.isnan(days) & np.isnat(due_dates))
+            if len(missing):
+                keys = [
+                    (p.strategy, p.code, p.first_entry_date)
+                    for p, _ in (rows[k] for k in missing.tolist())
+                ]
+                logger.warning(
+                    f"cannot get due date of {name}, no exit by date | {keys}"
+                )
+        if extremes is None:
+            highs_lows = [(p.high_since_entry, p.low_since_entry) for p, _ in rows]
+        else:
+            highs_lows = [extremes.get(p) for p, _ in rows]
+        valid = ~np.isnat(out_due_dates)
+        # rows with a holding period by due date
+        out_due_rows = np.flatnonzero(valid)[
+            np.argsort(out_due_dates[valid], kind="stable")
+        ]
+
+        return cls(
+            positions=tuple(p for p, _ in rows),
+            strategy_ids=np.array([p.strategy for p, _ in rows], dtype=np.int64),
+            codes=np.array([p.code for p, _ in rows], dtype="U6"),
+            is_long=np.array([p.action == Action.Buy for p, _ in rows], dtype=bool),
+            avg_prc=np.array([p.avg_prc for p, _ in rows], dtype=np.float64),
+            high_since_entry=np.array([to_float(h) for h, _ in highs_lows]),
+            low_since_entry=np.array([to_float(low) for _, low in highs_lows]),
+            dp_due_dates=dp_due_dates,
+            out_due_dates=out_due_dates[out_due_rows],
+            out_due_rows=out_due_rows,
+            exit_take_profit=np.array([to_float(s.exit_take_profit) for _, s in rows]),
+            exit_stop_loss=np.array([to_float(s.exit_stop_loss) for _, s in rows]),
+            exit_dp_profit_limit=np.array(
+                [to_float(s.exit_dp_profit_limit) for _, s in rows]
+            ),
+            exit_profit_pullback_threshold=np.array(
+                [to_float(s.exit_profit_pullback_threshold) for _, s in rows]
+            ),
+            exit_profit_pullback_ratio=np.array(
+                [to_float(s.exit_profit_pullback_ratio) for _, s in rows]
+            ),
+            code_rows=freeze({code: tuple(x) for code, x in code_rows.items()}),
+        )
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __reduce__(self):
+        # mappingproxy cannot be pickled, e.g. for the exit workers
+        return load_exit_book, ({**self._asdict(), "code_rows": dict(self.code_rows)},)
+
+    def take(self, rows: np.ndarray) -> "ExitBook":
+        """book of `rows`, renumbered in the given order"""
+        local_rows = np.full(len(self), -1, dtype=np.int64)
+        local_rows[rows] = np.arange(len(rows))
+        out_due_rows = local_rows[self.out_due_rows]
+        out_due = out_due_rows >= 0
+        code_rows: Dict[str, List[int]] = {}
+        for k, code in enumerate(self.codes[rows].tolist()):
+            code_rows.setdefault(code, []).append(k)
+        # not _replace, __len__ is the number of positions
+        return type(self)(
+            positions=tuple(self.positions[k] for k in rows.tolist()),
+            out_due_dates=self.out_due_dates[out_due],
+            out_due_rows=out_due_rows[out_due],
+            code_rows=freeze({code: tuple(x) for code, x in code_rows.items()}),
+            **{field: getattr(self, field)[rows] for field in ROW_FIELDS},
+        )
+
+    def get_code_keys(self) -> Dict[str, bytes]:
+        """
+        exit rule inputs of the rows of each code, equal while none changed,
+        the high / low since entry are left out as quotes of the day move them
+        """
+        params = np.column_stack(
+            [
+                self.strategy_ids.astype(np.float64),
+                self.is_long.astype(np.float64),
+                self.avg_prc,
+                self.dp_due_dates.astype(np.int64).astype(np.float64),
+                self.exit_take_profit,
+                self.exit_stop_loss,
+                self.exit_dp_profit_limit,
+                self.exit_profit_pullback_threshold,
+                self.exit_profit_pullback_ratio,
+            ]
+        )
+        return {
+            code: params[list(rows)].tobytes() for code, rows in self.code_rows.items()
+        }
+
+    def get_out_due_rows(self, today: dt.date) -> np.ndarray:
+        """rows whose holding period ends on or before today"""
+        return self.out_due_rows[
+            : np.searchsorted(self.out_due_dates, np.datetime64(today, "D"), "right")
+        ]
+
+
+def load_exit_book(fields: dict) -> ExitBook:
+    return ExitBook(**{**fields, "code_rows": freeze(fields["code_rows"])})
+
+
+def evaluate_quote_exits(
+    book: ExitBook,
+    rows: np.ndarray,
+    quotes: Mapping[str, np.ndarray],
+    today: dt.date,
+) -> np.ndarray:
+    """
+    index in QUOTE_EXIT_TYPES of the first matching rule of each row,
+    NO_EXIT if none, quotes are aligned with rows
+    """
+    is_long = book.is_long[rows]
+    avg_prc = book.avg_prc[rows]
+    close = quotes["close"]
+    returns = get_returns(is_long, avg_prc, close)
+    masks = [
+        profit_pullback_mask(
+            is_long,
+            avg_prc,
+            close,
+            quotes["high"],
+            quotes["low"],
+            book.high_since_entry[rows],
+            book.low_since_entry[rows],
+            book.exit_profit_pullback_threshold[rows],
+            book.exit_profit_pullback_ratio[rows],
+        ),
+        days_profit_limit_mask(
+            returns,
+            np.datetime64(today, "D") >= book.dp_due_dates[rows],
+            book.exit_dp_profit_limit[rows],
+        ),
+        take_profit_mask(returns, book.exit_take_profit[rows]),
+        stop_loss_mask(returns, book.exit_stop_loss[rows]),
+    ]
+    exit_types = np.full(len(rows), NO_EXIT, dtype=np.int64)
+    # reversed so the first rule overwrites the later ones
+    for k in reversed(range(len(masks))):
+        exit_types[masks[k]] = k
+    return exit_types
+
+
+# relative margin of trigger prices, candidates are confirmed by the ratio kernels
+TRIGGER_MARGIN = 1e-9
+
+
+class CodeTriggers(NamedTuple):
+    """rows of a code sorted by trigger price"""
+
+    # exit candidates when close >= level
+    upper_levels: np.ndarray
+    upper_rows: np.ndarray
+    # exit candidates when close <= level
+    lower_levels: np.ndarray
+    lower_rows: np.ndarray
+    # pullback rows whose level moves with a new high / low of the quote
+    long_pullback_highs: np.ndarray
+    long_pullback_rows: np.ndarray
+    short_pullback_lows: np.ndarray
+    short_pullback_rows: np.ndarray
+
+
+def get_trigger_levels(book: ExitBook, today: dt.date) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (upper, lower) trigger prices of each row from avg_prc, the strategy
+    parameters and the high / low since entry, a position may exit when
+    close >= upper or close <= lower
+    """
+    a = book.avg_prc
+    is_long = book.is_long
+    dp_due = np.datetime64(today, "D") >= book.dp_due_dates
+    dp_limit = np.where(dp_due, book.exit_dp_profit_limit, np.nan)
+    threshold = book.exit_profit_pullback_threshold
+    k = 1 - book.exit_profit_pullback_ratio
+    with np.errstate(invalid="ignore"):
+        # pullback levels once activated by the high / low since entry,
+        # a non-positive threshold is always evaluated
+        hse = book.high_since_entry
+        long_pullback = np.where(
+            is_long & (hse / a - 1 >= threshold),
+            np.fmax(a, a + k * (hse - a)),
+            np.nan,
+        )
+        long_pullback[is_long & (threshold <= 0) & ~np.isnan(k)] = np.inf
+        lse = book.low_since_entry
+        short_pullback = np.where(
+            ~is_long & (1 - lse / a >= threshold),
+            np.fmin(a, a - k * (a - lse)),
+            np.nan,
+        )
+        short_pullback[~is_long & (threshold <= 0) & ~np.isnan(k)] = -np.inf
+
+    upper = np.where(
+        is_long,
+        a * (1 + book.exit_take_profit),
+        np.fmin(
+            np.fmin(a * (1 - book.exit_stop_loss), a * (1 - dp_limit)), short_pullback
+        ),
+    )
+    lower = np.where(
+        is_long,
+        np.fmax(
+            np.fmax(a * (1 + book.exit_stop_loss), a * (1 + dp_limit)), long_pullback
+        ),
+        a * (1 - book.exit_take_profit),
+    )
+    upper = np.where(np.isnan(upper), np.inf, upper * (1 - TRIGGER_MARGIN))
+    lower = np.where(np.isnan(lower), -np.inf, lower * (1 + TRIGGER_MARGIN))
+    return upper, lower
+
+
+def get_code_triggers(book: ExitBook, today: dt.date) -> Mapping[str, CodeTriggers]:
+    upper, lower = get_trigger_levels(book, today)
+    has_pullback = ~np.isnan(book.exit_profit_pullback_threshold) & ~np.isnan(
+        book.exit_profit_pullback_ratio
+    )
+    # no high / low since entry, the quote high / low always moves the level
+    highs = np.where(np.isnan(book.high_since_entry), -np.inf, book.high_since_entry)
+    lows = np.where(np.isnan(book.low_since_entry), np.inf, book.low_since_entry)
+
+    def sort_rows(levels: np.ndarray, rows: np.ndarray):
+        order = np.argsort(levels[rows], kind="stable")
+        return levels[rows][order], rows[order]
+
+    triggers = {}
+    for code, rows in book.code_rows.items():
+        rows = np.array(rows, dtype=np.int64)
+        long_rows = rows[has_pullback[rows] & book.is_long[rows]]
+        short_rows = rows[has_pullback[rows] & ~book.is_long[rows]]
+        triggers[code] = CodeTriggers(
+            *sort_rows(upper, rows[upper[rows] < np.inf]),
+            *sort_rows(lower, rows[lower[rows] > -np.inf]),
+            *sort_rows(highs, long_rows),
+            *sort_rows(lows, short_rows),
+        )
+    return freeze(triggers)
+
+
+def find_candidate_rows(
+    book: ExitBook, triggers: CodeTriggers, close: float, high: float, low: float
+) -> np.ndarray:
+    """rows of a code which may exit at the quote, a few comparisons each"""
+    rows = [
+        triggers.upper_rows[
+            : np.searchsorted(triggers.upper_levels, close, side="right")
+        ],
+        triggers.lower_rows[
+            np.searchsorted(triggers.lower_levels, close, side="left") :
+        ],
+    ]
+    # the quote makes a new high / low since entry, levels move with it
+    long_rows = triggers.long_pullback_rows[
+        : np.searchsorted(triggers.long_pullback_highs, high, side="left")
+    ]
+    if len(long_rows):
+        rows.append(
+            long_rows[
+                profit_pullback_candidates(
+                    True,
+                    book.avg_prc[long_rows],
+                    close,
+                    high,
+                    book.exit_profit_pullback_threshold[long_rows],
+                    book.exit_profit_pullback_ratio[long_rows],
+                )
+            ]
+        )
+    short_rows = triggers.short_pullback_rows[
+        np.searchsorted(triggers.short_pullback_lows, low, side="right") :
+    ]
+    if len(short_rows):
+        rows.append(
+            short_rows[
+                profit_pullback_candidates(
+                    False,
+                    book.avg_prc[short_rows],
+                    close,
+                    low,
+                    book.exit_profit_pullback_threshold[short_rows],
+                    book.exit_profit_pullback_ratio[short_rows],
+                )
+            ]
+        )
+    return np.unique(np.concatenate(rows))
+
+
+def profit_pullback_candidates(
+    is_long: bool, a, close: float, extreme: float, threshold, ratio
+) -> np.ndarray:
+    """pullback level from the quote high (long) or low (short)"""
+    k = 1 - ratio
+    if is_long:
+        activated = extreme / a - 1 >= threshold
+        hit = close <= np.fmax(a, a + k * (extreme - a)) * (1 + TRIGGER_MARGIN)
+    else:
+        activated = 1 - extreme / a >= threshold
+        hit = close >= np.fmin(a, a - k * (a - extreme)) * (1 - TRIGGER_MARGIN)
+    return (activated & hit) | (threshold <= 0)
+
+
+def evaluate_code_quotes(
+    book: ExitBook,
+    triggers: Mapping[str, CodeTriggers],
+    codes: List[str],
+    close: np.ndarray,
+    high: np.ndarray,
+    low: np.ndarray,
+    today: dt.date,
+) -> Tuple[np.ndarray, np.ndarray, int]:
+    """
+    rows with an exit at the quotes of `codes` in book order, their index in
+    QUOTE_EXIT_TYPES and the number of candidate rows, quotes are aligned
+    with codes
+    """
+    closes, highs, lows = close.tolist(), high.tolist(), low.tolist()
+    rows, quote_rows = [], []
+    for k, code in enumerate(codes):
+        candidates = find_candidate_rows(
+            book, triggers[code], closes[k], highs[k], lows[k]
+        )
+        rows.append(candidates)
+        quote_rows.append(np.full(len(candidates), k, dtype=np.int64))
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), 0
+    rows = np.concatenate(rows)
+    # positions in book order
+    order = np.argsort(rows, kind="stable")
+    rows = rows[order]
+    quote_rows = np.concatenate(quote_rows)[order]
+    exit_types = evaluate_quote_exits(
+        book,
+        rows,
+        {"close": close[quote_rows], "high": high[quote_rows], "low": low[quote_rows]},
+        today,
+    )
+    matched = exit_types != NO_EXIT
+    return rows[matched], exit_types[matched], len(rows)
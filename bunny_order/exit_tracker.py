@@ -0,0 +1,194 @@
+import os
+import time
+import threading
+from typing import Dict, Optional, Set, Tuple
+
+from bunny_order.models import (
+    ExitOrder,
+    ExitOrderState,
+    Signal,
+    Order,
+    Trade,
+)
+from bunny_order.config import Config
+from bunny_order.utils import logger, load_checkpoints
+
+ACTIVE_STATES = (ExitOrderState.Sent, ExitOrderState.Acked)
+
+
+class ExitOrderTracker:
+    """
+    State of the exit order of each (strategy_id, code)
+
+    Sent -> Acked -> Filled, or Rejected by the risk manager or the broker,
+    a rejected exit can be sent again after `reject_cooldown` seconds.
+    Every transition is appended to a jsonl file, the last line of a key wins
+    on load.
+
+    Transitions come from the exit handler thread and reset from the engine
+    thread, both hold `lock`.
+    """
+
+    def __init__(
+        self,
+        path: str = f"{Config.CHECKPOINTS_DIR}/exit_orders.jsonl",
+        reject_cooldown: float = Config.EXIT_REJECT_COOLDOWN,
+        legacy_path: str = f"{Config.CHECKPOINTS_DIR}/exit_handler.json",
+    ):
+        self.path = path
+        self.reject_cooldown = reject_cooldown
+        self.legacy_path = legacy_path
+        self.lock = threading.Lock()
+        self._orders: Dict[Tuple[int, str], ExitOrder] = {}
+        # order_id -> (strategy_id, code)
+        self._order_keys: Dict[str, Tuple[int, str]] = {}
+        dir_name = os.path.dirname(self.path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        self.load()
+        # running signals of the checkpoint written before exit orders were
+        # tracked, they stay running until the next reset
+        self._legacy_running: Set[Tuple[int, str]] = self.load_legacy()
+        self._f = open(self.path, "a", encoding="utf-8")
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    exit_order = ExitOrder.parse_raw(line)
+                except Exception:
+                    # torn write of the last line before a crash
+                    logger.warning(f"skip invalid exit order: {line}")
+                    continue
+                self._set(exit_order)
+        logger.info(f"load exit orders | size: {len(self._orders)}")
+
+    def load_legacy(self) -> Set[Tuple[int, str]]:
+        """{strategy_id: [code]} of the former exit handler checkpoint"""
+        data = load_checkpoints(self.legacy_path)
+        keys = {
+            (int(strategy_id), code)
+            for strategy_id, codes in data.items()
+            for code in codes
+        }
+        if keys:
+            logger.info(f"load legacy running signals | size: {len(keys)}")
+        return keys
+
+    def _set(self, exit_order: ExitOrder):
+        key = (exit_order.strategy_id, exit_order.code)
+        self._orders[key] = exit_order
+        for order_id in exit_order.order_ids:
+            self._order_keys[order_id] = key
+
+    def _save(self, exit_order: ExitOrder):
+        exit_order.update_ts = time.time()
+        self._set(exit_order)
+        self._f.write(exit_order.json() + "\n")
+        self._f.flush()
+
+    def __len__(self) -> int:
+        return len(self._orders)
+
+    def get(self, strategy_id: int, code: str) -> Optional[ExitOrder]:
+        return self._orders.get((strategy_id, code))
+
+    def is_running(self, strategy_id: int, code: str) -> bool:
+        if (strategy_id, code) in self._legacy_running:
+            return True
+        exit_order = self._orders.get((strategy_id, code))
+        if exit_order is None:
+            return False
+        if exit_order.state == ExitOrderState.Rejected:
+            return time.time() - exit_order.update_ts < self.reject_cooldown
+        return True
+
+    def on_sent(self, signal: Signal):
+        with self.lock:
+            self._save(
+                ExitOrder(
+                    strategy_id=signal.strategy_id,
+                    code=signal.code,
+                    signal_id=signal.id,
+                    exit_type=signal.exit_type,
+                    action=signal.action,
+                    quantity=signal.quantity,
+                    state=ExitOrderState.Sent,
+                    update_ts=time.time(),
+                )
+            )
+
+    def on_signal(self, signal: Signal):
+        """exit signal validated by the risk manager"""
+        with self.lock:
+            self._on_signal(signal)
+
+    def _on_signal(self, signal: Signal):
+        exit_order = self.get(signal.strategy_id, signal.code)
+        if exit_order is None or exit_order.signal_id != signal.id:
+            return
+        if not signal.rm_validated and exit_order.state in ACTIVE_STATES:
+            logger.warning(
+                f"exit rejected by risk manager | {signal.strategy_id}, {signal.code}, "
+                f"reason: {signal.rm_reject_reason}"
+            )
+            exit_order.state = ExitOrderState.Rejected
+            self._save(exit_order)
+
+    def on_order(self, order: Order):
+        with self.lock:
+            self._on_order(order)
+
+    def _on_order(self, order: Order):
+        exit_order = self.get(order.strategy, order.code)
+        if (
+            exit_order is None
+            or exit_order.state not in ACTIVE_STATES
+            or order.action != exit_order.action
+        ):
+            return
+        if order.order_id not in exit_order.order_ids:
+            exit_order.order_ids.append(order.order_id)
+        if order.status == "Failed":
+            logger.warning(
+                f"exit order failed | {order.strategy}, {order.code}, msg: {order.msg}"
+            )
+            exit_order.state = ExitOrderState.Rejected
+        else:
+            exit_order.state = ExitOrderState.Acked
+        self._save(exit_order)
+
+    def on_trade(self, trade: Trade):
+        with self.lock:
+            self._on_trade(trade)
+
+    def _on_trade(self, trade: Trade):
+        key = self._order_keys.get(trade.order_id)
+        if key is None:
+            return
+        exit_order = self._orders[key]
+        if trade.order_id not in exit_order.order_ids:
+            # order of a previous exit of the key
+            return
+        exit_order.filled_qty += trade.qty
+        if exit_order.filled_qty >= exit_order.quantity:
+            exit_order.state = ExitOrderState.Filled
+        self._save(exit_order)
+
+    def reset(self):
+        with self.lock:
+            self._orders.clear()
+            self._order_keys.clear()
+            self._f.close()
+            self._f = open(self.path, "w", encoding="utf-8")
+            self._legacy_running = set()
+            if os.path.exists(self.legacy_path):
+                os.remove(self.legacy_path)
+
+    def close(self):
+        with self.lock:
+            self._f.close()
@@ -0,0 +1,270 @@
+import datetime as dt
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from multiprocessing.connection import Connection
+from typing import Dict, List, Tuple
+import numpy as np
+
+from bunny_order.exit_rules import ExitBook, get_code_triggers, evaluate_code_quotes
+from bunny_order.errors import ExitWorkerError
+from bunny_order.utils import logger
+
+# close, high, low of each slot
+QUOTE_BOARD_COLUMNS = ("close", "high", "low")
+
+
+class SharedQuoteBoard:
+    """
+    quote columns in one shared memory block, slot k of every column holds the
+    quote of the k-th code of the current pass
+    """
+
+    def __init__(self, capacity: int, name: str = None):
+        create = name is None
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(
+            name=name,
+            create=create,
+            size=len(QUOTE_BOARD_COLUMNS) * capacity * 8,
+        )
+        # unlinked by the creating process, spawned workers share its
+        # resource tracker
+        self.owner = create
+        self.columns: Dict[str, np.ndarray] = dict(
+            zip(
+                QUOTE_BOARD_COLUMNS,
+                np.ndarray(
+                    (len(QUOTE_BOARD_COLUMNS), capacity),
+                    dtype=np.float64,
+                    buffer=self.shm.buf,
+                ),
+            )
+        )
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def write(self, columns: Dict[str, np.ndarray]):
+        n = len(columns["close"])
+        for key, arr in self.columns.items():
+            arr[:n] = columns[key]
+
+    def read(self, slots: np.ndarray) -> Dict[str, np.ndarray]:
+        return {key: arr[slots] for key, arr in self.columns.items()}
+
+    def close(self):
+        self.columns = {}
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def run_exit_worker(conn: Connection):
+    """
+    evaluate quotes of the codes of a partition of the exit book
+
+    messages: ("book", book, today) answered with ("ok", None), ("quotes",
+    board name, capacity, codes, slots) answered with ("ok", (rows,
+    exit_types, candidates)), either answered with ("error", message) on a
+    failure, and ("stop",)
+    """
+    board: SharedQuoteBoard = None
+    book: ExitBook = None
+    triggers = None
+    today: dt.date = None
+    while True:
+        msg = conn.recv()
+        if msg[0] == "stop":
+            break
+        try:
+            if msg[0] == "book":
+                _, book, today = msg
+                triggers = get_code_triggers(book, today)
+                conn.send(("ok", None))
+            elif msg[0] == "quotes":
+                _, board_name, capacity, codes, slots = msg
+                if board is None or board.name != board_name:
+                    # the board is replaced when it grows
+                    if board is not None:
+                        board.close()
+                    board = SharedQuoteBoard(capacity, name=board_name)
+                quotes = board.read(slots)
+                conn.send(
+                    (
+                        "ok",
+                        evaluate_code_quotes(
+                            book,
+                            triggers,
+                            codes,
+                            quotes["close"],
+                            quotes["high"],
+                            quotes["low"],
+                            today,
+                        ),
+                    )
+                )
+        except Exception as e:
+            conn.send(("error", repr(e)))
+    if board is not None:
+        board.close()
+    conn.close()
+
+
+class ExitWorkerPool:
+    """
+    exit book partitioned by code across worker processes
+
+    quotes of a pass are written once into a SharedQuoteBoard, each worker
+    evaluates the codes of its partition and returns only the rows with an
+    exit, rows are in the numbering of the full book
+
+    every message is answered within `timeout` seconds, otherwise the pipes
+    are out of sync: ExitWorkerError is raised and the pool must be closed
+    """
+
+    def __init__(self, workers: int, capacity: int = 1024, timeout: float = 5):
+        self.workers = workers
+        self.capacity = capacity
+        self.timeout = timeout
+        self.board: SharedQuoteBoard = None
+        self._processes: List[mp.Process] = []
+        self._conns: List[Connection] = []
+        # full book rows of each partition
+        self._partition_rows: List[np.ndarray] = []
+        self._code_workers: Dict[str, int] = {}
+        self._book_key = None
+
+    @property
+    def started(self) -> bool:
+        return bool(self._processes)
+
+    def start(self):
+        # the engine runs threads, do not fork them
+        ctx = mp.get_context("spawn")
+        self.board = SharedQuoteBoard(self.capacity)
+        for k in range(self.workers):
+            conn, child_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=run_exit_worker,
+                args=(child_conn,),
+                name=f"exit_worker_{k}",
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            self._processes.append(process)
+            self._conns.append(conn)
+        logger.info(f"start exit workers | workers: {self.workers}")
+
+    def set_book(self, book: ExitBook, key, today: dt.date):
+        """send each worker its partition, balanced by positions per code"""
+        if self._book_key == key:
+            return
+        loads = [0] * self.workers
+        partitions: List[List[int]] = [[] for _ in range(self.workers)]
+        self._code_workers = {}
+        for code, rows in sorted(
+            book.code_rows.items(), key=lambda x: len(x[1]), reverse=True
+        ):
+            k = loads.index(min(loads))
+            loads[k] += len(rows)
+            partitions[k].extend(rows)
+            self._code_workers[code] = k
+        self._partition_rows = []
+        for k, rows in enumerate(partitions):
+            rows = np.sort(np.array(rows, dtype=np.int64))
+            self._partition_rows.append(rows)
+            self._send(k, ("book", book.take(rows), today))
+        # read the acks, an error left unread would answer the next quotes
+        for k in range(self.workers):
+            self._recv(k)
+        self._book_key = key
+
+    def _send(self, k: int, msg: tuple):
+        try:
+            self._conns[k].send(msg)
+        except (BrokenPipeError, OSError) as e:
+            raise ExitWorkerError(f"exit_worker_{k}: {e!r}") from e
+
+    def _recv(self, k: int):
+        """result of the last message sent to worker k"""
+        try:
+            if not self._conns[k].poll(self.timeout):
+                raise ExitWorkerError(f"exit_worker_{k}: no reply in {self.timeout}s")
+            status, result = self._conns[k].recv()
+        except (EOFError, OSError) as e:
+            # the worker died
+            raise ExitWorkerError(f"exit_worker_{k}: {e!r}") from e
+        if status != "ok":
+            raise ExitWorkerError(f"exit_worker_{k}: {result}")
+        return result
+
+    def publish(self, quotes: Dict[str, np.ndarray]):
+        n = len(quotes["close"])
+        if n > self.board.capacity:
+            capacity = self.board.capacity
+            while capacity < n:
+                capacity *= 2
+            # workers are idle between passes, they attach to the new board
+            # with the next quotes
+            self.board.close()
+            self.board = SharedQuoteBoard(capacity)
+        self.board.write(quotes)
+
+    def evaluate(
+        self, codes: List[str], quotes: Dict[str, np.ndarray]
+    ) -> Tuple[np.ndarray, np.ndarray, int]:
+        """
+        rows with an exit at the quotes of `codes` in book order, their index
+        in QUOTE_EXIT_TYPES and the number of candidate rows
+        """
+        self.publish(quotes)
+        tasks: Dict[int, Tuple[List[str], List[int]]] = {}
+        for slot, code in enumerate(codes):
+            task = tasks.setdefault(self._code_workers[code], ([], []))
+            task[0].append(code)
+            task[1].append(slot)
+        for k, (task_codes, slots) in tasks.items():
+            self._send(
+                k,
+                (
+                    "quotes",
+                    self.board.name,
+                    self.board.capacity,
+                    task_codes,
+                    np.array(slots),
+                ),
+            )
+
+        rows, exit_types, candidates = [], [], 0
+        for k in tasks:
+            result = self._recv(k)
+            rows.append(self._partition_rows[k][result[0]])
+            exit_types.append(result[1])
+            candidates += result[2]
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), 0
+        rows = np.concatenate(rows)
+        order = np.argsort(rows, kind="stable")
+        return rows[order], np.concatenate(exit_types)[order], candidates
+
+    def close(self):
+        for conn in self._conns:
+            try:
+                conn.send(("stop",))
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        for conn in self._conns:
+            conn.close()
+        self._processes = []
+        self._conns = []
+        self._book_key = None
+        if self.board is not None:
+            self.board.close()
+            self.board = None
+        logger.info("shutdown exit workers")
@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import struct
+import zlib
+import threading
+from typing import Iterator, List, NamedTuple, Union
+from pydantic import BaseModel
+
+from bunny_order.models import (
+    Event,
+    Signal,
+    SF31Order,
+    Order,
+    Trade,
+    SF31Position,
+)
+from bunny_order.config import Config
+from bunny_order.utils import logger
+
+# segment header: magic, version, created ts
+SEGMENT_HEADER = struct.Struct("<4sHd")
+SEGMENT_MAGIC = b"BNYJ"
+SEGMENT_VERSION = 1
+# record header: payload length, crc32 of (length, ts, event, payload), ts, event
+RECORD_HEADER = struct.Struct("<IIdB")
+SEGMENT_SUFFIX = ".journal"
+
+# event -> payload model, PositionsCallback carries a list
+JOURNAL_MODELS = {
+    Event.Signal: Signal,
+    Event.SF31Order: SF31Order,
+    Event.OrderMapping: SF31Order,
+    Event.OrderCallback: Order,
+    Event.TradeCallback: Trade,
+    Event.PositionsCallback: SF31Position,
+}
+
+Payload = Union[BaseModel, List[BaseModel]]
+
+
+class Record(NamedTuple):
+    offset: int
+    next_offset: int
+    ts: float
+    event: Event
+    data: Payload
+
+
+def encode_payload(data: Payload) -> bytes:
+    if isinstance(data, list):
+        obj = [x.dict() for x in data]
+    else:
+        obj = data.dict()
+    # str keeps Decimal exact, dates and times as iso format
+    return json.dumps(obj, default=str, ensure_ascii=False).encode("utf-8")
+
+
+def decode_payload(event: Event, payload: bytes) -> Payload:
+    model = JOURNAL_MODELS[event]
+    obj = json.loads(payload)
+    if isinstance(obj, list):
+        return [model(**x) for x in obj]
+    return model(**obj)
+
+
+def get_crc(length: int, ts: float, event: int, payload: bytes) -> int:
+    crc = zlib.crc32(struct.pack("<IdB", length, ts, event))
+    return zlib.crc32(payload, crc)
+
+
+class Journal:
+    """
+    Append-only event journal split into segments
+
+    records are addressed by a global offset counting record bytes only,
+    a segment file is named after the offset of its first record
+    """
+
+    def __init__(
+        self,
+        journal_dir: str = Config.JOURNAL_DIR,
+        segment_size: int = Config.JOURNAL_SEGMENT_SIZE,
+        fsync_interval: float = Config.JOURNAL_FSYNC_INTERVAL,
+        fsync_batch: int = Config.JOURNAL_FSYNC_BATCH,
+    ):
+        self.journal_dir = journal_dir
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        self.lock = threading.Lock()
+        self._unsynced = 0
+        self._last_sync_ts = time.time()
+        if not os.path.exists(self.journal_dir):
+            os.makedirs(self.journal_dir)
+        self._open()
+
+    def _get_path(self, base: int) -> str:
+        return f"{self.journal_dir}/{base:020d}{SEGMENT_SUFFIX}"
+
+    def get_segments(self) -> List[int]:
+        """base offsets of segments in order"""
+        return sorted(
+            [
+                int(file[: -len(SEGMENT_SUFFIX)])
+                for file in os.listdir(self.journal_dir)
+                if file.endswith(SEGMENT_SUFFIX)
+            ]
+        )
+
+    def _open(self):
+        segments = self.get_segments()
+        if not segments:
+            self._create_segment(0)
+            return
+        base = segments[-1]
+        path = self._get_path(base)
+        if os.path.getsize(path) < SEGMENT_HEADER.size:
+            # crashed while creating the segment
+            os.remove(path)
+            self._create_segment(base)
+            return
+        valid_size = SEGMENT_HEADER.size
+        for record in self._scan(base, base, strict=False):
+            valid_size = SEGMENT_HEADER.size + record.next_offset - base
+        if os.path.getsize(path) > valid_size:
+            # torn write of the last record before a crash
+            logger.warning(
+                f"journal truncate torn tail | segment: {base}, size: {valid_size}"
+            )
+            with open(path, "r+b") as f:
+                f.truncate(valid_size)
+        self.base = base
+        self.offset = base + valid_size - SEGMENT_HEADER.size
+        self._f = open(path, "ab")
+
+    def _create_segment(self, base: int):
+        path = self._get_path(base)
+        with open(path, "wb") as f:
+            f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, time.time()))
+            f.flush()
+            os.fsync(f.fileno())
+        self.base = base
+        self.offset = base
+        self._f = open(path, "ab")
+
+    def roll(self):
+        """start a new segment"""
+        with self.lock:
+            if self.offset == self.base:
+                return
+            self._fsync()
+            self._f.close()
+            self._create_segment(self.offset)
+
+    def delete_segments(self, before_offset: int, before_ts: float) -> List[int]:
+        """
+        delete segments with every record below `before_offset` and appended
+        before `before_ts`, the current segment is kept, return their bases
+        """
+        with self.lock:
+            segments = [x for x in self.get_segments() if x < self.base]
+            deleted = []
+            for k, base in enumerate(segments):
+                # the next segment starts after the last record of this one
+                next_base = segments[k + 1] if k + 1 < len(segments) else self.base
+                if next_base > before_offset:
+                    break
+                with open(self._get_path(next_base), "rb") as f:
+                    _, _, next_created_ts = SEGMENT_HEADER.unpack(
+                        f.read(SEGMENT_HEADER.size)
+                    )
+                if next_created_ts > before_ts:
+                    break
+                os.remove(self._get_path(base))
+                deleted.append(base)
+        if deleted:
+            logger.info(f"journal delete segments | bases: {deleted}")
+        return deleted
+
+    def append(self, event: Event, data: Payload) -> int:
+        """append a record, return its offset"""
+        payload = encode_payload(data)
+        ts = time.time()
+        header = RECORD_HEADER.pack(
+            len(payload),
+            get_crc(len(payload), ts, event.value, payload),
+            ts,
+            event.value,
+        )
+        with self.lock:
+            if self.offset - self.base >= self.segment_size:
+                self._fsync()
+                self._f.close()
+                self._create_segment(self.offset)
+            offset = self.offset
+            self._f.write(header + payload)
+            # visible to readers, durable on the next fsync
+            self._f.flush()
+            self.offset += len(header) + len(payload)
+            self._unsynced += 1
+            if (
+                self._unsynced >= self.fsync_batch
+                or time.time() - self._last_sync_ts >= self.fsync_interval
+            ):
+                self._fsync()
+        return offset
+
+    def sync(self):
+        """fsync pending records once the fsync interval elapsed"""
+        if not self._unsynced:
+            return
+        with self.lock:
+            if time.time() - self._last_sync_ts >= self.fsync_interval:
+                self._fsync()
+
+    def _fsync(self):
+        if self._unsynced:
+            os.fsync(self._f.fileno())
+        self._unsynced = 0
+        self._last_sync_ts = time.time()
+
+    def close(self):
+        with self.lock:
+            self._fsync()
+            self._f.close()
+
+    def _scan(self, base: int, offset: int, strict: bool = True) -> Iterator[Record]:
+        """
+        records of segment `base` from `offset`, stop at an incomplete record,
+        a crc mismatch raises when `strict`
+        """
+        with open(self._get_path(base), "rb") as f:
+            magic, version, _ = SEGMENT_HEADER.unpack(f.read(SEGMENT_HEADER.size))
+            if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+                raise Exception(f"invalid journal segment: {base}")
+            f.seek(SEGMENT_HEADER.size + offset - base)
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                length, crc, ts, event = RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length:
+                    return
+                if crc != get_crc(length, ts, event, payload):
+                    if strict:
+                        raise Exception(f"journal crc mismatch | offset: {offset}")
+                    return
+                next_offset = offset + RECORD_HEADER.size + length
+                yield Record(
+                    offset,
+                    next_offset,
+                    ts,
+                    Event(event),
+                    decode_payload(Event(event), payload),
+                )
+                offset = next_offset
+
+    def read(self, offset: int = 0, max_records: int = 1000) -> List[Record]:
+        """records from `offset`, crossing into the following segments"""
+        segments = self.get_segments()
+        records = []
+        for k, base in enumerate(segments):
+            next_base = segments[k + 1] if k + 1 < len(segments) else None
+            if next_base is not None and next_base <= offset:
+                continue
+            for record in self._scan(base, max(offset, base)):
+                records.append(record)
+                if len(records) >= max_records:
+                    return records
+            if records:
+                offset = records[-1].next_offset
+        return records
+
+    def find_offset(self, since_ts: float) -> int:
+        """offset of the first record appended at or after `since_ts`"""
+        segments = self.get_segments()
+        start = segments[0]
+        for base in segments:
+            with open(self._get_path(base), "rb") as f:
+                _, _, created_ts = SEGMENT_HEADER.unpack(f.read(SEGMENT_HEADER.size))
+            if created_ts > since_ts:
+                break
+            start = base
+        offset = start
+        while True:
+            records = self.read(offset)
+            if not records:
+                return offset
+            for record in records:
+                if record.ts >= since_ts:
+                    return record.offset
+            offset = records[-1].next_offset
+
+
+class JournalCheckpoint:
+    """offset of a journal consumer persisted in a file"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> int:
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, "r", encoding="utf-8") as f:
+            return json.load(f)["offset"]
+
+    def save(self, offset: int):
+        with open(f"{self.path}.tmp", "w", encoding="utf-8") as f:
+            f.write(json.dumps({"offset": offset}))
+        os.replace(f"{self.path}.tmp", self.path)
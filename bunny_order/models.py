@@ -1,5 +1,5 @@
-from typing import Optional
-from pydantic import BaseModel
+from typing import List, Optional
+from pydantic import BaseModel, Field
 import datetime as dt
 from enum import Enum
 from decimal import Decimal
@@ -41,6 +41,13 @@ class ExitType(str, Enum):
     ExitByProfitPullback = "ExitByProfitPullback"
 
 
+class ExitOrderState(str, Enum):
+    Sent = "Sent"
+    Acked = "Acked"
+    Filled = "Filled"
+    Rejected = "Rejected"
+
+
 class RMRejectReason(str, Enum):
     NONE = ""
     StrategyNotFound = "StrategyNotFound"
@@ -59,6 +66,8 @@ class Event(Enum):
     PositionsCallback = 3
     Signal = 4
     Quote = 5
+    OrderMapping = 6
+    SF31Order = 8
 
 
 class Strategy(BaseModel):
@@ -147,6 +156,21 @@ class Trade(BaseModel):
     qty: int
 
 
+class ExitOrder(BaseModel):
+    """lifecycle of an exit signal of (strategy_id, code)"""
+
+    strategy_id: int
+    code: str
+    signal_id: str
+    exit_type: ExitType
+    action: Action
+    quantity: int
+    state: ExitOrderState
+    order_ids: List[str] = Field(default_factory=list)
+    filled_qty: int = 0
+    update_ts: float
+
+
 class Position(BaseModel):
     strategy: int
     code: str
@@ -176,6 +200,25 @@ class QuoteSnapshot(BaseModel):
     sell_volume: int
 
 
+# numpy dtypes of QuoteSnapshot columns
+QUOTE_SNAPSHOT_DTYPES = {
+    "dt": "datetime64[us]",
+    "code": "U6",
+    "open": "f8",
+    "high": "f8",
+    "low": "f8",
+    "close": "f8",
+    "volume": "i8",
+    "total_volume": "i8",
+    "amount": "i8",
+    "total_amount": "i8",
+    "buy_price": "f8",
+    "buy_volume": "i8",
+    "sell_price": "f8",
+    "sell_volume": "i8",
+}
+
+
 class SF31Position(BaseModel):
     trader_id: str
     ptime: dt.time
@@ -18,22 +18,22 @@ from bunny_order.models import (
     SecurityType,
     Contract,
 )
-from bunny_order.database.data_manager import DataManager
+from bunny_order.journal import Journal
 from bunny_order.utils import (
     logger,
     adjust_price_for_tick_unit,
     get_tpe_datetime,
-    is_trade_time,
     get_seqno,
     get_order_id,
 )
+from bunny_order.clock import clock
 from bunny_order.common import Strategies, Contracts, TradingDates
 from bunny_order.config import Config
 
 
 class SignalCollector:
-    def __init__(self, dm: DataManager, contracts: Contracts):
-        self.dm = dm
+    def __init__(self, journal: Journal, contracts: Contracts):
+        self.journal = journal
         self.contracts = contracts
         self.collector: Dict[str, Dict[Action, List[Signal]]] = {}
         self.__last_ts = 0
@@ -88,7 +88,7 @@ class SignalCollector:
         self._signals.extend(sell_signals)
 
     def check_signals(self) -> bool:
-        if get_tpe_datetime().time() < dt.time(hour=9, minute=0, second=0):
+        if clock.now().time() < dt.time(hour=9, minute=0, second=0):
             offset_interval = 60
         elif Config.DEBUG:
             offset_interval = 5
@@ -132,13 +132,14 @@ class SignalCollector:
             quantity=signal.quantity,
             price=signal.price,
         )
-        self.dm.save_sf31_order(order)
+        # persisted in order by the journal consumer
+        self.journal.append(Event.SF31Order, order)
         order_cb = self._mock_order_callback(order)
-        self.dm.save_order(order_cb)
+        self.journal.append(Event.OrderCallback, order_cb)
         order.order_id = order_cb.order_id
-        self.dm.update_sf31_order(order)
+        self.journal.append(Event.OrderMapping, order)
         trade_cb = self._mock_trade_callback(order_cb)
-        self.dm.save_trade(trade_cb)
+        self.journal.append(Event.TradeCallback, trade_cb)
 
     def _mock_order_callback(self, order: SF31Order) -> Order:
         order_time = (
@@ -187,6 +188,7 @@ class OrderManager:
         strategies: Strategies,
         contracts: Contracts,
         trading_dates: TradingDates,
+        journal: Journal,
         unhandled_orders: Deque[SF31Order] = deque(),
         q_in: Deque[Tuple[Event, Union[Signal, Order, Trade]]] = deque(),
         active_event: threading.Event = threading.Event(),
@@ -196,14 +198,17 @@ class OrderManager:
         self.contracts = contracts
         self.trading_dates = trading_dates
         self.unhandled_orders = unhandled_orders
-        self.dm = DataManager()
+        # sf31 orders are journaled, Postgres is fed by the journal consumer
+        self.journal = journal
         self.s31_orders_dir = (
             f"{Config.OBSERVER_BASE_PATH}/{Config.OBSERVER_SF31_ORDERS_DIR}"
         )
         self.pause_order = False
         self.active_event = active_event
         self.pending_signals: Deque[Signal] = deque()
-        self.signal_collector = SignalCollector(dm=self.dm, contracts=self.contracts)
+        self.signal_collector = SignalCollector(
+            journal=self.journal, contracts=self.contracts
+        )
 
     def reset(self):
         self.unhandled_orders.clear()
@@ -238,7 +243,7 @@ class OrderManager:
         )
         with open(path, "a") as f:
             f.write(order_string)
-        self.dm.save_sf31_order(order)
+        self.journal.append(Event.SF31Order, order)
 
     def cancel_order(self, order: SF31Order):
         pass
@@ -322,10 +327,10 @@ class OrderManager:
         logger.info(trade)
 
     def system_check(self) -> bool:
-        if not is_trade_time():
+        if not clock.is_trade_time():
             return False
         if not self.trading_dates.check_updated():
-            if is_trade_time():
+            if clock.is_trade_time():
                 logger.warning(
                     f"trading_dates not updated, previous update time: {self.contracts.update_dt}"
                 )
@@ -333,13 +338,13 @@ class OrderManager:
         if not self.trading_dates.is_trading_date():
             return False
         if not self.contracts.check_updated():
-            if is_trade_time():
+            if clock.is_trade_time():
                 logger.warning(
                     f"contracts not updated, previous update time: {self.contracts.update_dt}"
                 )
             return False
         if not self.strategies.check_updated():
-            if is_trade_time():
+            if clock.is_trade_time():
                 logger.warning(
                     f"strategies not updated, previous update time: {self.strategies.update_dt}"
                 )
@@ -22,7 +22,6 @@ from bunny_order.utils import (
     get_signal_id,
     dump_checkpoints,
     load_checkpoints,
-    ReadWriteLock,
 )
 from bunny_order.models import (
     Signal,
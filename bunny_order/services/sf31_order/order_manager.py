@@ -6,6 +6,8 @@ import json
 import datetime as dt
 from typing import Dict, Tuple, DefaultDict, List, Callable, Deque
 from collections import defaultdict, deque
+import threading
+from threading import Thread
 import pandas as pd
 from watchdog.observers import Observer
 from watchdog.events import (
@@ -19,6 +21,7 @@ import datetime as dt
 
 
 from bunny_order.database.data_manager import DataManager
+from bunny_order.database.listener import TSDBListener
 from bunny_order.config import Config
 from bunny_order.utils import logger, get_tpe_datetime, event_wrapper
 from bunny_order.models import (
@@ -253,15 +256,63 @@ class OrderManager:
             OrderEventHandler(self.strategies, sf31_orders_path), sf31_orders_path, True
         )
 
+        self.q_listener_out: Deque[Tuple[str, str, float]] = deque()
+        self.listener_active_event = threading.Event()
+        self.listener = TSDBListener(
+            host=Config.DB_HOST,
+            port=Config.DB_PORT,
+            user=Config.DB_USER,
+            password=Config.DB_PASSWORD,
+            db=Config.DB_DATABASE,
+            channels=[Config.LISTENER_STRATEGY_CHANNEL],
+            q_out=self.q_listener_out,
+            active_event=self.listener_active_event,
+        )
+        self.__thread_listener = Thread(target=self.listener.run, name="listener")
+        self.__thread_listener.setDaemon(True)
+        self.fallback_sync_interval = Config.LISTENER_FALLBACK_SYNC_INTERVAL
+
+    def on_notifications(self):
+        if not self.q_listener_out:
+            return
+        channel, payload, received_ts = self.q_listener_out.popleft()
+        self.q_listener_out.clear()
+        self.strategies.update(self.dm.get_strategies())
+        self.listener.record_latency(channel, payload, received_ts)
+
     def _del__(self):
         self.observer.stop()
 
     def run(self):
         self.observer.start()
+        self.__thread_listener.start()
         logger.info("start")
         prev_update_ts = 0
-        while True:
-            if time.time() - prev_update_ts > 10:
-                self.strategies.update(self.dm.get_strategies())
-                prev_update_ts = time.time()
-            time.sleep(1)
+        prev_poll_ts = 0
+        self.active = True
+        while self.active:
+            try:
+                self.on_notifications()
+                if time.time() - prev_update_ts > 10:
+                    # changes are pushed while the listener is healthy and the
+                    # trigger is installed, poll slowly as fallback
+                    if (
+                        self.listener.is_pushed(Config.LISTENER_STRATEGY_CHANNEL)
+                        and time.time() - prev_poll_ts < self.fallback_sync_interval
+                    ):
+                        self.strategies.touch()
+                    else:
+                        self.strategies.update(self.dm.get_strategies())
+                        prev_poll_ts = time.time()
+                    prev_update_ts = time.time()
+                time.sleep(1)
+            except KeyboardInterrupt:
+                self.active = False
+                self.stop()
+
+    def stop(self):
+        self.listener_active_event.set()
+        if self.__thread_listener.is_alive():
+            self.__thread_listener.join(10)
+        self.observer.stop()
+        logger.info("shutdown")
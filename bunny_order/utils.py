@@ -4,12 +4,14 @@ from loguru import logger
 from datetime import datetime, timedelta
 import datetime as dt
 import threading
+import time
 from functools import wraps
 from decimal import Decimal, ROUND_HALF_UP
 import json
 import uuid
 
 from bunny_order.config import Config
+from bunny_order.errors import LockTimeout
 
 
 if not os.path.exists(Config.LOGURU_SINK_DIR):
@@ -130,44 +132,75 @@ def get_next_schedule_time(dtime: dt.time) -> dt.datetime:
     return next_dt
 
 
-class ReadWriteLock:
-    """A lock object that allows many simultaneous "read locks", but
-    only one "write lock." """
+class LockStats:
+    """contention metrics of a WriteLock, times in ms"""
 
     def __init__(self):
-        self._read_ready = threading.Condition(threading.Lock())
-        self._readers = 0
-
-    def acquire_read(self):
-        """Acquire a read lock. Blocks only if a thread has
-        acquired the write lock."""
-        self._read_ready.acquire()
-        try:
-            self._readers += 1
-        finally:
-            self._read_ready.release()
-
-    def release_read(self):
-        """Release a read lock."""
-        self._read_ready.acquire()
-        try:
-            self._readers -= 1
-            if not self._readers:
-                self._read_ready.notifyAll()
-        finally:
-            self._read_ready.release()
-
-    def acquire_write(self):
-        """Acquire a write lock. Blocks until there are no
-        acquired read or write locks."""
-        self._read_ready.acquire()
-        counter = 0
-        while self._readers > 0:
-            self._read_ready.wait(10)
-            counter += 1
-            if counter > 5:
-                logger.error("lock not release")
+        self.writes = 0
+        self.timeouts = 0
+        self.write_wait_ms = 0.0
+        self.max_write_wait_ms = 0.0
+        self.write_hold_ms = 0.0
+        self.max_write_hold_ms = 0.0
+        self.max_waiters = 0
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+
+class WriteLock:
+    """A lock serializing the writers of a copy-on-write cache, readers use
+    the published data without locking.
+
+    Acquiring longer than `timeout` seconds raises LockTimeout."""
+
+    def __init__(self, name: str = "", timeout: float = Config.LOCK_TIMEOUT):
+        self.name = name
+        self.timeout = timeout
+        self._cond = threading.Condition(threading.Lock())
+        self._writer = False
+        self._waiters = 0
+        self._write_ts = 0.0
+        self.stats = LockStats()
+
+    def acquire_write(self, timeout: float = None):
+        """Acquire the write lock. Blocks while another thread holds it."""
+        timeout = self.timeout if timeout is None else timeout
+        with self._cond:
+            wait_ms = 0.0
+            if self._writer:
+                start_ts = time.perf_counter()
+                self._waiters += 1
+                self.stats.max_waiters = max(self.stats.max_waiters, self._waiters)
+                try:
+                    if not self._cond.wait_for(lambda: not self._writer, timeout):
+                        self.stats.timeouts += 1
+                        raise LockTimeout(
+                            f"write lock timeout | lock: {self.name}, "
+                            f"timeout: {timeout}s"
+                        )
+                finally:
+                    self._waiters -= 1
+                wait_ms = (time.perf_counter() - start_ts) * 1000
+            self._writer = True
+            self._write_ts = time.perf_counter()
+            self.stats.writes += 1
+            self.stats.write_wait_ms += wait_ms
+            self.stats.max_write_wait_ms = max(self.stats.max_write_wait_ms, wait_ms)
 
     def release_write(self):
-        """Release a write lock."""
-        self._read_ready.release()
+        """Release the write lock."""
+        with self._cond:
+            hold_ms = (time.perf_counter() - self._write_ts) * 1000
+            self.stats.write_hold_ms += hold_ms
+            self.stats.max_write_hold_ms = max(self.stats.max_write_hold_ms, hold_ms)
+            self._writer = False
+            self._cond.notify()
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            return {
+                "name": self.name,
+                **self.stats.to_dict(),
+                "waiters": self._waiters,
+            }
@@ -0,0 +1,32 @@
+-- NOTIFY channels consumed by bunny_order.database.listener.TSDBListener
+-- payload: {"table": ..., "op": ..., "ts": <epoch seconds>}
+
+create or replace function dealer.fn_notify_change() returns trigger as $$
+begin
+    perform pg_notify(
+        TG_ARGV[0],
+        json_build_object(
+            'table', TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME,
+            'op', TG_OP,
+            'ts', extract(epoch from clock_timestamp())
+        )::text
+    );
+    return null;
+end;
+$$ language plpgsql;
+
+drop trigger if exists tg_strategy_notify on dealer.strategy;
+create trigger tg_strategy_notify
+    after insert or update or delete on dealer.strategy
+    for each statement execute function dealer.fn_notify_change('strategy_changed');
+
+-- positions are derived from trades by dealer.ft_get_positions_order_manager()
+drop trigger if exists tg_trades_notify on dealer.trades;
+create trigger tg_trades_notify
+    after insert or update or delete on dealer.trades
+    for each statement execute function dealer.fn_notify_change('positions_changed');
+
+drop trigger if exists tg_contracts_notify on sino.contracts;
+create trigger tg_contracts_notify
+    after insert or update or delete on sino.contracts
+    for each statement execute function dealer.fn_notify_change('contracts_changed');
@@ -0,0 +1,77 @@
+-- positions without high / low since entry, read by DataManager.get_positions
+-- and get_position_changes on every position sync
+-- the exit handler seeds high / low since entry once a day from
+-- dealer.ft_get_positions_order_manager() and tracks them from quotes after,
+-- this function reads dealer.trades only and never touches the quotes
+--
+-- a position is the trades of (strategy, code) after its net quantity was last
+-- flat, at the average price of its entry trades; the columns must match those
+-- of dealer.ft_get_positions_order_manager()
+
+create or replace function dealer.ft_get_positions_order_manager_lite()
+returns table (
+    strategy integer,
+    code text,
+    action text,
+    qty integer,
+    cost_amt double precision,
+    avg_prc double precision,
+    first_entry_date date
+) as $$
+    with signed_trades as (
+        select
+            t.strategy,
+            t.code,
+            t.trade_date,
+            t.price::double precision as price,
+            case when t.action = 'B' then t.qty else -t.qty end as qty,
+            row_number() over w as n,
+            sum(case when t.action = 'B' then t.qty else -t.qty end) over w as net_qty
+        from dealer.trades as t
+        window w as (
+            partition by t.strategy, t.code
+            order by t.trade_date, t.trade_time, t.seqno
+        )
+    ),
+    flat as (
+        select
+            strategy,
+            code,
+            coalesce(max(n) filter (where net_qty = 0), 0) as flat_n,
+            max(n) as last_n
+        from signed_trades
+        group by strategy, code
+    ),
+    -- trades of the open position, the first one sets its side
+    open_trades as (
+        select
+            t.*,
+            first_value(t.qty > 0) over (
+                partition by t.strategy, t.code order by t.n
+            ) as is_long
+        from signed_trades as t
+        join flat as f on f.strategy = t.strategy and f.code = t.code
+        where t.n > f.flat_n and f.flat_n < f.last_n
+    ),
+    positions as (
+        select
+            strategy,
+            code,
+            bool_and(is_long) as is_long,
+            abs(sum(qty)) as qty,
+            sum(price * abs(qty)) filter (where (qty > 0) = is_long)
+                / sum(abs(qty)) filter (where (qty > 0) = is_long) as avg_prc,
+            min(trade_date) as first_entry_date
+        from open_trades
+        group by strategy, code
+    )
+    select
+        p.strategy,
+        p.code::text,
+        case when p.is_long then 'B' else 'S' end,
+        p.qty::integer,
+        p.avg_prc * p.qty,
+        p.avg_prc,
+        p.first_entry_date
+    from positions as p;
+$$ language sql stable;
@@ -0,0 +1,55 @@
+import datetime as dt
+
+from bunny_order.clock import SessionClock, SessionPhase
+
+
+class FakeTime:
+    def __init__(self, now: dt.datetime):
+        self.now = now
+        self.calls = 0
+
+    def __call__(self) -> dt.datetime:
+        self.calls += 1
+        return self.now
+
+
+def test_session_phase():
+    source = FakeTime(dt.datetime(2023, 5, 29, 7, 0))
+    clock = SessionClock(time_source=source, resolution=0, debug=False)
+    assert clock.phase() == SessionPhase.PreSync
+    assert not clock.is_sync_time()
+    assert not clock.is_trade_time()
+
+    source.now = dt.datetime(2023, 5, 29, 8, 30)
+    assert clock.phase() == SessionPhase.PreMarket
+    assert clock.is_sync_time()
+    assert clock.is_signal_time()
+    assert clock.is_before_market_signal_time()
+    assert not clock.is_trade_time()
+
+    source.now = dt.datetime(2023, 5, 29, 10, 0)
+    assert clock.phase() == SessionPhase.Trading
+    assert clock.is_trade_time()
+    assert not clock.is_before_market_signal_time()
+
+    source.now = dt.datetime(2023, 5, 29, 14, 45)
+    assert clock.phase() == SessionPhase.PostTrade
+    assert not clock.is_trade_time()
+
+    source.now = dt.datetime(2023, 5, 27, 10, 0)
+    assert clock.phase() == SessionPhase.Closed
+    assert not clock.is_week_date()
+
+
+def test_cached_now():
+    source = FakeTime(dt.datetime(2023, 5, 29, 10, 0))
+    clock = SessionClock(time_source=source, resolution=60, debug=False)
+    now = clock.now()
+    source.now = dt.datetime(2023, 5, 29, 10, 1)
+    assert clock.now() == now
+    assert clock.is_trade_time()
+    assert source.calls == 1
+
+    clock.invalidate()
+    assert clock.now() == dt.datetime(2023, 5, 29, 10, 1)
+    assert source.calls == 2
@@ -0,0 +1,258 @@
+import pytest
+import datetime
+import numpy as np
+from pytest_mock import MockerFixture
+
+from decimal import Decimal
+
+from bunny_order.models import Position, Action, Trade, OrderType, SecurityType
+from bunny_order.common import (
+    Positions,
+    Snapshots,
+    ColumnarSnapshots,
+    Strategies,
+    TradingDates,
+)
+from bunny_order.config import Config
+
+
+def test_positions_apply_changes(positions: Positions):
+    position = Position(
+        strategy=1,
+        code="2836",
+        action=Action.Buy,
+        qty=5,
+        cost_amt=62000.0,
+        avg_prc=12.4,
+        first_entry_date=datetime.date(2023, 5, 25),
+        low_since_entry=12.4,
+        high_since_entry=12.4,
+    )
+    positions.apply_changes({1: {"2836": position}}, removed=[(2, "8048"), (6, "5243")])
+
+    assert positions.get_position(1, "2836").qty == 5
+    assert positions.exists(1, "2882")
+    assert not positions.exists(2, "8048")
+    assert positions.exists(2, "8446")
+    assert not positions.exists(6, "5243")
+    assert (6, "5243") not in positions.get_position_strategy_codes()
+
+
+def test_columnar_snapshots(snapshots: Snapshots):
+    columnar_snapshots = ColumnarSnapshots()
+    columnar_snapshots.update(snapshots._data)
+
+    columns = columnar_snapshots.get_columns()
+    assert columns["close"].dtype == np.float64
+    assert columns["volume"].dtype == np.int64
+    for code, snapshot in snapshots._data.items():
+        assert columnar_snapshots.get_snapshot(code) == snapshot
+    with pytest.raises(Exception):
+        columnar_snapshots.get_snapshot("0000")
+
+
+def test_columnar_snapshots_apply_columns(snapshots: Snapshots):
+    columnar_snapshots = ColumnarSnapshots()
+    columnar_snapshots.update(snapshots._data)
+    watermarks = columnar_snapshots.get_watermarks()
+    assert watermarks["2882"] == datetime.datetime(2023, 5, 26, 14, 30)
+
+    changed = snapshots._data["2882"].copy(
+        update={"dt": datetime.datetime(2023, 5, 26, 14, 30, 5), "close": 44.0}
+    )
+    added = snapshots._data["2836"].copy(update={"code": "2330"})
+    source = ColumnarSnapshots()
+    source.update({"2882": changed, "2330": added})
+
+    changed_codes = columnar_snapshots.apply_columns(source.get_columns())
+
+    assert changed_codes == ["2882", "2330"]
+    assert columnar_snapshots.get_snapshot("2882") == changed
+    assert columnar_snapshots.get_snapshot("2330") == added
+    assert columnar_snapshots.get_snapshot("8446") == snapshots._data["8446"]
+
+
+def test_columnar_snapshots_in_place(snapshots: Snapshots):
+    columnar_snapshots = ColumnarSnapshots(capacity=2)
+    columnar_snapshots.update(snapshots._data)
+    # grown to fit every code
+    assert columnar_snapshots.capacity >= len(snapshots._data)
+
+    columns = columnar_snapshots.get_columns()
+    with pytest.raises(ValueError):
+        columns["close"][0] = 0.0
+    k = columns["code"].tolist().index("2882")
+    changed = snapshots._data["2882"].copy(
+        update={"dt": datetime.datetime(2023, 5, 26, 14, 30, 5), "close": 44.0}
+    )
+    source = ColumnarSnapshots()
+    source.update({"2882": changed})
+    board = columnar_snapshots._board
+    columnar_snapshots.apply_columns(source.get_columns())
+
+    # written in place, views see the update
+    assert columnar_snapshots._board is board
+    assert columns["close"][k] == 44.0
+    assert columnar_snapshots._seq % 2 == 0
+
+
+def test_positions_copy_on_write(positions: Positions):
+    data = positions._data
+    version = positions.version
+    with pytest.raises(TypeError):
+        data[1]["2882"] = None
+
+    positions.apply_changes({}, removed=[(1, "2882")])
+
+    # readers holding the previous version are not affected
+    assert "2882" in data[1]
+    assert not positions.exists(1, "2882")
+    assert positions.version == version + 1
+    # unchanged strategies are shared between versions
+    assert positions._data[2] is data[2]
+
+    # an empty delta or unchanged positions publish nothing
+    index = positions._index
+    positions.apply_changes({}, [])
+    positions.apply_changes({2: dict(positions._data[2])})
+    positions.update({k: dict(v) for k, v in positions._data.items()})
+    assert positions._index is index
+    assert positions.version == version + 1
+
+
+def test_trading_dates_offsets(trading_dates: TradingDates, mocker: MockerFixture):
+    mocker.patch.object(trading_dates, "_check_updated")
+    mocker.patch.object(Config, "DEBUG", False)
+    bench_dates = [
+        datetime.date(2023, 5, 23),
+        datetime.date(2023, 5, 26),
+        datetime.date(2023, 6, 21),
+        datetime.date(2023, 7, 5),
+    ]
+    assert trading_dates.get_next_n_trading_date(
+        datetime.date(2023, 5, 26), 1
+    ) == datetime.date(2023, 5, 29)
+    with pytest.raises(Exception):
+        trading_dates.get_next_n_trading_date(datetime.date(2023, 5, 27), 1)
+
+    result = trading_dates.get_next_n_trading_dates(bench_dates + ["2023-05-27"], 1)
+    expected = [
+        trading_dates.get_next_n_trading_date(x, 1) for x in bench_dates[:3]
+    ] + [None, None]
+    assert result.tolist() == expected
+
+    # offsets per date
+    result = trading_dates.get_next_n_trading_dates(bench_dates, [0, 5, 1, -1])
+    assert result.tolist() == [
+        datetime.date(2023, 5, 23),
+        datetime.date(2023, 6, 2),
+        datetime.date(2023, 6, 26),
+        datetime.date(2023, 7, 4),
+    ]
+
+
+def test_trading_dates_offsets_debug(
+    trading_dates: TradingDates, mocker: MockerFixture
+):
+    mocker.patch.object(trading_dates, "_check_updated")
+    mocker.patch.object(Config, "DEBUG", True)
+    # non trading dates roll back to the previous trading date
+    assert trading_dates.get_next_n_trading_date(
+        datetime.date(2023, 5, 27), 1
+    ) == datetime.date(2023, 5, 29)
+    result = trading_dates.get_next_n_trading_dates(["2023-05-27", "2023-05-01"], 1)
+    assert result.tolist() == [datetime.date(2023, 5, 29), None]
+
+
+def test_positions_index(positions: Positions):
+    codes = positions.get_position_codes()
+    assert len(codes) == len(set(codes))
+    assert set(codes) == {code for _, code in positions.get_position_strategy_codes()}
+    for strategy_id, code in positions.get_position_strategy_codes():
+        assert strategy_id in positions.get_code_strategies(code)
+    assert positions.get_code_strategies("0000") == ()
+
+    # cached until positions change
+    assert positions.get_position_codes() is codes
+    positions.apply_changes({}, removed=[(1, "2882")])
+    assert 1 not in positions.get_code_strategies("2882")
+    assert positions.get_position_codes() is not codes
+
+
+def get_trade(code: str, action: Action, price: str, qty: int) -> Trade:
+    return Trade(
+        trader_id="0",
+        strategy=1,
+        order_id="A0001",
+        order_type=OrderType.ROD,
+        seqno="1",
+        security_type=SecurityType.Stock,
+        trade_date=datetime.date(2023, 5, 30),
+        trade_time=datetime.time(9, 30),
+        code=code,
+        action=action,
+        price=Decimal(price),
+        qty=qty,
+    )
+
+
+def test_positions_apply_trade(positions: Positions):
+    # add to a position
+    position = positions.apply_trade(get_trade("2836", Action.Buy, "13.4", 2), 0)
+    assert position.qty == 5
+    assert position.cost_amt == pytest.approx(37200.0 + 26800.0)
+    assert position.avg_prc == pytest.approx(64000.0 / 5000)
+    assert position.high_since_entry == pytest.approx(13.4)
+    assert positions.get_position(1, "2836") is position
+
+    # reduce keeps the average price
+    position = positions.apply_trade(get_trade("2836", Action.Sell, "12.0", 1), 10)
+    assert position.qty == 4
+    assert position.avg_prc == pytest.approx(12.8)
+    assert position.low_since_entry == pytest.approx(12.0)
+
+    # close
+    assert positions.apply_trade(get_trade("2836", Action.Sell, "12.0", 4), 20) is None
+    assert not positions.exists(1, "2836")
+    assert "2836" not in positions.get_position_codes()
+
+    # open
+    position = positions.apply_trade(get_trade("1101", Action.Sell, "40", 2), 30)
+    assert position.action == Action.Sell
+    assert position.first_entry_date == datetime.date(2023, 5, 30)
+    assert positions.get_code_strategies("1101") == (1,)
+
+
+def test_positions_reconcile_trades(positions: Positions):
+    positions.apply_trade(get_trade("2836", Action.Buy, "12.4", 2), 0)
+    positions.apply_trade(get_trade("2882", Action.Sell, "43.5", 12), 10)
+    assert positions.get_position(1, "2836").qty == 5
+    assert not positions.exists(1, "2882")
+
+    # the DB has the first trade only, the second is re-applied
+    snapshot = positions.get_position(1, "2836")
+    positions.apply_changes({1: {"2836": snapshot}}, persisted_offset=10)
+    assert positions.get_position(1, "2836").qty == 5
+    assert not positions.exists(1, "2882")
+    assert [offset for offset, _ in positions.get_pending_trades()] == [10]
+
+    # full snapshot without the second trade
+    stale = snapshot.copy(update={"code": "2882", "qty": 12})
+    positions.update({1: {"2836": snapshot, "2882": stale}}, persisted_offset=10)
+    assert positions.get_position(1, "2836").qty == 5
+    assert not positions.exists(1, "2882")
+
+    # both trades persisted
+    positions.update({1: {"2836": snapshot}}, persisted_offset=20)
+    assert positions.get_pending_trades() == []
+    assert positions.get_position(1, "2836").qty == 5
+
+
+def test_strategies_identical_reload(strategies: Strategies):
+    version = strategies.version
+    strategies.update(dict(strategies._data))
+    assert strategies.version == version
+
+    strategy = strategies.get_strategy(1).copy(update={"holding_period": 99})
+    strategies.update({**strategies._data, 1: strategy})
+    assert strategies.version == version + 1
@@ -0,0 +1,184 @@
+import datetime
+from decimal import Decimal
+import psycopg2
+import pytest
+from pytest_mock import MockerFixture
+
+from bunny_order.database.data_manager import DataManager
+from bunny_order.models import (
+    SF31Order,
+    SecurityType,
+    OrderType,
+    PriceType,
+    Action,
+)
+from bunny_order.config import Config
+from bunny_order.errors import DatabaseUnavailable
+
+
+@pytest.fixture()
+def dm(mocker: MockerFixture) -> DataManager:
+    conn = mocker.MagicMock()
+    conn.closed = 0
+    mocker.patch("psycopg2.connect", return_value=conn)
+    dm = DataManager()
+    dm.simulation = False
+    return dm
+
+
+def test_circuit_breaker(dm: DataManager, mocker: MockerFixture):
+    dm.cli.reconnect_backoff_initial = 0.01
+    connect = mocker.patch("psycopg2.connect")
+    connect.side_effect = psycopg2.OperationalError("connection refused")
+    dm.cli.conn.closed = 2
+
+    with pytest.raises(DatabaseUnavailable):
+        dm.cli.execute_query("select 1")
+    assert dm.is_degraded()
+    # fail fast while the breaker is open
+    with pytest.raises(DatabaseUnavailable):
+        dm.cli.execute_query("select 1")
+
+    conn = mocker.MagicMock()
+    conn.closed = 0
+    connect.side_effect = None
+    connect.return_value = conn
+    dm.cli._reconnect_thread.join(1)
+    assert not dm.is_degraded()
+    assert connect.call_count >= 2
+
+
+def test_degraded_reads_and_writes(dm: DataManager, mocker: MockerFixture):
+    mocker.patch.object(dm.cli, "execute_query", return_value=[])
+    assert dm.get_strategies() == {}
+    read_dt = dm.get_read_dt("get_strategies")
+    assert read_dt is not None
+
+    mocker.patch.object(
+        dm.cli, "execute_query", side_effect=DatabaseUnavailable("open")
+    )
+    mocker.patch.object(dm.cli, "stream_query", side_effect=DatabaseUnavailable("open"))
+    # last result served, incremental reads report no changes
+    assert dm.get_strategies() == {}
+    assert dm.get_contract_changes(since=datetime.date(2023, 5, 26)) == {}
+    # the cached result keeps its read time, no changes have none
+    assert dm.get_read_dt("get_strategies") == read_dt
+    assert dm.get_read_dt("get_contract_changes") is None
+    with pytest.raises(DatabaseUnavailable):
+        dm.get_coming_dividends()
+
+    m_save_one = mocker.patch.object(
+        dm, "save_one", side_effect=DatabaseUnavailable("open")
+    )
+    dm.save_signal(mocker.MagicMock())
+    dm.save_order(mocker.MagicMock(order_id="00000"))
+    # queued behind the pending write without being sent
+    assert len(dm.pending_writes) == 2
+    assert m_save_one.call_count == 1
+
+    m_save_one.side_effect = None
+    assert dm.replay_writes() == 2
+    assert not dm.pending_writes
+    assert m_save_one.call_count == 3
+
+
+def test_write_timeout(dm: DataManager, mocker: MockerFixture):
+    cursor = dm.cli.conn.cursor.return_value
+    cursor.__enter__.return_value = cursor
+
+    def execute(query: str):
+        if query.startswith("update"):
+            raise psycopg2.extensions.QueryCanceledError("statement timeout")
+
+    cursor.execute.side_effect = execute
+    order = SF31Order(
+        signal_id="001",
+        sfdate=datetime.date(2023, 5, 26),
+        sftime=datetime.time(9, 0),
+        strategy_id=1,
+        security_type=SecurityType.Stock,
+        code="2330",
+        order_type=OrderType.ROD,
+        price_type=PriceType.LMT,
+        action=Action.Buy,
+        quantity=1,
+        price=Decimal("500"),
+        order_id="A0001",
+    )
+    dm.update_sf31_order(order)
+
+    cursor.execute.assert_any_call(
+        f"set local statement_timeout = {int(Config.DB_TIMEOUTS['update_sf31_order'])}"
+    )
+    assert len(dm.pending_writes) == 1
+    assert dm.cli.profiler.callers["update_sf31_order"].timeouts == 1
+    assert not dm.is_degraded()
+
+
+def test_late_cancel(dm: DataManager):
+    with dm.cli._cancel_after(1000):
+        (token,) = dm.cli._cancel_tokens
+        dm.cli._cancel(dm.cli.conn, token)
+    assert dm.cli.conn.cancel.call_count == 1
+    # the timer fired after the statement, the next one is not cancelled
+    dm.cli._cancel(dm.cli.conn, token)
+    assert dm.cli.conn.cancel.call_count == 1
+
+
+def test_stream_query_closed_early(dm: DataManager, mocker: MockerFixture):
+    stream_conn = mocker.MagicMock()
+    stream_conn.closed = 0
+    mocker.patch("psycopg2.connect", return_value=stream_conn)
+    cursor = stream_conn.cursor.return_value
+    cursor.closed = False
+    cursor.fetchmany.return_value = [(1,), (2,)]
+
+    rows = dm.cli.stream_query("select 1", out_type="tuple")
+    assert next(rows) == (1,)
+    rows.close()
+    # the named cursor and its transaction are released on the stream connection
+    cursor.close.assert_called_once()
+    stream_conn.rollback.assert_called_once()
+    assert not dm.cli.conn.rollback.called
+
+
+def test_update_sf31_order_ids(dm: DataManager, mocker: MockerFixture):
+    m_execute_query = mocker.patch.object(dm.cli, "execute_query", return_value=0)
+    orders = [
+        SF31Order(
+            signal_id=signal_id,
+            sfdate=datetime.date(2023, 5, 26),
+            sftime=datetime.time(9, 0),
+            strategy_id=1,
+            security_type=SecurityType.Stock,
+            code="2330",
+            order_type=OrderType.ROD,
+            price_type=PriceType.LMT,
+            action=Action.Buy,
+            quantity=1,
+            price=Decimal("500"),
+            order_id=order_id,
+        )
+        for signal_id, order_id in [("001", "A0001"), ("002", "A0002")]
+    ]
+    dm.cli.last_rowcount = 2
+    dm.update_sf31_order_ids(orders)
+
+    assert m_execute_query.call_count == 1
+    query = m_execute_query.call_args[0][0]
+    assert (
+        "('001', 1, '2023-05-26'::date, '09:00:00.000000'::time, '2330', "
+        "500::numeric, 1, 'B', 'A0001')" in query
+    )
+    assert "o.signal_id = v.signal_id and o.strategy_id = v.strategy_id" in query
+    assert "o.action = v.action" in query
+
+    # an sf31 order not inserted matches no row, the missing ones are listed
+    dm.cli.last_rowcount = 1
+    m_execute_query.side_effect = [
+        0,
+        [("002", 1, datetime.date(2023, 5, 26), "2330")],
+    ]
+    with pytest.raises(Exception, match="'002'"):
+        dm.update_sf31_order_ids(orders)
+    assert "not exists" in m_execute_query.call_args[0][0]
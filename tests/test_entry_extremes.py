@@ -0,0 +1,65 @@
+import datetime
+
+from bunny_order.entry_extremes import EntryExtremes
+from bunny_order.models import Position, Action
+
+
+def get_position(**kwargs) -> Position:
+    return Position(
+        **{
+            "strategy": 1,
+            "code": "2836",
+            "action": Action.Buy,
+            "qty": 3,
+            "cost_amt": 37200.0,
+            "avg_prc": 12.4,
+            "first_entry_date": datetime.date(2023, 5, 25),
+            "low_since_entry": None,
+            "high_since_entry": None,
+            **kwargs,
+        }
+    )
+
+
+def test_entry_extremes():
+    extremes = EntryExtremes()
+    # position without high / low before the seed
+    position = get_position()
+    assert extremes.get(position) == (None, None)
+
+    extremes.seed(
+        [get_position(low_since_entry=11.4, high_since_entry=13.4)],
+        datetime.date(2023, 5, 30),
+    )
+    assert extremes.version == 1
+    assert extremes.get(position) == (13.4, 11.4)
+
+    # quotes of the day
+    extremes.update([position], high=13.0, low=11.0)
+    assert extremes.get(position) == (13.4, 11.0)
+    extremes.update([position], high=13.8, low=11.5)
+    assert extremes.get(position) == (13.8, 11.0)
+    # no trade yet
+    extremes.update([position], high=0.0, low=0.0)
+    assert extremes.get(position) == (13.8, 11.0)
+
+    # the next seed keeps the quotes applied since the previous one
+    extremes.seed(
+        [get_position(low_since_entry=11.2, high_since_entry=13.6)],
+        datetime.date(2023, 5, 31),
+    )
+    assert extremes.get(position) == (13.8, 11.0)
+
+    # re-entered position starts over from its quotes, the position values
+    # are not used
+    reentered = get_position(
+        first_entry_date=datetime.date(2023, 6, 1),
+        low_since_entry=12.0,
+        high_since_entry=12.0,
+    )
+    assert extremes.get(reentered) == (None, None)
+    extremes.update([reentered], high=12.5, low=11.9)
+    assert extremes.get(reentered) == (12.5, 11.9)
+
+    extremes.retain([(1, "2882")])
+    assert len(extremes) == 0
@@ -1,10 +1,13 @@
 import pytest
 from pytest_mock import MockerFixture
-from typing import List, Dict
+from typing import List, Dict, Optional
 import datetime
+import random
 from decimal import Decimal
 
 from bunny_order.exit_handler import ExitHandler
+from bunny_order.exit_tracker import ExitOrderTracker
+from bunny_order.exit_workers import ExitWorkerPool
 from bunny_order.models import (
     Position,
     Strategy,
@@ -15,22 +18,129 @@ from bunny_order.models import (
     Action,
     ExitType,
 )
-from bunny_order.common import Positions, Strategies, Contracts, TradingDates
+from bunny_order.common import (
+    Positions,
+    Strategies,
+    Contracts,
+    TradingDates,
+    Snapshots,
+    ColumnarSnapshots,
+)
+from bunny_order.clock import clock
+from bunny_order.exit_rules import ExitBook, get_code_triggers, find_candidate_rows
 
 
 @pytest.fixture(name="exit_handler")
 def exit_handler(
+    tmp_path,
     strategies: Strategies,
     positions: Positions,
     contracts: Contracts,
     trading_dates: TradingDates,
 ):
-    return ExitHandler(
+    exit_handler = ExitHandler(
         strategies=strategies,
         positions=positions,
         contracts=contracts,
         trading_dates=trading_dates,
     )
+    exit_handler.exit_orders = ExitOrderTracker(
+        f"{tmp_path}/exit_orders.jsonl", legacy_path=f"{tmp_path}/exit_handler.json"
+    )
+    return exit_handler
+
+
+def evaluate_quote(
+    exit_handler: ExitHandler,
+    strategy: Strategy,
+    position: Position,
+    snapshot: QuoteSnapshot,
+):
+    """evaluate the quote of a single position through on_quote"""
+    clock.invalidate()
+    exit_handler.strategies.update({strategy.id: strategy.copy()})
+    exit_handler.positions.update({position.strategy: {position.code: position}})
+    snapshots = ColumnarSnapshots()
+    snapshots.update(
+        {
+            snapshot.code: snapshot.copy(
+                update={"dt": clock.now() - datetime.timedelta(seconds=1)}
+            )
+        }
+    )
+    exit_handler._evaluated.clear()
+    exit_handler.on_quote(snapshots, [snapshot.code])
+
+
+def evaluate_out_date(
+    exit_handler: ExitHandler, strategy: Strategy, position: Position
+):
+    """out-date exit of a single position through before_market_signals"""
+    clock.invalidate()
+    exit_handler.strategies.update({strategy.id: strategy.copy()})
+    exit_handler.positions.update({position.strategy: {position.code: position}})
+    exit_handler.before_market_signals()
+
+
+def reference_quote_exit(
+    strategy: Strategy,
+    position: Position,
+    snapshot: QuoteSnapshot,
+    high_since_entry: Optional[float],
+    low_since_entry: Optional[float],
+    dp_due: bool,
+) -> Optional[ExitType]:
+    """first exit of the quote rules in their scalar order, the reference"""
+    is_long = position.action == Action.Buy
+
+    def get_returns(price: float) -> float:
+        if is_long:
+            return price / position.avg_prc - 1
+        return 1 - price / position.avg_prc
+
+    returns = get_returns(snapshot.close)
+    if (
+        strategy.exit_profit_pullback_ratio is not None
+        and strategy.exit_profit_pullback_threshold is not None
+    ):
+        if is_long:
+            best = snapshot.high
+            if high_since_entry is not None:
+                best = max(best, high_since_entry)
+        else:
+            best = snapshot.low
+            if low_since_entry is not None:
+                best = min(best, low_since_entry)
+        max_returns = get_returns(best)
+        if max_returns >= strategy.exit_profit_pullback_threshold and (
+            returns < 0
+            or 1 - returns / max_returns >= strategy.exit_profit_pullback_ratio
+        ):
+            return ExitType.ExitByProfitPullback
+    if (
+        dp_due
+        and strategy.exit_dp_days is not None
+        and strategy.exit_dp_profit_limit is not None
+        and returns <= strategy.exit_dp_profit_limit
+    ):
+        return ExitType.ExitByDaysProfitLimit
+    if strategy.exit_take_profit is not None and returns >= strategy.exit_take_profit:
+        return ExitType.ExitByTakeProfit
+    if strategy.exit_stop_loss is not None and returns <= strategy.exit_stop_loss:
+        return ExitType.ExitByStopLoss
+    return None
+
+
+def is_due(trading_dates: TradingDates, first_entry_date, days) -> bool:
+    """reference due date rule, never due outside the trading calendar"""
+    if days is None:
+        return False
+    try:
+        return clock.today() >= trading_dates.get_next_n_trading_date(
+            first_entry_date, days
+        )
+    except Exception:
+        return False
 
 
 def test_send_exit_signal(exit_handler: ExitHandler):
@@ -91,17 +201,17 @@ def test_exit_by_out_date(freezer, mocker: MockerFixture, exit_handler: ExitHand
     m_send_exit_signal = mocker.patch.object(exit_handler, "send_exit_signal")
     _ = mocker.patch.object(exit_handler.trading_dates, "_check_updated")
     # no signal
-    exit_handler.exit_by_out_date(strategy=strategy, position=position)
+    evaluate_out_date(exit_handler, strategy, position)
     m_send_exit_signal.assert_not_called()
 
     # no signal
     strategy.holding_period = 2
-    exit_handler.exit_by_out_date(strategy=strategy, position=position)
+    evaluate_out_date(exit_handler, strategy, position)
     m_send_exit_signal.assert_not_called()
 
     # signal
     strategy.holding_period = 1
-    exit_handler.exit_by_out_date(strategy=strategy, position=position)
+    evaluate_out_date(exit_handler, strategy, position)
     m_send_exit_signal.assert_called_once_with(position, ExitType.ExitByOutDate)
 
 
@@ -157,33 +267,25 @@ def test_exit_by_days_profit_limit(
     m_send_exit_signal = mocker.patch.object(exit_handler, "send_exit_signal")
     _ = mocker.patch.object(exit_handler.trading_dates, "_check_updated")
     # no signal
-    exit_handler.exit_by_days_profit_limit(
-        strategy=strategy, position=position, snapshot=snapshot
-    )
+    evaluate_quote(exit_handler, strategy, position, snapshot)
     m_send_exit_signal.assert_not_called()
 
     # no signal
     strategy.exit_dp_days = 2  # met
     strategy.exit_dp_profit_limit = -0.1  # not met
-    exit_handler.exit_by_days_profit_limit(
-        strategy=strategy, position=position, snapshot=snapshot
-    )
+    evaluate_quote(exit_handler, strategy, position, snapshot)
     m_send_exit_signal.assert_not_called()
 
     # no signal
     strategy.exit_dp_days = 5  # not met
     strategy.exit_dp_profit_limit = 0.1  # met
-    exit_handler.exit_by_days_profit_limit(
-        strategy=strategy, position=position, snapshot=snapshot
-    )
+    evaluate_quote(exit_handler, strategy, position, snapshot)
     m_send_exit_signal.assert_not_called()
 
     # signal
     strategy.exit_dp_days = 2  # met
     strategy.exit_dp_profit_limit = 0.1  # met
-    exit_handler.exit_by_days_profit_limit(
-        strategy=strategy, position=position, snapshot=snapshot
-    )
+    evaluate_quote(exit_handler, strategy, position, snapshot)
     m_send_exit_signal.assert_called_once_with(position, ExitType.ExitByDaysProfitLimit)
 
 
@@ -236,16 +338,12 @@ def test_exit_by_take_profit(mocker: MockerFixture, exit_handler: ExitHandler):
     m_send_exit_signal = mocker.patch.object(exit_handler, "send_exit_signal")
     # no signal
     strategy.exit_take_profit = 0.1  # not met
-    exit_handler.exit_by_take_profit(
-        strategy=strategy, position=position, snapshot=snapshot
-    )
+    evaluate_quote(exit_handler, strategy, position, snapshot)
     m_send_exit_signal.assert_not_called()
 
     # signal
     strategy.exit_take_profit = -0.1  # met
-    exit_handler.exit_by_take_profit(
-        strategy=strategy, position=position, snapshot=snapshot
-    )
+    evaluate_quote(exit_handler, strategy, position, snapshot)
     m_send_exit_signal.assert_called_once_with(position, ExitType.ExitByTakeProfit)
 
 
@@ -298,16 +396,12 @@ def test_exit_by_stop_loss(mocker: MockerFixture, exit_handler: ExitHandler):
     m_send_exit_signal = mocker.patch.object(exit_handler, "send_exit_signal")
     # no signal
     strategy.exit_stop_loss = -0.1  # not met
-    exit_handler.exit_by_stop_loss(
-        strategy=strategy, position=position, snapshot=snapshot
-    )
+    evaluate_quote(exit_handler, strategy, position, snapshot)
     m_send_exit_signal.assert_not_called()
 
     # signal
     strategy.exit_stop_loss = 0.1  # met
-    exit_handler.exit_by_stop_loss(
-        strategy=strategy, position=position, snapshot=snapshot
-    )
+    evaluate_quote(exit_handler, strategy, position, snapshot)
     m_send_exit_signal.assert_called_once_with(position, ExitType.ExitByStopLoss)
 
 
@@ -359,25 +453,25 @@ def test_exit_by_profit_pullback_long(mocker: MockerFixture, exit_handler: ExitH
         sell_volume=34,
     )
 
+    # high / low since entry come from the entry extremes only
+    exit_handler.extremes.seed([position], datetime.date(2023, 5, 26))
     m_send_exit_signal = mocker.patch.object(exit_handler, "send_exit_signal")
     # no signal
     strategy.exit_profit_pullback_threshold = 0.1  # not met
     strategy.exit_profit_pullback_ratio = 0.5  # met
-    exit_handler.exit_by_profit_pullback(
-        strategy=strategy, position=position, snapshot=snapshot
-    )
+    evaluate_quote(exit_handler, strategy, position, snapshot)
     m_send_exit_signal.assert_not_called()
 
     # signal
     strategy.exit_profit_pullback_threshold = 0.03  # met
     strategy.exit_profit_pullback_ratio = 0.5  # met
-    exit_handler.exit_by_profit_pullback(
-        strategy=strategy, position=position, snapshot=snapshot
-    )
+    evaluate_quote(exit_handler, strategy, position, snapshot)
     m_send_exit_signal.assert_called_once_with(position, ExitType.ExitByProfitPullback)
 
 
-def test_exit_by_profit_pullback_short(mocker: MockerFixture, exit_handler: ExitHandler):
+def test_exit_by_profit_pullback_short(
+    mocker: MockerFixture, exit_handler: ExitHandler
+):
     position = Position(
         strategy=1,
         code="2836",
@@ -425,19 +519,322 @@ def test_exit_by_profit_pullback_short(mocker: MockerFixture, exit_handler: Exit
         sell_volume=34,
     )
 
+    # high / low since entry come from the entry extremes only
+    exit_handler.extremes.seed([position], datetime.date(2023, 5, 26))
     m_send_exit_signal = mocker.patch.object(exit_handler, "send_exit_signal")
     # no signal
     strategy.exit_profit_pullback_threshold = 0.1  # not met
     strategy.exit_profit_pullback_ratio = 0.5  # met
-    exit_handler.exit_by_profit_pullback(
-        strategy=strategy, position=position, snapshot=snapshot
-    )
+    evaluate_quote(exit_handler, strategy, position, snapshot)
     m_send_exit_signal.assert_not_called()
 
     # signal
     strategy.exit_profit_pullback_threshold = 0.03  # met
     strategy.exit_profit_pullback_ratio = 0.5  # met
-    exit_handler.exit_by_profit_pullback(
-        strategy=strategy, position=position, snapshot=snapshot
-    )
+    evaluate_quote(exit_handler, strategy, position, snapshot)
     m_send_exit_signal.assert_called_once_with(position, ExitType.ExitByProfitPullback)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_on_quote_matches_reference_rules(
+    seed: int,
+    mocker: MockerFixture,
+    exit_handler: ExitHandler,
+    strategies: Strategies,
+    snapshots: Snapshots,
+):
+    rnd = random.Random(seed)
+    strategies.update(
+        {
+            strategy.id: strategy.copy(
+                update={
+                    "exit_stop_loss": rnd.choice([None, -0.2, -0.05, 0.05]),
+                    "exit_take_profit": rnd.choice([None, -0.05, 0.05, 0.2]),
+                    "exit_dp_days": rnd.choice([None, 1, 3]),
+                    "exit_dp_profit_limit": rnd.choice([None, -0.05, 0.05]),
+                    "exit_profit_pullback_threshold": rnd.choice([None, 0.01, 0.1]),
+                    "exit_profit_pullback_ratio": rnd.choice([None, 0.3, 0.8]),
+                }
+            )
+            for strategy in strategies._data.values()
+        }
+    )
+    now = clock.now()
+    quotes = {
+        code: snapshot.copy(
+            update={
+                "dt": now - datetime.timedelta(seconds=1),
+                "close": round(snapshot.close * rnd.uniform(0.8, 1.2), 2),
+                "volume": rnd.choice([0, 1, 10]),
+            }
+        )
+        for code, snapshot in snapshots._data.items()
+    }
+    columnar_snapshots = ColumnarSnapshots()
+    columnar_snapshots.update(quotes)
+    exit_handler.extremes.seed(
+        [
+            exit_handler.positions.get_position(strategy_id, code)
+            for strategy_id, code in exit_handler.positions.get_position_strategy_codes()
+        ],
+        clock.today(),
+    )
+
+    sent = []
+    running = set()
+
+    def send_exit_signal(position: Position, exit_type: ExitType):
+        sent.append((position.strategy, position.code, exit_type))
+        running.add((position.strategy, position.code))
+
+    mocker.patch.object(exit_handler, "send_exit_signal", send_exit_signal)
+    mocker.patch.object(exit_handler, "is_running_signal", lambda *key: key in running)
+
+    exit_handler.on_quote(columnar_snapshots)
+    vectorised = list(sent)
+
+    # reference: the scalar exit rules in the previous on_quote order
+    expected = []
+    for strategy_id, code in exit_handler.positions.get_position_strategy_codes():
+        snapshot = quotes[code]
+        if snapshot.volume == 0:
+            continue
+        strategy = strategies.get_strategy(strategy_id)
+        position = exit_handler.positions.get_position(strategy_id, code)
+        exit_type = reference_quote_exit(
+            strategy,
+            position,
+            snapshot,
+            *exit_handler.extremes.get(position),
+            is_due(
+                exit_handler.trading_dates,
+                position.first_entry_date,
+                strategy.exit_dp_days,
+            ),
+        )
+        if exit_type is not None:
+            expected.append((strategy_id, code, exit_type))
+
+    assert vectorised == expected
+
+
+def test_exit_triggers(
+    positions: Positions, strategies: Strategies, trading_dates: TradingDates
+):
+    strategies.update(
+        {
+            strategy.id: strategy.copy(
+                update={"exit_take_profit": 0.1, "exit_stop_loss": -0.1}
+            )
+            for strategy in strategies._data.values()
+        }
+    )
+    book = ExitBook.from_positions(positions, strategies, trading_dates)
+    triggers = get_code_triggers(book, datetime.date(2023, 5, 30))
+    # long 2836 at 12.4, take profit at 13.64, stop loss at 11.16
+    (row,) = book.code_rows["2836"]
+    assert triggers["2836"].upper_levels.tolist() == pytest.approx([13.64])
+    assert triggers["2836"].lower_levels.tolist() == pytest.approx([11.16])
+    assert find_candidate_rows(book, triggers["2836"], 13.0, 13.0, 12.5).size == 0
+    assert find_candidate_rows(book, triggers["2836"], 13.7, 13.7, 12.5).tolist() == [
+        row
+    ]
+    assert find_candidate_rows(book, triggers["2836"], 11.1, 12.5, 11.1).tolist() == [
+        row
+    ]
+
+
+def test_missing_due_dates(
+    mocker: MockerFixture,
+    positions: Positions,
+    strategies: Strategies,
+    trading_dates: TradingDates,
+):
+    m_logger = mocker.patch("bunny_order.exit_rules.logger")
+    strategies.update(
+        {
+            strategy.id: strategy.copy(
+                update={"holding_period": 100000, "exit_dp_days": None}
+            )
+            for strategy in strategies._data.values()
+        }
+    )
+    book = ExitBook.from_positions(positions, strategies, trading_dates)
+    # due date past the trading calendar
+    assert book.out_due_rows.size == 0
+    messages = [call[0][0] for call in m_logger.warning.call_args_list]
+    assert any("holding_period" in x for x in messages)
+    assert not any("exit_dp_days" in x for x in messages)
+
+
+def test_before_market_signals(mocker: MockerFixture, exit_handler: ExitHandler):
+    exit_handler.strategies.update(
+        {
+            strategy.id: strategy.copy(update={"holding_period": 2})
+            for strategy in exit_handler.strategies._data.values()
+        }
+    )
+    mocker.patch.object(clock, "today", return_value=datetime.date(2023, 5, 30))
+    _ = mocker.patch.object(exit_handler.trading_dates, "_check_updated")
+    # due positions from the reference rule
+    m_send_exit_signal = mocker.patch.object(exit_handler, "send_exit_signal")
+    expected = [
+        (position, ExitType.ExitByOutDate)
+        for position in ExitBook.from_positions(
+            exit_handler.positions, exit_handler.strategies, exit_handler.trading_dates
+        ).positions
+        if is_due(
+            exit_handler.trading_dates,
+            position.first_entry_date,
+            exit_handler.strategies.get_strategy(position.strategy).holding_period,
+        )
+    ]
+    assert expected
+
+    running = {(expected[0][0].strategy, expected[0][0].code)}
+    mocker.patch.object(
+        exit_handler,
+        "is_running_signal",
+        side_effect=lambda strategy_id, code: (strategy_id, code) in running,
+    )
+    exit_handler.before_market_signals()
+    assert [c.args for c in m_send_exit_signal.call_args_list] == expected[1:]
+
+    # same day, only the running exit is retried once it is no longer running
+    m_send_exit_signal.reset_mock()
+    exit_handler.before_market_signals()
+    m_send_exit_signal.assert_not_called()
+    running.clear()
+    exit_handler.before_market_signals()
+    m_send_exit_signal.assert_called_once_with(*expected[0])
+    m_send_exit_signal.reset_mock()
+    exit_handler.before_market_signals()
+    m_send_exit_signal.assert_not_called()
+
+
+def test_on_quote_change_driven(
+    mocker: MockerFixture,
+    exit_handler: ExitHandler,
+    strategies: Strategies,
+    snapshots: Snapshots,
+):
+    now = clock.now()
+    quotes = {
+        code: snapshot.copy(
+            update={"dt": now - datetime.timedelta(seconds=1), "volume": 1}
+        )
+        for code, snapshot in snapshots._data.items()
+    }
+    columnar_snapshots = ColumnarSnapshots()
+    columnar_snapshots.update(quotes)
+    mocker.patch.object(exit_handler, "send_exit_signal")
+    book = exit_handler.get_exit_book()
+    codes = [code for code in book.code_rows if code in quotes]
+
+    exit_handler.on_quote(columnar_snapshots, codes)
+    assert exit_handler.stats.last_evaluations == sum(
+        len(book.code_rows[code]) for code in codes
+    )
+    assert not exit_handler.has_changed_codes()
+
+    # unchanged quotes
+    exit_handler.on_quote(columnar_snapshots, codes)
+    assert exit_handler.stats.last_evaluations == 0
+
+    # a code ticked
+    code = codes[0]
+    quotes[code] = quotes[code].copy(update={"close": quotes[code].close + 0.05})
+    columnar_snapshots.update(quotes)
+    exit_handler.on_quote(columnar_snapshots, codes)
+    assert exit_handler.stats.last_evaluations == len(book.code_rows[code])
+
+    # strategy changed, its codes are evaluated without a tick
+    strategy_id = int(book.strategy_ids[0])
+    strategies.update(
+        {
+            **strategies._data,
+            strategy_id: strategies.get_strategy(strategy_id).copy(
+                update={"exit_take_profit": 0.5}
+            ),
+        }
+    )
+    assert exit_handler.has_changed_codes()
+    changed = {
+        c for c in codes if strategy_id in book.strategy_ids[list(book.code_rows[c])]
+    }
+    exit_handler.on_quote(columnar_snapshots, [])
+    assert exit_handler.stats.last_evaluations == sum(
+        len(book.code_rows[c]) for c in changed
+    )
+    assert exit_handler.get_stats()["passes"] == 4
+
+
+def test_on_quote_workers(
+    mocker: MockerFixture,
+    exit_handler: ExitHandler,
+    strategies: Strategies,
+    snapshots: Snapshots,
+):
+    rnd = random.Random(0)
+    strategies.update(
+        {
+            strategy.id: strategy.copy(
+                update={
+                    "exit_stop_loss": rnd.choice([None, -0.05, 0.05]),
+                    "exit_take_profit": rnd.choice([None, -0.05, 0.05]),
+                    "exit_profit_pullback_threshold": rnd.choice([None, 0.01]),
+                    "exit_profit_pullback_ratio": rnd.choice([None, 0.3]),
+                }
+            )
+            for strategy in strategies._data.values()
+        }
+    )
+    now = clock.now()
+    quotes = {
+        code: snapshot.copy(
+            update={
+                "dt": now - datetime.timedelta(seconds=1),
+                "close": round(snapshot.close * rnd.uniform(0.8, 1.2), 2),
+                "volume": 1,
+            }
+        )
+        for code, snapshot in snapshots._data.items()
+    }
+    columnar_snapshots = ColumnarSnapshots()
+    columnar_snapshots.update(quotes)
+    sent = []
+    mocker.patch.object(
+        exit_handler,
+        "send_exit_signal",
+        lambda position, exit_type: sent.append(
+            (position.strategy, position.code, exit_type)
+        ),
+    )
+    exit_handler.on_quote(columnar_snapshots)
+    expected = list(sent)
+    assert expected
+
+    sent.clear()
+    exit_handler._evaluated.clear()
+    # the board grows past its capacity
+    exit_handler.workers = ExitWorkerPool(2, capacity=1)
+    exit_handler.workers.start()
+    try:
+        exit_handler.on_quote(columnar_snapshots)
+    finally:
+        exit_handler.workers.close()
+    assert sent == expected
+
+    sent.clear()
+    exit_handler._evaluated.clear()
+    # a dead worker falls back to the exit handler thread
+    exit_handler.workers = ExitWorkerPool(2, timeout=1)
+    exit_handler.workers.start()
+    try:
+        exit_handler.workers._processes[0].kill()
+        exit_handler.workers._processes[0].join()
+        exit_handler.on_quote(columnar_snapshots)
+        assert not exit_handler.workers.started
+    finally:
+        exit_handler.workers.close()
+    assert sent == expected
@@ -0,0 +1,134 @@
+import os
+import datetime
+import time
+from decimal import Decimal
+
+from bunny_order.exit_tracker import ExitOrderTracker
+from bunny_order.utils import dump_checkpoints
+from bunny_order.models import (
+    Signal,
+    SignalSource,
+    SecurityType,
+    OrderType,
+    PriceType,
+    Action,
+    ExitType,
+    ExitOrderState,
+    Order,
+    Trade,
+    RMRejectReason,
+)
+
+
+def get_signal() -> Signal:
+    return Signal(
+        id="s0001",
+        source=SignalSource.ExitHandler,
+        sdate=datetime.date(2023, 5, 30),
+        stime=datetime.time(9, 30),
+        strategy_id=1,
+        security_type=SecurityType.Stock,
+        code="2836",
+        order_type=OrderType.ROD,
+        price_type=PriceType.LMT,
+        action=Action.Sell,
+        quantity=3,
+        price=Decimal("11.2"),
+        exit_type=ExitType.ExitByStopLoss,
+    )
+
+
+def get_order(status: str = "New") -> Order:
+    return Order(
+        trader_id="0",
+        strategy=1,
+        order_id="A0001",
+        security_type=SecurityType.Stock,
+        order_date=datetime.date(2023, 5, 30),
+        order_time=datetime.time(9, 30),
+        code="2836",
+        action=Action.Sell,
+        order_price=Decimal("11.2"),
+        order_qty=3,
+        order_type=OrderType.ROD,
+        price_type=PriceType.LMT,
+        status=status,
+    )
+
+
+def get_trade(qty: int) -> Trade:
+    return Trade(
+        trader_id="0",
+        strategy=1,
+        order_id="A0001",
+        order_type=OrderType.ROD,
+        seqno="1",
+        security_type=SecurityType.Stock,
+        trade_date=datetime.date(2023, 5, 30),
+        trade_time=datetime.time(9, 30),
+        code="2836",
+        action=Action.Sell,
+        price=Decimal("11.2"),
+        qty=qty,
+    )
+
+
+def test_exit_order_lifecycle(tmp_path):
+    path = f"{tmp_path}/exit_orders.jsonl"
+    legacy_path = f"{tmp_path}/exit_handler.json"
+    tracker = ExitOrderTracker(path, legacy_path=legacy_path)
+    assert not tracker.is_running(1, "2836")
+
+    tracker.on_sent(get_signal())
+    assert tracker.is_running(1, "2836")
+    assert tracker.get(1, "2836").state == ExitOrderState.Sent
+
+    tracker.on_order(get_order())
+    assert tracker.get(1, "2836").state == ExitOrderState.Acked
+    tracker.on_trade(get_trade(2))
+    assert tracker.get(1, "2836").state == ExitOrderState.Acked
+    tracker.on_trade(get_trade(1))
+    assert tracker.get(1, "2836").state == ExitOrderState.Filled
+    assert tracker.is_running(1, "2836")
+
+    # the last state of each key is restored
+    tracker.close()
+    tracker = ExitOrderTracker(path, legacy_path=legacy_path)
+    assert tracker.get(1, "2836").state == ExitOrderState.Filled
+    assert tracker.get(1, "2836").filled_qty == 3
+
+    tracker.reset()
+    assert not tracker.is_running(1, "2836")
+    tracker.close()
+    assert len(ExitOrderTracker(path, legacy_path=legacy_path)) == 0
+
+
+def test_exit_order_reject_cooldown(tmp_path):
+    tracker = ExitOrderTracker(f"{tmp_path}/exit_orders.jsonl", reject_cooldown=60)
+    tracker.on_sent(get_signal())
+    tracker.on_order(get_order(status="Failed"))
+    assert tracker.get(1, "2836").state == ExitOrderState.Rejected
+    assert tracker.is_running(1, "2836")
+
+    tracker.get(1, "2836").update_ts = time.time() - 60
+    assert not tracker.is_running(1, "2836")
+
+    # rejected by the risk manager
+    signal = get_signal()
+    tracker.on_sent(signal)
+    signal.rm_reject_reason = RMRejectReason.InsufficientUnit
+    tracker.on_signal(signal)
+    assert tracker.get(1, "2836").state == ExitOrderState.Rejected
+
+
+def test_exit_order_legacy_checkpoint(tmp_path):
+    legacy_path = f"{tmp_path}/exit_handler.json"
+    dump_checkpoints(legacy_path, {"1": ["2836"]})
+    tracker = ExitOrderTracker(f"{tmp_path}/exit_orders.jsonl", legacy_path=legacy_path)
+    # running signals of the former checkpoint are not sent again
+    assert tracker.is_running(1, "2836")
+    assert not tracker.is_running(2, "2836")
+
+    tracker.reset()
+    assert not tracker.is_running(1, "2836")
+    assert not os.path.exists(legacy_path)
@@ -0,0 +1,248 @@
+import os
+import time
+import datetime
+from collections import deque
+from decimal import Decimal
+import pytest
+from pytest_mock import MockerFixture
+
+from bunny_order.engine import Engine
+from bunny_order.journal import Journal, JournalCheckpoint
+from bunny_order.database.journal_consumer import JournalConsumer
+from bunny_order.models import (
+    Event,
+    Trade,
+    SF31Order,
+    Order,
+    SecurityType,
+    OrderType,
+    PriceType,
+    Action,
+)
+
+
+def create_trade(seqno: str) -> Trade:
+    return Trade(
+        trader_id="000",
+        strategy=1,
+        order_id="A0001",
+        order_type=OrderType.ROD,
+        seqno=seqno,
+        security_type=SecurityType.Stock,
+        trade_date=datetime.date(2023, 5, 26),
+        trade_time=datetime.time(9, 0, 1, 123456),
+        code="2330",
+        action=Action.Buy,
+        price=Decimal("500.5"),
+        qty=1,
+    )
+
+
+def create_sf31_order(order_id: str) -> SF31Order:
+    return SF31Order(
+        signal_id="001",
+        sfdate=datetime.date(2023, 5, 26),
+        sftime=datetime.time(9, 0),
+        strategy_id=1,
+        security_type=SecurityType.Stock,
+        code="2330",
+        order_type=OrderType.ROD,
+        price_type=PriceType.LMT,
+        action=Action.Buy,
+        quantity=1,
+        price=Decimal("500"),
+        order_id=order_id,
+    )
+
+
+def test_journal_roundtrip(tmp_path):
+    journal = Journal(str(tmp_path), segment_size=256, fsync_interval=0, fsync_batch=1)
+    trades = [create_trade(f"{k:03d}") for k in range(5)]
+    offsets = [journal.append(Event.TradeCallback, trade) for trade in trades]
+    assert len(journal.get_segments()) > 1
+
+    records = journal.read(0)
+    assert [x.data for x in records] == trades
+    assert [x.offset for x in records] == offsets
+    # catch up from any offset across segments
+    records = journal.read(offsets[3])
+    assert [x.data for x in records] == trades[3:]
+    assert journal.read(records[-1].next_offset) == []
+
+
+def test_journal_torn_tail(tmp_path):
+    journal = Journal(str(tmp_path), fsync_interval=0)
+    journal.append(Event.TradeCallback, create_trade("001"))
+    offset = journal.append(Event.TradeCallback, create_trade("002"))
+    journal.close()
+    path = f"{tmp_path}/{journal.get_segments()[-1]:020d}.journal"
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 3)
+
+    journal = Journal(str(tmp_path), fsync_interval=0)
+    assert journal.offset == offset
+    assert len(journal.read(0)) == 1
+    journal.append(Event.TradeCallback, create_trade("003"))
+    assert [x.data.seqno for x in journal.read(0)] == ["001", "003"]
+
+
+def test_journal_crc_mismatch(tmp_path):
+    journal = Journal(str(tmp_path), fsync_interval=0)
+    journal.append(Event.TradeCallback, create_trade("001"))
+    journal.append(Event.TradeCallback, create_trade("002"))
+    path = f"{tmp_path}/{journal.get_segments()[0]:020d}.journal"
+    with open(path, "r+b") as f:
+        f.seek(40)
+        f.write(b"x")
+    with pytest.raises(Exception, match="crc mismatch"):
+        journal.read(0)
+
+
+def test_journal_find_offset(tmp_path):
+    journal = Journal(str(tmp_path), fsync_interval=0)
+    journal.append(Event.TradeCallback, create_trade("001"))
+    journal.roll()
+    since_ts = time.time()
+    offset = journal.append(Event.TradeCallback, create_trade("002"))
+    assert journal.find_offset(since_ts) == offset
+    assert journal.find_offset(time.time() + 1) == journal.offset
+
+
+def test_journal_consumer(tmp_path, mocker: MockerFixture):
+    m_dm = mocker.patch("bunny_order.database.journal_consumer.DataManager")
+    dm = m_dm.return_value
+    dm.is_degraded.return_value = False
+    dm.pending_writes = []
+    journal = Journal(str(tmp_path), fsync_interval=0)
+    journal.append(Event.OrderMapping, create_sf31_order("A0001"))
+    journal.append(Event.OrderMapping, create_sf31_order("A0002"))
+    journal.append(Event.TradeCallback, create_trade("001"))
+
+    checkpoint_path = f"{tmp_path}/db_consumer.offset"
+    consumer = JournalConsumer(journal, checkpoint_path=checkpoint_path)
+    assert consumer.consume() == 3
+    assert consumer.consume() == 0
+    # consecutive mappings in one bulk update
+    assert dm.update_sf31_order_ids.call_count == 1
+    assert [x.order_id for x in dm.update_sf31_order_ids.call_args[0][0]] == [
+        "A0001",
+        "A0002",
+    ]
+    dm.save_trade.assert_called_once_with(create_trade("001"))
+    assert JournalCheckpoint(checkpoint_path).load() == journal.offset
+
+    consumer = JournalConsumer(journal, checkpoint_path=checkpoint_path)
+    assert consumer.consume() == 0
+    consumer.seek(0)
+    assert consumer.consume() == 3
+
+
+def test_journal_consumer_failed_record(tmp_path, mocker: MockerFixture):
+    m_dm = mocker.patch("bunny_order.database.journal_consumer.DataManager")
+    dm = m_dm.return_value
+    dm.is_degraded.return_value = False
+    dm.pending_writes = []
+    dm.retry_interval = 0
+    dm.update_sf31_order_ids.side_effect = [Exception("bulk"), None, Exception("bad")]
+    journal = Journal(str(tmp_path), fsync_interval=0)
+    journal.append(Event.OrderMapping, create_sf31_order("A0001"))
+    offset = journal.append(Event.OrderMapping, create_sf31_order("A0002"))
+    journal.append(Event.TradeCallback, create_trade("001"))
+
+    checkpoint_path = f"{tmp_path}/db_consumer.offset"
+    dead_letter_path = f"{tmp_path}/db_consumer.dead_letter"
+    consumer = JournalConsumer(
+        journal,
+        checkpoint_path=checkpoint_path,
+        dead_letter_path=dead_letter_path,
+        max_retries=2,
+    )
+    # stop at the failing mapping, the checkpoint covers written records only
+    assert consumer.consume() == 1
+    assert JournalCheckpoint(checkpoint_path).load() == offset
+    assert not dm.save_trade.called
+
+    # moved to the dead-letter file on the last attempt
+    dm.update_sf31_order_ids.side_effect = Exception("bad")
+    assert consumer.consume() == 2
+    dm.save_trade.assert_called_once_with(create_trade("001"))
+    assert JournalCheckpoint(checkpoint_path).load() == journal.offset
+    with open(dead_letter_path, encoding="utf-8") as f:
+        lines = f.readlines()
+    assert len(lines) == 1
+    assert '"offset": %d' % offset in lines[0]
+
+
+def test_journal_delete_segments(tmp_path):
+    journal = Journal(str(tmp_path), fsync_interval=0)
+    journal.append(Event.TradeCallback, create_trade("001"))
+    journal.roll()
+    offset = journal.append(Event.TradeCallback, create_trade("002"))
+    journal.roll()
+    journal.append(Event.TradeCallback, create_trade("003"))
+    assert len(journal.get_segments()) == 3
+
+    # not persisted yet or within the retention
+    assert journal.delete_segments(0, time.time()) == []
+    assert journal.delete_segments(offset, time.time() - 60) == []
+    assert journal.delete_segments(offset, time.time()) == [0]
+    assert journal.get_segments()[0] == offset
+    # the current segment is kept
+    assert journal.delete_segments(journal.offset, time.time()) == [offset]
+    assert [x.data.seqno for x in journal.read(0)] == ["003"]
+
+
+def test_recover_from_journal(tmp_path, mocker: MockerFixture):
+    journal = Journal(str(tmp_path), fsync_interval=0, fsync_batch=1)
+    orders = [create_sf31_order("") for _ in range(3)]
+    for k, order in enumerate(orders):
+        order.code = f"233{k}"
+    order_cbs = [
+        Order(
+            trader_id="000",
+            strategy=order.strategy_id,
+            order_id=f"A000{k}",
+            security_type=order.security_type,
+            order_date=order.sfdate,
+            order_time=order.sftime,
+            code=order.code,
+            action=order.action,
+            order_price=order.price,
+            order_qty=order.quantity,
+            order_type=order.order_type,
+            price_type=order.price_type,
+            status="New",
+        )
+        for k, order in enumerate(orders)
+    ]
+    for order in orders:
+        journal.append(Event.SF31Order, order)
+    # mapped and journaled
+    journal.append(Event.OrderCallback, order_cbs[0])
+    journal.append(
+        Event.OrderMapping, orders[0].copy(update={"order_id": order_cbs[0].order_id})
+    )
+    # mapped, the mapping is lost in the crash
+    journal.append(Event.OrderCallback, order_cbs[1])
+
+    # only the recovery state, no threads nor connections
+    mocker.patch.object(Engine, "__del__", lambda self: None)
+    engine = Engine.__new__(Engine)
+    engine.journal = mocker.MagicMock(wraps=journal)
+    engine.journal_consumer = mocker.MagicMock(persisted_offset=0)
+    engine.positions = mocker.MagicMock()
+    engine.unhandled_orders = deque()
+    engine.order_mappings = []
+    engine.order_callbacks = {}
+    engine.recover_from_journal()
+
+    # the sf31 order without a callback waits for it
+    assert list(engine.unhandled_orders) == [orders[2]]
+    assert set(engine.order_callbacks) == {"A0000", "A0001"}
+    # the lost mapping is journaled again, the journaled one is not
+    mappings = [
+        call.args[1]
+        for call in engine.journal.append.call_args_list
+        if call.args[0] == Event.OrderMapping
+    ]
+    assert mappings == [orders[1].copy(update={"order_id": "A0001"})]
@@ -0,0 +1,29 @@
+from pytest_mock import MockerFixture
+
+from bunny_order.database.listener import TSDBListener
+
+
+def test_is_pushed_requires_trigger(mocker: MockerFixture):
+    conn = mocker.MagicMock(closed=0)
+    conn.cursor.return_value.fetchall.return_value = [
+        (memoryview(b"strategy_changed\x00"),),
+        (memoryview(b"contracts_changed\x00"),),
+    ]
+    mocker.patch("psycopg2.connect", return_value=conn)
+    listener = TSDBListener(
+        "localhost",
+        5432,
+        "user",
+        "password",
+        "db",
+        ["strategy_changed", "positions_changed"],
+    )
+    assert not listener.is_pushed("strategy_changed")
+
+    listener.connect()
+    assert listener.triggered_channels == {"strategy_changed", "contracts_changed"}
+    assert listener.is_pushed("strategy_changed")
+    assert not listener.is_pushed("positions_changed")
+
+    listener.close()
+    assert not listener.is_pushed("strategy_changed")
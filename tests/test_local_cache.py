@@ -0,0 +1,30 @@
+import datetime
+
+from bunny_order.database.local_cache import LocalCache
+from bunny_order.common import Positions, Strategies, Contracts, TradingDates
+
+
+def test_local_cache_roundtrip(
+    tmp_path,
+    strategies: Strategies,
+    positions: Positions,
+    contracts: Contracts,
+    trading_dates: TradingDates,
+):
+    local_cache = LocalCache(cache_dir=str(tmp_path))
+    update_dt = datetime.datetime(2023, 5, 26, 8, 20)
+    local_cache.dump_strategies(strategies._data, update_dt)
+    local_cache.dump_positions(positions._data, update_dt)
+    local_cache.dump_contracts(contracts._data, update_dt)
+    local_cache.dump_trading_dates(trading_dates._data, update_dt)
+
+    data, cached_dt = local_cache.load_strategies()
+    assert cached_dt == update_dt
+    assert data == strategies._data
+    data, _ = local_cache.load_positions()
+    assert data == positions._data
+    data, _ = local_cache.load_contracts()
+    assert data == contracts._data
+    data, _ = local_cache.load_trading_dates()
+    assert data == list(trading_dates._data)
+    assert local_cache.load_coming_dividends() is None
@@ -24,16 +24,22 @@ from bunny_order.common import Positions, Strategies, Contracts, Snapshots, Trad
 
 @pytest.fixture()
 def order_manager(
-    strategies: Strategies, contracts: Contracts, trading_dates: TradingDates
+    mocker: MockerFixture,
+    strategies: Strategies,
+    contracts: Contracts,
+    trading_dates: TradingDates,
 ):
     return OrderManager(
-        strategies=strategies, contracts=contracts, trading_dates=trading_dates
+        strategies=strategies,
+        contracts=contracts,
+        trading_dates=trading_dates,
+        journal=mocker.MagicMock(),
     )
 
 
 @pytest.fixture()
 def signal_collector(mocker: MockerFixture, contracts: Dict[str, Contract]):
-    return SignalCollector(dm=mocker, contracts=contracts)
+    return SignalCollector(journal=mocker.MagicMock(), contracts=contracts)
 
 
 def create_signal(
@@ -0,0 +1,53 @@
+import json
+import threading
+import time
+
+from bunny_order.database.profiler import QueryProfiler, get_fingerprint, report
+
+
+def test_get_fingerprint():
+    q1 = "select * from sino.contracts where code in ('2330','2317') and qty > 1000"
+    q2 = "select *  from sino.contracts\nwhere code in ('1101') and qty > 5"
+    assert get_fingerprint(q1) == get_fingerprint(q2)
+    assert get_fingerprint(q1) == (
+        "select * from sino.contracts where code in (...) and qty > ?"
+    )
+
+
+def test_profiler_dump_and_report(tmp_path):
+    profiler = QueryProfiler(slow_query_ms=1e9)
+    with profiler.caller("get_positions"):
+        with profiler.caller("inner"):
+            profiler.record("select 1", 3)
+        profiler.record("select 2", 30)
+    profiler.record("select 3", 1, error=True)
+
+    assert profiler.callers["get_positions"].count == 2
+    assert profiler.callers["unknown"].errors == 1
+    assert profiler.statements["select ?"].percentile(0.5) == 5
+
+    profiler.dump(str(tmp_path))
+    path = tmp_path / f"db_profile_{profiler.date.strftime('%Y%m%d')}.json"
+    assert json.loads(path.read_text())["callers"]["get_positions"]["count"] == 2
+    lines = report([str(path)]).splitlines()
+    assert lines[1].endswith("get_positions")
+
+
+def test_profiler_explain_off_thread():
+    profiler = QueryProfiler(slow_query_ms=10)
+    explained = threading.Event()
+    threads = []
+
+    def explain(query: str) -> str:
+        threads.append(threading.current_thread().name)
+        explained.set()
+        return "plan"
+
+    profiler.explain = explain
+    profiler.record("select 1", 20)
+    assert explained.wait(1)
+    assert threads == ["query_explain"]
+    # once per fingerprint within the cooldown
+    profiler.record("select 2", 20)
+    time.sleep(0.05)
+    assert len(threads) == 1
@@ -1,7 +1,10 @@
 import pytest
+import threading
+import time
 from decimal import Decimal
 
-from bunny_order.utils import adjust_price_for_tick_unit
+from bunny_order.utils import adjust_price_for_tick_unit, WriteLock
+from bunny_order.errors import LockTimeout
 
 
 @pytest.mark.parametrize(
@@ -30,3 +33,44 @@ from bunny_order.utils import adjust_price_for_tick_unit
 )
 def test_adjust_price_for_tick_unit(price: Decimal, expected: Decimal):
     assert adjust_price_for_tick_unit(price) == expected
+
+
+def test_write_lock_contention():
+    lock = WriteLock("test", timeout=0.05)
+    lock.acquire_write()
+
+    acquired = threading.Event()
+
+    def write():
+        lock.acquire_write(timeout=1)
+        acquired.set()
+        lock.release_write()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    while not lock.get_stats()["waiters"]:
+        time.sleep(0.001)
+
+    assert not acquired.is_set()
+    lock.release_write()
+    writer.join(1)
+    assert acquired.is_set()
+
+    stats = lock.get_stats()
+    assert stats["writes"] == 2
+    assert stats["timeouts"] == 0
+    assert stats["max_waiters"] == 1
+    assert stats["max_write_wait_ms"] > 0
+    assert stats["waiters"] == 0
+
+
+def test_write_lock_timeout():
+    lock = WriteLock("test", timeout=0.01)
+    lock.acquire_write()
+    with pytest.raises(LockTimeout):
+        lock.acquire_write()
+    lock.release_write()
+    lock.acquire_write()
+    lock.release_write()
+    assert lock.get_stats()["writes"] == 2
+    assert lock.get_stats()["timeouts"] == 1